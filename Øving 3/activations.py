@@ -0,0 +1,89 @@
+import typing
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class _AllActivationsCaptured(Exception):
+    pass
+
+
+def stream_activations(model: nn.Module,
+                       layer_names: typing.List[str],
+                       images: torch.Tensor,
+                       batch_size: int = 32,
+                       dtype: torch.dtype = None,
+                       downsample: int = None) -> typing.Iterator[dict]:
+    """
+    Runs images through model in batches and yields, for every batch, a dict
+    from layer name to the output of that layer. The outputs are captured
+    with forward hooks in a single forward pass. A layer that is called more
+    than once per forward pass (e.g. the shared ReLU of a ResNet BasicBlock)
+    yields the output of its last call. The first forward pass runs the whole
+    model to find the last call of a requested layer, later forward passes
+    are stopped right after it, so later layers are not computed.
+    Args:
+        layer_names: names of the layers as given by model.named_modules(), e.g. ["conv1", "layer4"]
+        images: shape [num_images, 3, H, W]
+        dtype: if set, activations are stored in this dtype (e.g. torch.float16)
+        downsample: if set, 4D activations are average pooled to [downsample, downsample]
+    """
+    modules = dict(model.named_modules())
+    for name in layer_names:
+        assert name in modules, f"Did not find layer {name} in {type(model).__name__}"
+    device = next(model.parameters()).device
+    captured, calls = {}, {}
+    last_name = None
+    # (layer name, number of calls) of the last call of a requested layer
+    stop_at = None
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            nonlocal last_name
+            output = output.detach()
+            if downsample is not None and output.dim() == 4:
+                output = F.adaptive_avg_pool2d(output, downsample)
+            if dtype is not None:
+                output = output.to(dtype)
+            captured[name] = output.cpu()
+            calls[name] = calls.get(name, 0) + 1
+            last_name = name
+            if (name, calls[name]) == stop_at:
+                raise _AllActivationsCaptured()
+        return hook
+
+    handles = [modules[name].register_forward_hook(make_hook(name)) for name in layer_names]
+    try:
+        with torch.inference_mode():
+            for start in range(0, len(images), batch_size):
+                captured, calls = {}, {}
+                try:
+                    model(images[start:start + batch_size].to(device))
+                except _AllActivationsCaptured:
+                    pass
+                if stop_at is None:
+                    stop_at = (last_name, calls[last_name])
+                yield captured
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def capture_activations(model: nn.Module,
+                        layer_names: typing.List[str],
+                        images: torch.Tensor,
+                        batch_size: int = 32,
+                        dtype: torch.dtype = None,
+                        downsample: int = None,
+                        stream: bool = False):
+    """
+    Captures the outputs of the given layers for all images (see stream_activations).
+    Returns:
+        dict from layer name to a tensor of shape [num_images, ...],
+        or an iterator over per-batch dicts if stream is set
+    """
+    batches = stream_activations(model, layer_names, images, batch_size, dtype, downsample)
+    if stream:
+        return batches
+    batches = list(batches)
+    return {name: torch.cat([batch[name] for batch in batches]) for name in layer_names}
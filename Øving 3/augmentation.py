@@ -0,0 +1,95 @@
+import torch
+import typing
+import dataloaders
+
+
+class BatchAugmentation:
+
+    def __init__(self,
+                 crop_padding: int = 4,
+                 flip_probability: float = 0.5,
+                 brightness: float = 0.,
+                 contrast: float = 0.,
+                 saturation: float = 0.,
+                 mean: typing.Sequence[float] = dataloaders.mean,
+                 std: typing.Sequence[float] = dataloaders.std,
+                 seed: int = 0):
+        """
+            Random crop-with-padding, horizontal flip and color jitter applied
+            to a whole normalized batch of shape [batch_size, 3, H, W] at once.
+            Every sample gets its own random parameters, drawn from a seeded
+            generator so the augmentations are reproducible.
+            Args:
+                crop_padding: number of zero pixels added to each side before cropping (0 disables)
+                flip_probability: probability of flipping each image horizontally
+                brightness, contrast, saturation: jitter factors are drawn uniformly
+                    from [1 - value, 1 + value] (0 disables)
+                mean, std: the normalization used by the dataloader
+        """
+        self.crop_padding = crop_padding
+        self.flip_probability = flip_probability
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def _uniform(self, batch_size: int, low: float, high: float, device):
+        values = torch.rand(batch_size, generator=self.generator)
+        return (low + (high - low) * values).to(device)
+
+    def _jitter_factors(self, batch_size: int, value: float, device):
+        return self._uniform(batch_size, 1 - value, 1 + value, device).view(-1, 1, 1, 1)
+
+    def random_crop(self, X_batch: torch.Tensor):
+        batch_size, channels, height, width = X_batch.shape
+        pad = self.crop_padding
+        padded = torch.nn.functional.pad(X_batch, (pad, pad, pad, pad))
+        offsets = torch.randint(0, 2*pad + 1, (2, batch_size), generator=self.generator)
+        offsets = offsets.to(X_batch.device)
+        # Per-sample row/column indices into the padded images
+        rows = offsets[0, :, None] + torch.arange(height, device=X_batch.device)
+        cols = offsets[1, :, None] + torch.arange(width, device=X_batch.device)
+        batch_idx = torch.arange(batch_size, device=X_batch.device).view(-1, 1, 1, 1)
+        channel_idx = torch.arange(channels, device=X_batch.device).view(1, -1, 1, 1)
+        return padded[batch_idx, channel_idx, rows[:, None, :, None], cols[:, None, None, :]]
+
+    def random_flip(self, X_batch: torch.Tensor):
+        flip = self._uniform(X_batch.shape[0], 0, 1, X_batch.device) < self.flip_probability
+        return torch.where(flip.view(-1, 1, 1, 1), X_batch.flip(3), X_batch)
+
+    def color_jitter(self, X_batch: torch.Tensor):
+        batch_size = X_batch.shape[0]
+        if self.brightness > 0:
+            X_batch = X_batch * self._jitter_factors(batch_size, self.brightness, X_batch.device)
+        if self.contrast > 0:
+            gray_mean = grayscale(X_batch).mean(dim=(1, 2, 3), keepdim=True)
+            factors = self._jitter_factors(batch_size, self.contrast, X_batch.device)
+            X_batch = (X_batch - gray_mean) * factors + gray_mean
+        if self.saturation > 0:
+            gray = grayscale(X_batch)
+            factors = self._jitter_factors(batch_size, self.saturation, X_batch.device)
+            X_batch = (X_batch - gray) * factors + gray
+        return X_batch.clamp(0, 1)
+
+    def __call__(self, X_batch: torch.Tensor):
+        mean = self.mean.to(X_batch.device)
+        std = self.std.to(X_batch.device)
+        # Augment in [0, 1] pixel space, so padding is black and jitter acts on real colors
+        X_batch = X_batch * std + mean
+        if self.crop_padding > 0:
+            X_batch = self.random_crop(X_batch)
+        if self.flip_probability > 0:
+            X_batch = self.random_flip(X_batch)
+        if self.brightness > 0 or self.contrast > 0 or self.saturation > 0:
+            X_batch = self.color_jitter(X_batch)
+        return (X_batch - mean) / std
+
+
+def grayscale(X_batch: torch.Tensor):
+    """
+    Returns the luminance of a batch of RGB images, shape [batch_size, 1, H, W]
+    """
+    r, g, b = X_batch.unbind(dim=1)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
@@ -0,0 +1,149 @@
+import argparse
+import itertools
+import json
+import os
+import pathlib
+import time
+import torch
+import utils
+from dataloaders import load_cifar10, dataloader_kwargs, DEFAULT_SETTINGS, DEFAULT_SETTINGS_PATH
+from task2 import ExampleModel, Model_task2, Model
+
+MODELS = {
+    "task2": lambda: Model_task2(image_channels=3, num_classes=10),
+    "task3": lambda: ExampleModel(image_channels=3, num_classes=10),
+    "resnet18": Model,
+}
+
+# The input resolution the models are trained at, if not the CIFAR10 32x32
+IMAGE_SIZES = {
+    "resnet18": 224,
+}
+
+
+def measure_images_per_second(create_model, settings: dict,
+                              num_steps: int, num_epochs: int = 2) -> float:
+    """
+    Measures end-to-end training throughput (data loading, forward, backward
+    and SGD step) with the given settings. The iterator over the training set
+    is restarted num_epochs times, so the cost of starting workers is included.
+    """
+    utils.set_seed(0)
+    torch.set_num_threads(settings["num_threads"])
+    dataloader_train, _, _ = load_cifar10(settings["batch_size"], **dataloader_kwargs(settings))
+    model = utils.to_cuda(create_model())
+    optimizer = torch.optim.SGD(model.parameters(), 1e-3)
+    loss_criterion = torch.nn.CrossEntropyLoss()
+
+    def train_step(X_batch, Y_batch):
+        loss = loss_criterion(model(utils.to_cuda(X_batch)), utils.to_cuda(Y_batch))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    # Warm-up step, not timed
+    train_step(*next(iter(dataloader_train)))
+
+    num_images = 0
+    start = time.time()
+    for _ in range(num_epochs):
+        for step, (X_batch, Y_batch) in enumerate(dataloader_train):
+            if step >= num_steps:
+                break
+            train_step(X_batch, Y_batch)
+            num_images += X_batch.shape[0]
+    return num_images / (time.time() - start)
+
+
+def candidate_values(args) -> dict:
+    """
+    Returns the values to probe for every setting, in the order they are tuned
+    """
+    num_cpus = os.cpu_count()
+    return dict(
+        num_threads=sorted({1, max(1, num_cpus // 2), num_cpus}),
+        batch_size=args.batch_sizes,
+        in_memory=[False, True],
+        num_workers=sorted({0, 1, 2, max(1, num_cpus // 2), num_cpus}),
+        persistent_workers=[False, True],
+        prefetch_factor=[2, 4],
+    )
+
+
+def canonical_settings(settings: dict) -> dict:
+    """
+    Resets the worker options that have no effect, so equivalent settings are only probed once
+    """
+    settings = dict(settings)
+    if settings["in_memory"]:
+        settings["num_workers"] = 0
+    if settings["num_workers"] == 0:
+        settings["persistent_workers"] = False
+        settings["prefetch_factor"] = DEFAULT_SETTINGS["prefetch_factor"]
+    return settings
+
+
+def autotune(create_model, args) -> dict:
+    """
+    Searches for the settings with the highest training throughput.
+    By default one setting is tuned at a time while the others are kept at the
+    best values found so far; with args.exhaustive every combination is tried.
+    The images are loaded at args.image_size, which is kept in the settings so
+    that load_cifar10(..., **dataloader_kwargs(settings)) uses the same resolution.
+    """
+    candidates = candidate_values(args)
+    defaults = dict(DEFAULT_SETTINGS, image_size=args.image_size)
+    results = {}
+
+    def probe(settings):
+        settings = canonical_settings(settings)
+        key = json.dumps(settings, sort_keys=True)
+        if key not in results:
+            results[key] = measure_images_per_second(create_model, settings, args.steps)
+            print(f"{results[key]:10.1f} images/sec \t {settings}")
+        return results[key]
+
+    if args.exhaustive:
+        names = list(candidates.keys())
+        for values in itertools.product(*candidates.values()):
+            probe(dict(defaults, **dict(zip(names, values))))
+    else:
+        best = canonical_settings(defaults)
+        best_images_per_second = probe(best)
+        for name, values in candidates.items():
+            for value in values:
+                settings = canonical_settings(dict(best, **{name: value}))
+                images_per_second = probe(settings)
+                if images_per_second > best_images_per_second:
+                    best, best_images_per_second = settings, images_per_second
+
+    best_key = max(results, key=results.get)
+    return dict(json.loads(best_key), images_per_second=results[best_key])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Finds the data loading / batch size settings with the highest training throughput on this host")
+    parser.add_argument("--model", choices=list(MODELS.keys()), default="task3")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--steps", type=int, default=20,
+                        help="number of timed train steps per epoch and setting")
+    parser.add_argument("--exhaustive", action="store_true",
+                        help="try every combination instead of tuning one setting at a time")
+    parser.add_argument("--image-size", type=int, default=None,
+                        help="resolution to load the images at (see load_cifar10), "
+                             "224 for resnet18 and 32x32 for the other models if not set")
+    parser.add_argument("--output", type=pathlib.Path, default=DEFAULT_SETTINGS_PATH)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.image_size is None:
+        args.image_size = IMAGE_SIZES.get(args.model)
+    best = autotune(MODELS[args.model], args)
+    best["model"] = args.model
+    with open(args.output, "w") as fp:
+        json.dump(best, fp, indent=4)
+    print(f"Best settings ({best['images_per_second']:.1f} images/sec) written to: {args.output}")
+    print(json.dumps(best, indent=4))
@@ -0,0 +1,177 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import pathlib
+import resource
+import sys
+import numpy as np
+import torch
+import torch.multiprocessing
+import utils
+from autotune import MODELS
+from inference_optimization import measure_latency
+
+# Input resolution each model is deployed at
+IMAGE_SIZES = {
+    "task2": 32,
+    "task3": 32,
+    "resnet18": 224,
+}
+
+VARIANTS = ["eager", "bf16", "compiled"]
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of this process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def load_model(name: str, checkpoint_dir: pathlib.Path = None) -> torch.nn.Module:
+    model = MODELS[name]()
+    if checkpoint_dir is not None:
+        state_dict = utils.load_best_checkpoint(checkpoint_dir)
+        assert state_dict is not None, f"Did not find best.ckpt under: {checkpoint_dir}"
+        model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def prepare_variant(model: torch.nn.Module, variant: str):
+    """
+    Returns a callable running model as the given variant:
+    eager fp32, bfloat16 autocast or torch.compile
+    """
+    if variant == "eager":
+        return model
+    if variant == "bf16":
+        def forward(X_batch):
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                return model(X_batch)
+        return forward
+    if variant == "compiled":
+        return torch.compile(model)
+    raise ValueError(f"Unknown variant: {variant}")
+
+
+def benchmark_model(name: str, variant: str, checkpoint_dir: pathlib.Path,
+                    num_threads: list, batch_sizes: list,
+                    num_iterations: int, num_throughput_iterations: int) -> list:
+    """
+    Measures the batch size 1 latency percentiles and the throughput at
+    every batch size, for every thread count. Runs in its own process
+    (see run_isolated), so the peak RSS belongs to this model and variant only.
+    Returns:
+        list of result dicts, one per thread count
+    """
+    model = load_model(name, checkpoint_dir)
+    forward = prepare_variant(model, variant)
+    image_shape = (3, IMAGE_SIZES[name], IMAGE_SIZES[name])
+    results = []
+    for threads in num_threads:
+        torch.set_num_threads(threads)
+        latencies_ms = measure_latency(forward, 1, num_iterations, image_shape=image_shape) * 1000
+        result = dict(
+            model=name, variant=variant, num_threads=threads,
+            p50_ms=float(np.percentile(latencies_ms, 50)),
+            p95_ms=float(np.percentile(latencies_ms, 95)),
+            p99_ms=float(np.percentile(latencies_ms, 99)),
+            images_per_second={},
+        )
+        for batch_size in batch_sizes:
+            latencies = measure_latency(forward, batch_size, num_throughput_iterations,
+                                        num_warmup=2, image_shape=image_shape)
+            result["images_per_second"][batch_size] = batch_size / float(np.median(latencies))
+        result["peak_rss_mb"] = peak_rss_mb()
+        print(format_row(result, batch_sizes))
+        results.append(result)
+    return results
+
+
+def run_isolated(*args) -> list:
+    """
+    Runs benchmark_model in a fresh process. Failures (e.g. torch.compile not
+    working on this host) are reported instead of aborting the whole benchmark.
+    """
+    context = torch.multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        try:
+            return executor.submit(benchmark_model, *args).result()
+        except Exception as error:
+            name, variant = args[:2]
+            print(f"{name} ({variant}) failed: {error}")
+            return [dict(model=name, variant=variant, error=str(error))]
+
+
+def format_row(result: dict, batch_sizes: list) -> str:
+    if "error" in result:
+        return f"| {result['model']} | {result['variant']} | - | failed: {result['error']} |"
+    throughputs = " | ".join(f"{result['images_per_second'][batch_size]:.0f}"
+                             for batch_size in batch_sizes)
+    return (f"| {result['model']} | {result['variant']} | {result['num_threads']} "
+            f"| {result['p50_ms']:.2f} | {result['p95_ms']:.2f} | {result['p99_ms']:.2f} "
+            f"| {throughputs} | {result['peak_rss_mb']:.0f} |")
+
+
+def markdown_table(results: list, batch_sizes: list) -> str:
+    header = ["Model", "Variant", "Threads", "p50 (ms)", "p95 (ms)", "p99 (ms)"]
+    header += [f"Images/sec (bs {batch_size})" for batch_size in batch_sizes]
+    header += ["Peak RSS (MB)"]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    lines += [format_row(result, batch_sizes) for result in results]
+    return "\n".join(lines)
+
+
+def parse_checkpoints(values: list) -> dict:
+    """
+    Parses ["task3=checkpoints/task3", ...] into {"task3": Path("checkpoints/task3"), ...}
+    """
+    checkpoints = {}
+    for value in values:
+        name, directory = value.split("=", 1)
+        assert name in MODELS, f"Unknown model {name}, expected one of {list(MODELS.keys())}"
+        checkpoints[name] = pathlib.Path(directory)
+    return checkpoints
+
+
+def get_parser():
+    num_cpus = os.cpu_count()
+    parser = argparse.ArgumentParser(
+        description="Measures CPU inference latency and throughput of the CIFAR10 models")
+    parser.add_argument("--models", choices=list(MODELS.keys()), nargs="+",
+                        default=list(MODELS.keys()))
+    parser.add_argument("--variants", choices=VARIANTS, nargs="+", default=VARIANTS)
+    parser.add_argument("--checkpoint", action="append", default=[], metavar="MODEL=DIR",
+                        help="load MODEL from DIR/best.ckpt, e.g. task3=checkpoints/task3 "
+                             "(randomly initialized weights otherwise)")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=sorted({1, max(1, num_cpus // 2), num_cpus}))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 256],
+                        help="batch sizes to measure the throughput at")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="number of timed batch size 1 forward passes")
+    parser.add_argument("--throughput-iterations", type=int, default=10)
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("benchmark.json"))
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    checkpoints = parse_checkpoints(args.checkpoint)
+    print(markdown_table([], args.batch_sizes))
+    results = []
+    for name in args.models:
+        for variant in args.variants:
+            results += run_isolated(name, variant, checkpoints.get(name), args.threads,
+                                    args.batch_sizes, args.iterations, args.throughput_iterations)
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=4)
+    table = markdown_table(results, args.batch_sizes)
+    with open(args.output.with_suffix(".md"), "w") as fp:
+        fp.write(table + "\n")
+    print(f"Results written to: {args.output} and {args.output.with_suffix('.md')}")
+    print(table)
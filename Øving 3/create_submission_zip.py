@@ -25,7 +25,16 @@ files_to_include = {
     "task4b": [".py"],
     "trainer": [".py"],
     "utils": [".py"],
-    "dataloaders": [".py"]
+    "dataloaders": [".py"],
+    "augmentation": [".py"],
+    "feature_cache": [".py"],
+    "evaluator": [".py"],
+    "mixed_precision_comparison": [".py"],
+    "inference_optimization": [".py"],
+    "autotune": [".py"],
+    "activations": [".py"],
+    "distillation": [".py"],
+    "benchmark": [".py"]
 }
 zipfile_path = "assignment_code.zip"
 print("-"*80)
@@ -1,8 +1,14 @@
 from torchvision import transforms, datasets
 from torch.utils.data.sampler import SubsetRandomSampler
+import copy
 import torch
+import torch.nn.functional as F
 import typing
+import pathlib
+import time
+import json
 import numpy as np
+import utils
 np.random.seed(0)
 
 #Task 2/3 mean/std
@@ -12,21 +18,191 @@ std = (.25, .25, .25)
 #Task 4 mean/std
 #mean = (0.485, 0.456, 0.406)
 #std = (0.229, 0.224, 0.225)
+#(or pass these to load_cifar10 as mean=imagenet_mean, std=imagenet_std)
+imagenet_mean = (0.485, 0.456, 0.406)
+imagenet_std = (0.229, 0.224, 0.225)
 
 
-def load_cifar10(batch_size: int, validation_fraction: float = 0.1
+class TensorDataLoader:
+
+    def __init__(self,
+                 images: torch.Tensor,
+                 labels: torch.Tensor,
+                 indices: typing.Sequence[int],
+                 batch_size: int,
+                 shuffle: bool,
+                 drop_last: bool = False,
+                 mean: typing.Sequence[float] = mean,
+                 std: typing.Sequence[float] = std):
+        """
+            Iterates over batches of an in-memory uint8 image tensor.
+            Conversion to float and normalization is done as one
+            vectorized op per batch, so no worker processes are needed.
+            Args:
+                images: uint8 tensor or (memory-mapped) np.ndarray of shape [N, 3, H, W]
+                labels: int64 tensor of shape [N]
+                indices: the sample indices this loader iterates over
+                mean, std: the normalization of the images
+        """
+        self.images = images
+        self.labels = labels
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        # (x / 255 - mean) / std == x * scale - shift
+        std_tensor = torch.tensor(std).view(1, -1, 1, 1)
+        self.scale = 1 / (255 * std_tensor)
+        self.shift = torch.tensor(mean).view(1, -1, 1, 1) / std_tensor
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def normalize(self, X_batch: torch.Tensor):
+        return X_batch.float().mul_(self.scale).sub_(self.shift)
+
+    def batches_with_indices(self):
+        """
+        Yields (sample indices, images, labels) for every batch
+        """
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices))]
+        for i in range(len(self)):
+            batch_indices = indices[i*self.batch_size:(i+1)*self.batch_size]
+            if isinstance(self.images, np.ndarray):
+                batch_indices, X_batch = read_rows(self.images, batch_indices)
+            else:
+                X_batch = self.images[batch_indices]
+            yield batch_indices, self.normalize(X_batch), self.labels[batch_indices]
+
+    def __iter__(self):
+        for _, X_batch, Y_batch in self.batches_with_indices():
+            yield X_batch, Y_batch
+
+
+def read_rows(array: np.ndarray, indices: torch.Tensor) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the sorted indices and the rows of a memory-mapped array at them.
+    Sorting keeps the reads from the memory map sequential.
+    """
+    indices = indices.sort().values
+    return indices, torch.from_numpy(array[indices.numpy()])
+
+
+def load_cifar10_uint8(train: bool, root: str = "data/cifar10"
+                       ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Decodes CIFAR10 once into a single uint8 tensor of shape [N, 3, 32, 32].
+    The result is cached on disk, so later runs only read one file.
+    Returns:
+        [images, labels]
+    """
+    split = "train" if train else "test"
+    cache_path = pathlib.Path(root, f"cifar10_{split}_uint8.pt")
+    if cache_path.is_file():
+        cache = torch.load(cache_path)
+        return cache["images"], cache["labels"]
+    dataset = datasets.CIFAR10(root, train=train, download=True)
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    labels = torch.tensor(dataset.targets, dtype=torch.long)
+    with utils.atomic_path(cache_path) as tmp_path:
+        torch.save(dict(images=images, labels=labels), tmp_path)
+    return images, labels
+
+
+def load_cifar10_resized(train: bool, image_size: int, root: str = "data/cifar10",
+                         chunk_size: int = 1000) -> typing.Tuple[np.ndarray, torch.Tensor]:
+    """
+    Returns CIFAR10 resized to image_size x image_size, as a memory-mapped uint8
+    array of shape [N, 3, image_size, image_size].
+    The images are resized once (bilinear, like transforms.Resize) in chunks
+    and cached on disk, so training never resizes per sample.
+    Returns:
+        [images, labels]
+    """
+    images, labels = load_cifar10_uint8(train, root)
+    split = "train" if train else "test"
+    cache_path = pathlib.Path(root, f"cifar10_{split}_uint8_{image_size}.npy")
+    if not cache_path.is_file():
+        print(f"Building {image_size}x{image_size} cache of the {split} split in: {cache_path}")
+        with utils.atomic_path(cache_path) as tmp_path:
+            resized = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.uint8,
+                shape=(len(images), images.shape[1], image_size, image_size))
+            for start in range(0, len(images), chunk_size):
+                # Resizing stays in uint8 (antialias has no effect when upsampling,
+                # but selects the fast uint8 kernel) and channels_last is its fastest layout
+                chunk = images[start:start + chunk_size].contiguous(memory_format=torch.channels_last)
+                chunk = F.interpolate(chunk, size=image_size, mode="bilinear",
+                                      align_corners=False, antialias=True)
+                resized[start:start + len(chunk)] = chunk.numpy()
+            resized.flush()
+            del resized
+    return np.load(cache_path, mmap_mode="r"), labels
+
+
+def split_indices(num_samples: int, validation_fraction: float):
+    indices = list(range(num_samples))
+    split_idx = int(np.floor(validation_fraction * num_samples))
+
+    val_indices = np.random.choice(indices, size=split_idx, replace=False)
+    train_indices = list(set(indices) - set(val_indices))
+    return train_indices, val_indices
+
+
+def load_cifar10(batch_size: int, validation_fraction: float = 0.1,
+                 in_memory: bool = False,
+                 num_workers: int = 2,
+                 persistent_workers: bool = False,
+                 prefetch_factor: int = 2,
+                 image_size: int = None,
+                 mean: typing.Sequence[float] = mean,
+                 std: typing.Sequence[float] = std
                  ) -> typing.List[torch.utils.data.DataLoader]:
+    """
+    Returns train, validation and test loaders for CIFAR10.
+    If in_memory is set, the dataset is kept as one uint8 tensor and
+    normalized per batch (see TensorDataLoader) instead of going through
+    the per-sample PIL transforms in worker processes.
+    If image_size is set, the images are resized to image_size x image_size
+    (e.g. 224 for ResNet18). With in_memory, they are read from a pre-resized
+    memory-mapped cache (see load_cifar10_resized).
+    mean, std: the normalization, e.g. imagenet_mean/imagenet_std for the pretrained ResNet18
+    num_workers, persistent_workers and prefetch_factor are passed on to the
+    torch DataLoaders (see load_settings for the ones autotune.py picked for the current host).
+    """
+    if in_memory:
+        if image_size is None:
+            images_train, labels_train = load_cifar10_uint8(train=True)
+            images_test, labels_test = load_cifar10_uint8(train=False)
+        else:
+            images_train, labels_train = load_cifar10_resized(train=True, image_size=image_size)
+            images_test, labels_test = load_cifar10_resized(train=False, image_size=image_size)
+        train_indices, val_indices = split_indices(len(labels_train), validation_fraction)
+        dataloader_train = TensorDataLoader(images_train, labels_train, train_indices,
+                                            batch_size, shuffle=True, drop_last=True,
+                                            mean=mean, std=std)
+        dataloader_val = TensorDataLoader(images_train, labels_train, val_indices,
+                                          batch_size, shuffle=True, mean=mean, std=std)
+        dataloader_test = TensorDataLoader(images_test, labels_test, range(len(labels_test)),
+                                           batch_size, shuffle=False, mean=mean, std=std)
+        return dataloader_train, dataloader_val, dataloader_test
+
     # Note that transform train will apply the same transform for
     # validation!
+    resize = [transforms.Resize(image_size)] if image_size is not None else []
     transform_train = transforms.Compose([
         transforms.ToTensor(),
         transforms.Normalize(mean, std),
-        #transforms.Resize(224)
+        *resize
     ])
     transform_test = transforms.Compose([
         transforms.ToTensor(),
         transforms.Normalize(mean, std),
-        #transforms.Resize(224)
+        *resize
     ])
     data_train = datasets.CIFAR10('data/cifar10',
                                   train=True,
@@ -38,29 +214,112 @@ def load_cifar10(batch_size: int, validation_fraction: float = 0.1
                                  download=True,
                                  transform=transform_test)
 
-    indices = list(range(len(data_train)))
-    split_idx = int(np.floor(validation_fraction * len(data_train)))
-
-    val_indices = np.random.choice(indices, size=split_idx, replace=False)
-    train_indices = list(set(indices) - set(val_indices))
+    train_indices, val_indices = split_indices(len(data_train), validation_fraction)
 
     train_sampler = SubsetRandomSampler(train_indices)
     validation_sampler = SubsetRandomSampler(val_indices)
 
+    worker_kwargs = dict(num_workers=num_workers)
+    if num_workers > 0:
+        worker_kwargs.update(persistent_workers=persistent_workers,
+                             prefetch_factor=prefetch_factor)
+
     dataloader_train = torch.utils.data.DataLoader(data_train,
                                                    sampler=train_sampler,
                                                    batch_size=batch_size,
-                                                   num_workers=2,
-                                                   drop_last=True)
+                                                   drop_last=True,
+                                                   **worker_kwargs)
 
     dataloader_val = torch.utils.data.DataLoader(data_train,
                                                  sampler=validation_sampler,
                                                  batch_size=batch_size,
-                                                 num_workers=2)
+                                                 **worker_kwargs)
 
     dataloader_test = torch.utils.data.DataLoader(data_test,
                                                   batch_size=batch_size,
                                                   shuffle=False,
-                                                  num_workers=2)
+                                                  **worker_kwargs)
 
     return dataloader_train, dataloader_val, dataloader_test
+
+
+DEFAULT_SETTINGS_PATH = pathlib.Path("autotune.json")
+
+# The data loading settings tuned by "python autotune.py" for this host (see load_settings).
+# These are the defaults of load_cifar10 and Trainer, used when no tuned settings exist
+DEFAULT_SETTINGS = dict(
+    batch_size=64,
+    num_threads=torch.get_num_threads(),
+    in_memory=False,
+    num_workers=2,
+    persistent_workers=False,
+    prefetch_factor=2,
+    image_size=None,
+)
+
+
+def load_settings(path: pathlib.Path = DEFAULT_SETTINGS_PATH) -> dict:
+    """
+    Returns the settings written by autotune, or the defaults if path does not exist.
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    if path.is_file():
+        with open(path) as fp:
+            settings.update(json.load(fp))
+    return settings
+
+
+def dataloader_kwargs(settings: dict) -> dict:
+    """
+    Returns the keyword arguments of load_cifar10 contained in settings, i.e:
+        load_cifar10(settings["batch_size"], **dataloader_kwargs(settings))
+    """
+    keys = ["in_memory", "num_workers", "persistent_workers", "prefetch_factor", "image_size"]
+    return {key: settings[key] for key in keys}
+
+
+def resize_dataloaders(dataloaders: typing.List[TensorDataLoader],
+                       image_size: typing.Optional[int],
+                       batch_size: int) -> typing.List[TensorDataLoader]:
+    """
+    Returns copies of the in-memory train, validation and test loaders
+    (see load_cifar10) with the given batch size, reading image_size x image_size
+    images from the resized cache (32 is the original dataset).
+    If image_size is None, the images are kept and only the batch size changes.
+    The train/validation split is kept.
+    """
+    assert all(isinstance(dataloader, TensorDataLoader) for dataloader in dataloaders),\
+        "Only in-memory dataloaders can be resized, use load_cifar10(..., in_memory=True)"
+    dataloaders = [copy.copy(dataloader) for dataloader in dataloaders]
+    if image_size is not None:
+        load = load_cifar10_uint8 if image_size == 32 else\
+            lambda train: load_cifar10_resized(train, image_size)
+        images_train, _ = load(train=True)
+        images_test, _ = load(train=False)
+        for dataloader, images in zip(dataloaders, [images_train, images_train, images_test]):
+            dataloader.images = images
+    for dataloader in dataloaders:
+        dataloader.batch_size = batch_size
+    return dataloaders
+
+
+def measure_images_per_second(dataloader, num_batches: int = None) -> float:
+    """
+    Iterates over (at most num_batches of) dataloader and returns
+    the number of images loaded per second.
+    """
+    num_images = 0
+    start = time.time()
+    for i, (X_batch, _) in enumerate(dataloader):
+        num_images += X_batch.shape[0]
+        if num_batches is not None and i + 1 >= num_batches:
+            break
+    return num_images / (time.time() - start)
+
+
+if __name__ == "__main__":
+    # Compares the loading throughput of the two dataset modes
+    for in_memory in [False, True]:
+        dataloader_train, _, _ = load_cifar10(64, in_memory=in_memory)
+        images_per_second = measure_images_per_second(dataloader_train)
+        print(f"in_memory={in_memory}: {images_per_second:.0f} images/sec")
@@ -0,0 +1,123 @@
+import copy
+import torch
+import pathlib
+import json
+import numpy as np
+import utils
+from torch import nn
+import torch.nn.functional as F
+from dataloaders import TensorDataLoader
+
+
+class DistillationLoss(nn.Module):
+
+    def __init__(self, temperature: float = 4., alpha: float = 0.5):
+        """
+            Combined loss for knowledge distillation:
+            (1 - alpha) * CE(student, labels) + alpha * T^2 * KL(teacher || student),
+            where the KL term compares the softmax of the logits divided by the temperature T.
+            If the targets are only labels (e.g. during validation), this is plain
+            cross entropy, so validation losses stay comparable to normal training.
+        """
+        super().__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def forward(self, predictions, targets):
+        """
+        Args:
+            targets: labels, or [labels, teacher_logits] (see DistillationDataLoader)
+        """
+        if not isinstance(targets, (tuple, list)):
+            return F.cross_entropy(predictions, targets)
+        labels, teacher_logits = targets
+        cross_entropy = F.cross_entropy(predictions, labels)
+        kl_divergence = F.kl_div(
+            F.log_softmax(predictions / self.temperature, dim=1),
+            F.log_softmax(teacher_logits.to(predictions.dtype) / self.temperature, dim=1),
+            reduction="batchmean", log_target=True)
+        return (1 - self.alpha) * cross_entropy + self.alpha * self.temperature**2 * kl_divergence
+
+
+class DistillationDataLoader:
+
+    def __init__(self, dataloader: TensorDataLoader, teacher_logits: np.ndarray):
+        """
+            Wraps an in-memory train dataloader, so every batch comes with the
+            cached teacher logits of its samples: (images, [labels, teacher_logits]).
+            Args:
+                teacher_logits: (memory-mapped) fp16 array of shape [num_samples, num_classes],
+                    where row i holds the logits of sample i of the dataset
+        """
+        assert not np.isnan(teacher_logits[dataloader.indices.numpy()]).any(),\
+            "The teacher logits are missing for some of the training samples"
+        self.dataloader = dataloader
+        self.teacher_logits = teacher_logits
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch_indices, X_batch, Y_batch in self.dataloader.batches_with_indices():
+            teacher_logits = torch.from_numpy(self.teacher_logits[batch_indices.numpy()]).float()
+            yield X_batch, (Y_batch, teacher_logits)
+
+
+def build_teacher_logits(teacher: nn.Module,
+                         dataloader: TensorDataLoader,
+                         filepath: pathlib.Path):
+    """
+    Runs the teacher once over the dataloader and stores its logits as fp16
+    in filepath, one row per sample index of the dataset. Rows of samples the
+    dataloader does not cover are NaN.
+    """
+    filepath.parent.mkdir(exist_ok=True, parents=True)
+    logits = None
+    teacher.eval()
+    with utils.atomic_path(filepath) as tmp_filepath, torch.inference_mode():
+        for batch_indices, X_batch, _ in dataloader.batches_with_indices():
+            batch_logits = teacher(utils.to_cuda(X_batch)).half().cpu().numpy()
+            if logits is None:
+                logits = np.lib.format.open_memmap(
+                    tmp_filepath, mode="w+", dtype=np.float16,
+                    shape=(len(dataloader.images), batch_logits.shape[1]))
+                logits[:] = np.nan
+            logits[batch_indices.numpy()] = batch_logits
+        logits.flush()
+        del logits
+
+
+def load_teacher_logits(teacher: nn.Module,
+                        teacher_dataloader: TensorDataLoader,
+                        dataloader_train: TensorDataLoader,
+                        filepath: pathlib.Path = pathlib.Path("distillation_cache/teacher_logits.npy")
+                        ) -> DistillationDataLoader:
+    """
+    Builds (on first use) and loads the teacher logits cache, and returns
+    dataloader_train wrapped in a DistillationDataLoader.
+    teacher_dataloader is an in-memory loader over the same dataset as
+    dataloader_train, at the input resolution of the teacher (e.g. the task 4
+    train loader). The teacher runs over all of its samples, not only its split.
+    The logits are of the un-augmented images. The cache is keyed on a hash
+    of the teacher weights and on the image size and normalization of
+    teacher_dataloader (stored next to it, in filepath with a .json suffix),
+    and rebuilt when either changes, e.g. after loading a new checkpoint.
+    """
+    normalization = (teacher_dataloader.scale.flatten().tolist(),
+                     teacher_dataloader.shift.flatten().tolist())
+    metadata = dict(teacher_hash=utils.state_dict_hash(teacher),
+                    normalization=repr(normalization),
+                    image_size=list(teacher_dataloader.images.shape[1:]),
+                    num_samples=len(teacher_dataloader.images))
+    metadata_path = filepath.with_suffix(".json")
+    if not filepath.is_file() or not metadata_path.is_file()\
+            or json.loads(metadata_path.read_text()) != metadata:
+        print(f"Building teacher logits cache in: {filepath}")
+        all_samples = copy.copy(teacher_dataloader)
+        all_samples.indices = torch.arange(len(teacher_dataloader.images))
+        all_samples.shuffle = False
+        all_samples.drop_last = False
+        build_teacher_logits(utils.to_cuda(teacher), all_samples, filepath)
+        utils.atomic_write(json.dumps(metadata, indent=4).encode(), metadata_path)
+    teacher_logits = np.load(filepath, mmap_mode="r")
+    return DistillationDataLoader(dataloader_train, teacher_logits)
@@ -0,0 +1,149 @@
+import copy
+import typing
+import concurrent.futures
+import torch
+import torch.multiprocessing
+import utils
+
+
+def rebatch(dataloader, batch_size: int):
+    """
+    Returns a copy of dataloader that iterates over the same samples
+    with the given batch size and without dropping the last batch.
+    """
+    if hasattr(dataloader, "teacher_logits"):
+        # distillation.DistillationDataLoader, evaluate on the wrapped labelled samples
+        dataloader = dataloader.dataloader
+    if isinstance(dataloader, torch.utils.data.DataLoader):
+        worker_kwargs = dict(num_workers=dataloader.num_workers)
+        if dataloader.num_workers > 0:
+            worker_kwargs.update(persistent_workers=dataloader.persistent_workers,
+                                 prefetch_factor=dataloader.prefetch_factor)
+        return torch.utils.data.DataLoader(dataloader.dataset,
+                                           sampler=dataloader.sampler,
+                                           batch_size=batch_size,
+                                           **worker_kwargs)
+    dataloader = copy.copy(dataloader)
+    dataloader.batch_size = batch_size
+    dataloader.drop_last = False
+    return dataloader
+
+
+def evaluate(dataloader,
+             model: torch.nn.Module,
+             loss_criterion: torch.nn.modules.loss._Loss,
+             top_k: int = 5) -> dict:
+    """
+    Computes loss, top-1/top-k accuracy and the confusion matrix in a single
+    pass over dataloader. Everything is accumulated on the device of the model,
+    and copied to the host once at the end.
+    Args:
+        loss_criterion: a criterion with mean reduction, e.g: torch.nn.CrossEntropyLoss()
+    Returns:
+        dict with keys loss, accuracy, top{k}_accuracy (floats) and
+        confusion_matrix (np.array of shape [num_classes, num_classes],
+        rows are true labels and columns predictions)
+    """
+    return evaluate_models(dataloader, [model], loss_criterion, top_k)[0]
+
+
+def evaluate_models(dataloader,
+                    models: typing.List[torch.nn.Module],
+                    loss_criterion: typing.Union[torch.nn.modules.loss._Loss,
+                                                 typing.List[torch.nn.modules.loss._Loss]],
+                    top_k: int = 5) -> typing.List[dict]:
+    """
+    Evaluates several models (see evaluate) in one shared pass over dataloader,
+    so every batch is only loaded once.
+    Args:
+        loss_criterion: one criterion for all models, or a list with one per model
+    Returns:
+        list of metric dicts, one per model
+    Raises:
+        ValueError if dataloader yields no batches or models is empty
+    """
+    if not isinstance(loss_criterion, (list, tuple)):
+        loss_criterion = [loss_criterion] * len(models)
+    assert len(loss_criterion) == len(models),\
+        f"Expected one loss criterion per model, got {len(loss_criterion)} for {len(models)} models"
+    loss_sums = [0] * len(models)
+    top_k_corrects = [0] * len(models)
+    confusions = [None] * len(models)
+    with torch.inference_mode():
+        for X_batch, Y_batch in dataloader:
+            X_batch = utils.to_cuda(X_batch)
+            Y_batch = utils.to_cuda(Y_batch)
+            for i, model in enumerate(models):
+                output_probs = model(X_batch)
+                num_classes = output_probs.shape[1]
+                if confusions[i] is None:
+                    confusions[i] = torch.zeros(num_classes**2, dtype=torch.long,
+                                                device=output_probs.device)
+
+                # The criterion averages over the batch, so weigh it by the batch size
+                loss_sums[i] = loss_sums[i] + loss_criterion[i](output_probs, Y_batch) * len(Y_batch)
+                pred = torch.argmax(output_probs, dim=1)
+                confusions[i] += torch.bincount(Y_batch * num_classes + pred,
+                                                minlength=num_classes**2)
+                top_k_pred = output_probs.topk(min(top_k, num_classes), dim=1).indices
+                top_k_corrects[i] = top_k_corrects[i] + (top_k_pred == Y_batch[:, None]).sum()
+
+        if not models or confusions[0] is None:
+            raise ValueError("Cannot evaluate on an empty dataloader or without models")
+        # Single host sync for all metrics of all models
+        values = torch.cat([
+            torch.cat([confusion.double(), torch.stack([loss_sum.double(), top_k_correct.double()])])
+            for confusion, loss_sum, top_k_correct in zip(confusions, loss_sums, top_k_corrects)
+        ]).cpu()
+
+    metrics = []
+    offset = 0
+    for confusion in confusions:
+        num_classes = int(round(len(confusion)**0.5))
+        model_values = values[offset:offset + len(confusion) + 2]
+        offset += len(confusion) + 2
+        confusion_matrix = model_values[:-2].view(num_classes, num_classes).long().numpy()
+        num_pictures = confusion_matrix.sum().item()
+        metrics.append({
+            "loss": model_values[-2].item() / num_pictures,
+            "accuracy": confusion_matrix.trace().item() / num_pictures,
+            f"top{top_k}_accuracy": model_values[-1].item() / num_pictures,
+            "confusion_matrix": confusion_matrix,
+        })
+    return metrics
+
+
+def _evaluate_in_process(args):
+    model, dataloader, loss_criterion, top_k, num_threads = args
+    torch.set_num_threads(num_threads)
+    return evaluate(dataloader, model, loss_criterion, top_k)
+
+
+def evaluate_many(dataloaders: typing.List[torch.utils.data.DataLoader],
+                  model: torch.nn.Module,
+                  loss_criterion: torch.nn.modules.loss._Loss,
+                  batch_size: int = None,
+                  top_k: int = 5,
+                  num_processes: int = 1) -> typing.List[dict]:
+    """
+    Evaluates several dataloaders (see evaluate), optionally in parallel
+    worker processes that split the available CPU threads between them.
+    Args:
+        batch_size: evaluation batch size, keeps the dataloader batch size if None
+        num_processes: number of worker processes. Only used on CPU.
+    Returns:
+        list of metric dicts, one per dataloader
+    """
+    if batch_size is not None:
+        dataloaders = [rebatch(dataloader, batch_size) for dataloader in dataloaders]
+    num_processes = min(num_processes, len(dataloaders))
+    if num_processes <= 1 or torch.cuda.is_available():
+        return [evaluate(dataloader, model, loss_criterion, top_k)
+                for dataloader in dataloaders]
+
+    num_threads = max(1, torch.get_num_threads() // num_processes)
+    context = torch.multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(num_processes, mp_context=context) as executor:
+        jobs = [(model, dataloader, loss_criterion, top_k, num_threads)
+                for dataloader in dataloaders]
+        return list(executor.map(_evaluate_in_process, jobs))
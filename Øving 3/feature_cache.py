@@ -0,0 +1,200 @@
+import torch
+import typing
+import pathlib
+import json
+import numpy as np
+import utils
+import evaluator
+from dataloaders import read_rows
+from torch import nn
+
+
+def frozen_prefix(model: nn.Module) -> nn.Sequential:
+    """
+    Returns the frozen part of the ResNet18 transfer model (task2.Model),
+    conv1 up to and including layer3.
+    """
+    resnet = model.model
+    return nn.Sequential(
+        resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool,
+        resnet.layer1, resnet.layer2, resnet.layer3
+    )
+
+
+class CachedFeatureModel(nn.Module):
+
+    def __init__(self, model: nn.Module):
+        """
+            Runs only the trainable part of task2.Model (layer4 + fc) on cached
+            layer3 activations. The wrapped resnet is stored under the same
+            attribute name as in task2.Model, so the state_dict (and thereby the
+            checkpoints) can be loaded straight back into the full model.
+        """
+        super().__init__()
+        self.model = model.model
+
+    def forward(self, x):
+        """
+        Args:
+            x: layer3 activations, shape: [batch_size, 256, H/16, W/16]
+        """
+        x = self.model.layer4(x)
+        x = self.model.avgpool(x)
+        x = torch.flatten(x, 1)
+        return self.model.fc(x)
+
+
+class FeatureCacheDataLoader:
+
+    def __init__(self,
+                 features: np.ndarray,
+                 labels: np.ndarray,
+                 batch_size: int,
+                 shuffle: bool,
+                 drop_last: bool = False):
+        """
+            Iterates over batches of a (memory-mapped) fp16 feature cache.
+            Features are returned as fp32 tensors.
+        """
+        self.features = features
+        self.labels = torch.from_numpy(np.asarray(labels))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.labels) // self.batch_size
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.labels))
+        else:
+            indices = torch.arange(len(self.labels))
+        for i in range(len(self)):
+            batch_indices, X_batch = read_rows(
+                self.features, indices[i*self.batch_size:(i+1)*self.batch_size])
+            yield X_batch.float(), self.labels[batch_indices]
+
+
+def build_feature_cache(prefix: nn.Module,
+                        dataloader: torch.utils.data.DataLoader,
+                        directory: pathlib.Path):
+    """
+    Runs the frozen prefix once over the dataloader and stores the activations
+    as fp16 in directory/features.npy, with the labels in directory/labels.npy.
+    """
+    directory.mkdir(exist_ok=True, parents=True)
+    num_samples = count_samples(dataloader)
+    features = None
+    labels = np.zeros(num_samples, dtype=np.int64)
+    prefix.eval()
+    offset = 0
+    features_path = directory.joinpath("features.npy")
+    with utils.atomic_path(features_path) as tmp_features_path, torch.inference_mode():
+        for X_batch, Y_batch in dataloader:
+            activations = prefix(utils.to_cuda(X_batch)).half().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    tmp_features_path, mode="w+", dtype=np.float16,
+                    shape=(num_samples, *activations.shape[1:]))
+            features[offset:offset + len(activations)] = activations
+            labels[offset:offset + len(activations)] = Y_batch.numpy()
+            offset += len(activations)
+        features.flush()
+        del features
+    with utils.atomic_path(directory.joinpath("labels.npy")) as tmp_labels_path:
+        np.save(tmp_labels_path, labels)
+
+
+def count_samples(dataloader) -> int:
+    """
+    Returns the number of samples one pass over the dataloader yields.
+    Works for both torch DataLoaders and dataloaders.TensorDataLoader.
+    """
+    if dataloader.drop_last:
+        return len(dataloader) * dataloader.batch_size
+    if isinstance(dataloader, torch.utils.data.DataLoader):
+        return len(dataloader.sampler)
+    return len(dataloader.indices)
+
+
+def cache_metadata(prefix: nn.Module, dataloader) -> dict:
+    """
+    Describes what a feature cache is built from: a hash of the frozen prefix
+    weights, the dataloader transform, the input image size and the number of samples.
+    """
+    if isinstance(dataloader, torch.utils.data.DataLoader):
+        transform = repr(getattr(dataloader.dataset, "transform", None))
+    else:
+        # dataloaders.TensorDataLoader, which normalizes every batch itself
+        transform = repr((dataloader.scale.flatten().tolist(), dataloader.shift.flatten().tolist()))
+    X_batch, _ = next(iter(dataloader))
+    return dict(prefix_hash=utils.state_dict_hash(prefix), transform=transform,
+                image_size=list(X_batch.shape[1:]), num_samples=count_samples(dataloader))
+
+
+def load_feature_cache(model: nn.Module,
+                       dataloaders: typing.List[torch.utils.data.DataLoader],
+                       batch_size: int,
+                       cache_dir: pathlib.Path = pathlib.Path("feature_cache")):
+    """
+    Builds (on first use) and loads the layer3 feature cache for the
+    train/val/test dataloaders. Every split is cached with all its samples,
+    and rebuilt when the frozen weights, transform or image size no longer
+    match its metadata.json (see cache_metadata).
+    Note that the frozen layers run in eval mode, so their BatchNorm
+    statistics are frozen as well.
+    Returns:
+        [CachedFeatureModel, [train, val, test] FeatureCacheDataLoader]
+    """
+    prefix = utils.to_cuda(frozen_prefix(model))
+    cached_dataloaders = []
+    for split, dataloader in zip(["train", "val", "test"], dataloaders):
+        directory = cache_dir.joinpath(split)
+        # The training loader drops its last batch, the cache keeps every sample
+        dataloader = evaluator.rebatch(dataloader, dataloader.batch_size)
+        metadata = cache_metadata(prefix, dataloader)
+        metadata_path = directory.joinpath("metadata.json")
+        if not directory.joinpath("features.npy").is_file() or not metadata_path.is_file()\
+                or json.loads(metadata_path.read_text()) != metadata:
+            print(f"Building feature cache for {split} split in: {directory}")
+            build_feature_cache(prefix, dataloader, directory)
+            utils.atomic_write(json.dumps(metadata, indent=4).encode(), metadata_path)
+        features = np.load(directory.joinpath("features.npy"), mmap_mode="r")
+        labels = np.load(directory.joinpath("labels.npy"))
+        cached_dataloaders.append(FeatureCacheDataLoader(
+            features, labels, batch_size,
+            shuffle=split != "test", drop_last=split == "train"))
+    return CachedFeatureModel(model), cached_dataloaders
+
+
+def check_feature_cache(model: nn.Module,
+                        dataloader: torch.utils.data.DataLoader,
+                        cached_dataloader: FeatureCacheDataLoader,
+                        num_batches: int = 10,
+                        tolerance: float = 1e-2):
+    """
+    Checks that the cached forward pass matches the live forward pass of the
+    full model. Both loaders must iterate in the same order without
+    augmentation, e.g. the test loaders.
+    Returns:
+        the largest absolute difference between the two outputs
+    """
+    cached_model = CachedFeatureModel(model)
+    model.eval()
+    max_difference = 0
+    with torch.inference_mode():
+        batches = zip(dataloader, cached_dataloader)
+        for i, ((X_batch, Y_batch), (features, Y_cached)) in enumerate(batches):
+            if i >= num_batches:
+                break
+            assert torch.equal(Y_batch, Y_cached), "Cached labels are in a different order"
+            live = model(utils.to_cuda(X_batch))
+            cached = cached_model(utils.to_cuda(features))
+            max_difference = max(max_difference, (live - cached).abs().max().item())
+    model.train()
+    assert max_difference <= tolerance,\
+        f"Cached and live forward differ by {max_difference}, expected at most {tolerance}"
+    return max_difference
@@ -0,0 +1,217 @@
+import copy
+import time
+import typing
+import torch
+import numpy as np
+from torch import nn
+import torch.nn.functional as F
+
+
+NO_OP_LAYERS = (nn.Dropout, nn.Dropout2d, nn.Identity)
+
+
+class ToChannelsLast(nn.Module):
+
+    def forward(self, x):
+        return x.contiguous(memory_format=torch.channels_last)
+
+
+def input_channel_values(conv: nn.Conv2d, values: torch.Tensor) -> torch.Tensor:
+    """
+    Returns per-input-channel values laid out like the conv weights,
+    [out_channels, in_channels / groups, 1, 1]: row o holds the values of
+    the input channels in the group of output channel o.
+    """
+    out_channels, group_channels = conv.weight.shape[:2]
+    return values.view(conv.groups, 1, group_channels)\
+        .expand(-1, out_channels // conv.groups, -1).reshape(out_channels, group_channels, 1, 1)
+
+
+class BatchNormFoldedConv2d(nn.Module):
+
+    def __init__(self, conv: nn.Conv2d, scale: torch.Tensor, shift: torch.Tensor):
+        """
+            A conv layer with the per-channel affine transform of an eval-mode
+            BatchNorm (scale * x + shift) folded into its input side.
+            The scale goes into the weights. With zero padding, the shift does
+            not reach the border pixels evenly, so its contribution is added as
+            a constant [1, out_channels, H, W] map, computed once per input size.
+            Only the folded weights and the offset kernel are stored: the
+            convolution of the shift image equals the convolution of a single
+            channel ones image with the weights summed over the input channels,
+            each weighted by its shift.
+        """
+        super().__init__()
+        self.conv = copy.deepcopy(conv)
+        self.conv.weight.data = conv.weight.data * input_channel_values(conv, scale)
+        self.conv.bias = None
+        offset_weight = (conv.weight.data * input_channel_values(conv, shift)).sum(1, keepdim=True)
+        self.register_buffer("offset_weight", offset_weight)
+        self.register_buffer("offset_bias", conv.bias.data.clone() if conv.bias is not None else None)
+        self.offsets = {}
+
+    def offset(self, x: torch.Tensor):
+        key = (tuple(x.shape[2:]), x.device, x.dtype)
+        if key not in self.offsets:
+            ones_image = x.new_ones(1, 1, *x.shape[2:])
+            self.offsets[key] = F.conv2d(
+                ones_image, self.offset_weight.to(x.dtype),
+                self.offset_bias.to(x.dtype) if self.offset_bias is not None else None,
+                self.conv.stride, self.conv.padding, self.conv.dilation
+            ).detach()
+        return self.offsets[key]
+
+    def forward(self, x):
+        return self.conv(x) + self.offset(x)
+
+
+def sequential_layers(model: nn.Module) -> typing.List[nn.Module]:
+    """
+    Returns the leaf layers of model in execution order.
+    Supports nn.Sequential (also nested) and models made of a
+    feature_extractor followed by a classifier, like task2.ExampleModel.
+    """
+    if isinstance(model, nn.Sequential):
+        layers = []
+        for child in model:
+            layers.extend(sequential_layers(child))
+        return layers
+    if hasattr(model, "feature_extractor") and hasattr(model, "classifier"):
+        return sequential_layers(model.feature_extractor) + sequential_layers(model.classifier)
+    if len(list(model.children())) == 0:
+        return [model]
+    raise ValueError(f"Can not turn {type(model).__name__} into a sequence of layers")
+
+
+def batch_norm_affine(bn: nn.BatchNorm2d):
+    """
+    Returns the per-channel (scale, shift) of an eval-mode BatchNorm
+    """
+    scale = 1 / torch.sqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    return scale.detach(), shift.detach()
+
+
+def fold_into_previous_conv(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    scale, shift = batch_norm_affine(bn)
+    folded = copy.deepcopy(conv)
+    folded.weight.data = conv.weight.data * scale.view(-1, 1, 1, 1)
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(shift)
+    folded.bias = nn.Parameter(bias * scale + shift)
+    return folded
+
+
+def fold_into_next_layer(bn: nn.BatchNorm2d, layer: nn.Module) -> nn.Module:
+    scale, shift = batch_norm_affine(bn)
+    if isinstance(layer, nn.Linear):
+        # The linear layer sees the flattened [C, H, W] features, channel major
+        repeats = layer.in_features // len(scale)
+        scale = scale.repeat_interleave(repeats)
+        shift = shift.repeat_interleave(repeats)
+        folded = copy.deepcopy(layer)
+        folded.weight.data = layer.weight.data * scale.view(1, -1)
+        bias = layer.bias.data if layer.bias is not None else 0
+        folded.bias = nn.Parameter(bias + layer.weight.data @ shift)
+        return folded
+    if layer.padding == (0, 0) or layer.padding == "valid":
+        folded = copy.deepcopy(layer)
+        folded.weight.data = layer.weight.data * input_channel_values(layer, scale)
+        bias = layer.bias.data if layer.bias is not None else 0
+        folded.bias = nn.Parameter(bias + (layer.weight.data * input_channel_values(layer, shift)).sum(dim=(1, 2, 3)))
+        return folded
+    return BatchNormFoldedConv2d(layer, scale, shift)
+
+
+def fold_batch_norms(layers: typing.List[nn.Module]) -> typing.List[nn.Module]:
+    """
+    Folds every eval-mode BatchNorm2d into the conv layer right before it or,
+    if it follows a non-linearity, into the next conv/linear layer.
+    MaxPool2d and Flatten in between are allowed, as long as the BatchNorm
+    scale is positive (so max pooling commutes with it).
+    BatchNorms that can not be folded are kept.
+    """
+    layers = list(layers)
+    i = 0
+    while i < len(layers):
+        bn = layers[i]
+        if not isinstance(bn, nn.BatchNorm2d):
+            i += 1
+            continue
+        if i > 0 and isinstance(layers[i-1], nn.Conv2d):
+            layers[i-1] = fold_into_previous_conv(layers[i-1], bn)
+            del layers[i]
+            continue
+        j = i + 1
+        while j < len(layers) and isinstance(layers[j], (nn.MaxPool2d, nn.Flatten)):
+            j += 1
+        crosses_max_pool = any(isinstance(layer, nn.MaxPool2d) for layer in layers[i+1:j])
+        scale, _ = batch_norm_affine(bn)
+        foldable = j < len(layers) and (
+            isinstance(layers[j], nn.Linear) or
+            (isinstance(layers[j], nn.Conv2d) and layers[j].padding_mode == "zeros"))
+        if foldable and (not crosses_max_pool or bool((scale > 0).all())):
+            layers[j] = fold_into_next_layer(bn, layers[j])
+            del layers[i]
+            continue
+        i += 1
+    return layers
+
+
+def optimize_for_inference(model: nn.Module,
+                           example_input: torch.Tensor = None,
+                           tolerance: float = 1e-4) -> nn.Module:
+    """
+    Returns an inference-only copy of model: eval-mode BatchNorms are folded
+    into the adjacent conv/linear layers, no-op Dropouts are removed and the
+    model runs in channels_last memory format.
+    The outputs are checked against the original model on example_input
+    (a random CIFAR10-sized batch by default).
+    """
+    model = copy.deepcopy(model).eval()
+    layers = [layer for layer in sequential_layers(model)
+              if not isinstance(layer, NO_OP_LAYERS)]
+    layers = fold_batch_norms(layers)
+    optimized = nn.Sequential(ToChannelsLast(), *layers).eval()
+    optimized = optimized.to(memory_format=torch.channels_last)
+
+    if example_input is None:
+        example_input = torch.randn(8, 3, 32, 32)
+    with torch.no_grad():
+        expected = model(example_input)
+        output = optimized(example_input)
+    max_difference = (expected - output).abs().max().item()
+    assert max_difference <= tolerance,\
+        f"Optimized model differs from the original by {max_difference}, expected at most {tolerance}"
+    return optimized
+
+
+def measure_latency(model: nn.Module, batch_size: int,
+                    num_iterations: int = 50, num_warmup: int = 5,
+                    image_shape=(3, 32, 32)) -> np.ndarray:
+    """
+    Returns the latency (in seconds) of num_iterations forward passes
+    """
+    X_batch = torch.randn(batch_size, *image_shape)
+    latencies = []
+    with torch.inference_mode():
+        for i in range(num_warmup + num_iterations):
+            start = time.perf_counter()
+            model(X_batch)
+            if i >= num_warmup:
+                latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+if __name__ == "__main__":
+    from task2 import ExampleModel
+    model = ExampleModel(image_channels=3, num_classes=10).eval()
+    optimized = optimize_for_inference(model)
+    print("Batch size \t Original (ms) \t Optimized (ms) \t Speedup")
+    for batch_size in [1, 32, 256]:
+        num_iterations = 200 if batch_size == 1 else 20
+        original_ms = np.median(measure_latency(model, batch_size, num_iterations)) * 1000
+        optimized_ms = np.median(measure_latency(optimized, batch_size, num_iterations)) * 1000
+        print(f"{batch_size:10d} \t {original_ms:13.2f} \t {optimized_ms:14.2f} \t {original_ms / optimized_ms:.2f}x")
@@ -0,0 +1,73 @@
+import pathlib
+import time
+import typing
+import torch
+import utils
+from dataloaders import load_cifar10, mean, std, imagenet_mean, imagenet_std
+from trainer import Trainer
+from evaluator import evaluate_many
+from task2 import ExampleModel, Model_task2, Model
+
+
+def train_and_measure(name: str, model, batch_size: int, learning_rate: float,
+                      epochs: int, early_stop_count: int, mixed_precision: bool,
+                      optimizer: typing.Type[torch.optim.Optimizer] = torch.optim.SGD,
+                      normalization: typing.Tuple[tuple, tuple] = (mean, std)):
+    """
+    Trains model on CIFAR10 and returns the end-to-end training throughput
+    (images/sec, including validation and checkpointing) and the test accuracy
+    of the best checkpoint. The accuracy comes from a single seed, so it is a
+    sanity check that the bf16 run still converges, not a measured accuracy difference.
+    Args:
+        optimizer: optimizer class, replaces the SGD optimizer of the Trainer
+        normalization: (mean, std) of the dataloaders
+    """
+    utils.set_seed(0)
+    dataloaders = load_cifar10(batch_size, in_memory=True,
+                               mean=normalization[0], std=normalization[1])
+    trainer = Trainer(
+        batch_size,
+        learning_rate,
+        early_stop_count,
+        epochs,
+        model,
+        dataloaders,
+        mixed_precision=mixed_precision,
+        checkpoint_dir=pathlib.Path("checkpoints", f"{name}_bf16={mixed_precision}")
+    )
+    trainer.optimizer = optimizer(trainer.model.parameters(), learning_rate)
+    start = time.time()
+    trainer.train()
+    images_per_second = trainer.global_step * batch_size / (time.time() - start)
+
+    trainer.load_best_model()
+    trainer.model.eval()
+    test_metrics, = evaluate_many([trainer.dataloader_test], trainer.model,
+                                  trainer.loss_criterion, batch_size=trainer.eval_batch_size)
+    return images_per_second, test_metrics["accuracy"]
+
+
+if __name__ == "__main__":
+    epochs = 10
+    early_stop_count = 4
+    #Model name, model constructor, batch size, learning rate, optimizer and
+    #normalization (as in task2.py, ResNet18 with the task 4 setup at 224x224)
+    configs = [
+        ("task2", lambda: Model_task2(image_channels=3, num_classes=10), 64, 5e-2,
+         torch.optim.SGD, (mean, std)),
+        ("task3", lambda: ExampleModel(image_channels=3, num_classes=10), 64, 5e-2,
+         torch.optim.SGD, (mean, std)),
+        ("resnet18", lambda: Model(image_size=224), 32, 5e-4,
+         torch.optim.Adam, (imagenet_mean, imagenet_std)),
+    ]
+    results = []
+    for name, create_model, batch_size, learning_rate, optimizer, normalization in configs:
+        for mixed_precision in [False, True]:
+            images_per_second, test_acc = train_and_measure(
+                name, create_model(), batch_size, learning_rate, epochs, early_stop_count,
+                mixed_precision, optimizer, normalization)
+            results.append((name, mixed_precision, images_per_second, test_acc))
+
+    print("Model    \t bf16 \t Images/sec \t Test Acc")
+    for name, mixed_precision, images_per_second, test_acc in results:
+        print(f"{name:<8} \t {str(mixed_precision):<5} \t {images_per_second:10.1f} \t {test_acc:.3f}")
@@ -1,11 +1,14 @@
 import pathlib
+import typing
 import torch
 import matplotlib.pyplot as plt
 import utils
 from torch import nn
+import torch.nn.functional as F
 import torchvision
 from dataloaders import load_cifar10
 from trainer import Trainer, compute_loss_and_accuracy
+from evaluator import evaluate_many
 
 #The final task 3 model
 class ExampleModel(nn.Module):
@@ -84,27 +87,34 @@ class ExampleModel(nn.Module):
         return out
 
 #function to print out loss and accuracy for the best performing model of a trainer
-def print_best_model(trainer: Trainer):
+def print_best_model(trainer: Trainer, num_processes: int = 1):
 
     trainer.load_best_model()
 
     trainer.model.eval()
-    train_loss, train_acc = compute_loss_and_accuracy(
-        trainer.dataloader_train, trainer.model, trainer.loss_criterion)
-    val_loss, val_acc = compute_loss_and_accuracy(
-        trainer.dataloader_val, trainer.model, trainer.loss_criterion)
-    test_loss, test_acc = compute_loss_and_accuracy(
-        trainer.dataloader_test, trainer.model, trainer.loss_criterion)
+    #All three splits are evaluated with the eval batch size, optionally in parallel processes
+    train_metrics, val_metrics, test_metrics = evaluate_many(
+        [trainer.dataloader_train, trainer.dataloader_val, trainer.dataloader_test],
+        trainer.model, trainer.loss_criterion,
+        batch_size=trainer.eval_batch_size, num_processes=num_processes)
     
     print("Best model values:")
-    print(f"Train:\t Loss: {train_loss:.3f} \t Acc: {train_acc:.3f}")
-    print(f"Val  :\t Loss: {val_loss:.3f} \t Acc: {val_acc:.3f}")
-    print(f"Test :\t Loss: {test_loss:.3f} \t Acc: {test_acc:.3f}")
+    for name, metrics in zip(["Train", "Val  ", "Test "], [train_metrics, val_metrics, test_metrics]):
+        print(f"{name}:\t Loss: {metrics['loss']:.3f} \t Acc: {metrics['accuracy']:.3f} \t Top-5 Acc: {metrics['top5_accuracy']:.3f}")
+    print("Test confusion matrix (rows: true class, columns: predicted class):")
+    print(test_metrics["confusion_matrix"])
 
 #Model for ResNet18 network
 class Model(nn.Module):
-    def __init__(self):
+    def __init__(self, image_size: int = None):
+        """
+            Args:
+                image_size: if set, input batches are upsampled to
+                    image_size x image_size inside the model (see dataloaders.load_cifar10
+                    for the alternative of a pre-resized dataset cache)
+        """
         super().__init__()
+        self.image_size = image_size
         self.model = torchvision.models.resnet18(pretrained=True)
         self.model.fc = nn.Linear(512, 10)
         # No need to apply softmax,
@@ -117,6 +127,10 @@ class Model(nn.Module):
             param.requires_grad = True
         
     def forward(self, x):
+        if self.image_size is not None and x.shape[-1] != self.image_size:
+            # Bilinear upsampling is about twice as fast in channels_last on CPU
+            x = x.contiguous(memory_format=torch.channels_last)
+            x = F.interpolate(x, size=self.image_size, mode="bilinear", align_corners=False)
         x = self.model(x)
         return x
 
@@ -192,6 +206,22 @@ def create_plots(trainer: Trainer, name: str):
     plt.savefig(plot_path.joinpath(f"{name}_plot.png"))
     plt.show()
 
+#Function to plot validation accuracy against wall-clock training time
+def create_time_to_accuracy_plot(trainers: typing.Dict[str, Trainer], name: str):
+    plot_path = pathlib.Path("plots")
+    plot_path.mkdir(exist_ok=True)
+    plt.figure(figsize=(10, 8))
+    plt.title("Time to accuracy")
+    for label, trainer in trainers.items():
+        times = list(trainer.validation_history["time"].values())
+        accuracies = list(trainer.validation_history["accuracy"].values())
+        plt.plot([t / 60 for t in times], accuracies, label=label)
+    plt.xlabel("Training time (minutes)")
+    plt.ylabel("Validation accuracy")
+    plt.legend()
+    plt.savefig(plot_path.joinpath(f"{name}_time_to_accuracy.png"))
+    plt.show()
+
 if __name__ == "__main__":
     # Set the random generator seed (parameters, shuffling etc).
     # You can try to change this and check if you still get the same result! 
@@ -203,6 +233,12 @@ if __name__ == "__main__":
     learning_rate = 5e-2
     early_stop_count = 4
     dataloaders = load_cifar10(batch_size)
+    #To use the settings found by "python autotune.py" for this host instead:
+    #from dataloaders import load_settings, dataloader_kwargs
+    #settings = load_settings()
+    #batch_size = settings["batch_size"]
+    #dataloaders = load_cifar10(batch_size, **dataloader_kwargs(settings))
+    #and pass num_threads=settings["num_threads"] to the Trainer
     model3 = ExampleModel(image_channels=3, num_classes=10)
     model2 = Model_task2(image_channels=3, num_classes=10)
 
@@ -213,7 +249,8 @@ if __name__ == "__main__":
         early_stop_count,
         epochs,
         model2,
-        dataloaders
+        dataloaders,
+        checkpoint_dir=pathlib.Path("checkpoints/task2")
     )
     #task2_trainer.train()
     #print_best_model(task2_trainer)
@@ -225,11 +262,17 @@ if __name__ == "__main__":
         early_stop_count,
         epochs,
         model3,
-        dataloaders
+        dataloaders,
+        checkpoint_dir=pathlib.Path("checkpoints/task3")
     )
     #task3_trainer.train()
     #print_best_model(task3_trainer)
 
+    #Or train both models in lockstep, loading every batch only once
+    #from trainer import MultiTrainer
+    #MultiTrainer([task3_trainer, task2_trainer]).train()
+    #create_comp_plots(task3_trainer, task2_trainer, "task3")
+
     #Task 4 parameters (Remember to change optimizer in trainer.py, and mean/std and add resize in dataloaders.py)
     epochs = 5
     batch_size = 32
@@ -237,6 +280,18 @@ if __name__ == "__main__":
     early_stop_count = 4
     dataloaders = load_cifar10(batch_size)
     model4 = Model()
+    #To resize, use load_cifar10(batch_size, image_size=224) (per sample, in the workers),
+    #or read a pre-resized 224x224 memory-mapped cache (~9GB on disk, built on first use,
+    #fastest when it fits in the page cache). The layer3 feature cache, progressive
+    #resizing and distillation below need these in-memory loaders:
+    #from dataloaders import imagenet_mean, imagenet_std
+    #dataloaders = load_cifar10(batch_size, in_memory=True, image_size=224,
+    #                           mean=imagenet_mean, std=imagenet_std)
+    #or keep 32x32 in-memory loaders and let the model upsample every batch:
+    #dataloaders = load_cifar10(batch_size, in_memory=True, mean=imagenet_mean, std=imagenet_std)
+    #model4 = Model(image_size=224)
+    #"python autotune.py --model resnet18" tunes the loaders at 224x224, use its settings as
+    #for Task 2/3 above, and pass mean=imagenet_mean, std=imagenet_std to load_cifar10
 
     task4_trainer = Trainer(
             batch_size,
@@ -248,4 +303,53 @@ if __name__ == "__main__":
         )
     #task4_trainer.train()
     #print_best_model(task4_trainer)
-    
\ No newline at end of file
+
+    #Task 4 trainer that only runs layer4 + fc on cached layer3 activations
+    #from feature_cache import load_feature_cache, check_feature_cache
+    #cached_model, cached_dataloaders = load_feature_cache(model4, dataloaders, batch_size)
+    #check_feature_cache(model4, dataloaders[2], cached_dataloaders[2])
+    #task4_cached_trainer = Trainer(
+    #        batch_size,
+    #        learning_rate,
+    #        early_stop_count,
+    #        epochs,
+    #        cached_model,
+    #        cached_dataloaders
+    #    )
+    #task4_cached_trainer.train()
+    #print_best_model(task4_cached_trainer)
+    
+    #Task 4 trainer with progressive resizing: 112x112 (4x the batch size) for the
+    #first epochs, full 224x224 for the last ones
+    #task4_progressive_trainer = Trainer(
+    #        batch_size,
+    #        learning_rate,
+    #        early_stop_count,
+    #        epochs,
+    #        Model(),
+    #        dataloaders,
+    #        checkpoint_dir=pathlib.Path("checkpoints/task4_progressive"),
+    #        resolution_schedule={0: (112, 4 * batch_size), 3: (224, batch_size)}
+    #    )
+    #task4_progressive_trainer.train()
+    #print_best_model(task4_progressive_trainer)
+    #create_time_to_accuracy_plot({"224": task4_trainer, "112 -> 224": task4_progressive_trainer}, "task4")
+
+    #Task 3 model distilled from the trained ResNet18. The teacher runs once
+    #over the training set, after that only its cached logits are read.
+    #from distillation import DistillationLoss, load_teacher_logits
+    #task4_trainer.load_best_model()
+    #student_dataloaders = list(load_cifar10(64, in_memory=True))
+    #student_dataloaders[0] = load_teacher_logits(task4_trainer.model, dataloaders[0], student_dataloaders[0])
+    #distilled_trainer = Trainer(
+    #        64,
+    #        5e-2,
+    #        4,
+    #        10,
+    #        ExampleModel(image_channels=3, num_classes=10),
+    #        student_dataloaders,
+    #        checkpoint_dir=pathlib.Path("checkpoints/task3_distilled"),
+    #        loss_criterion=DistillationLoss(temperature=4, alpha=0.5)
+    #    )
+    #distilled_trainer.train()
+    #print_best_model(distilled_trainer)
@@ -4,6 +4,7 @@ from PIL import Image
 import torchvision
 import torch
 import numpy as np
+from activations import capture_activations
 image_og = Image.open("images/zebra.jpg")
 print("Image shape:", image_og.size)
 
@@ -22,7 +23,9 @@ image_transform = torchvision.transforms.Compose([
 image = image_transform(image_og)[None]
 print("Image shape:", image.shape)
 
-activation = first_conv_layer(image)
+#Capturing the conv1 (task 4b) and layer4 (task 4c) activations in a single forward pass
+activations = capture_activations(model, ["conv1", "layer4"], image)
+activation = activations["conv1"]
 print("Activation shape:", activation.shape)
 
 
@@ -70,15 +73,8 @@ def plot_4b():
 
 #4c plotting
 def plot_4c():
-    #Passing the image through all but the last two modules
-    img = model.conv1(image)
-    img = model.bn1(img)
-    img = model.relu(img)
-    img = model.maxpool(img)
-    img = model.layer1(img)
-    img = model.layer2(img)
-    img = model.layer3(img)
-    img = model.layer4(img)
+    #Output of the last convolutional layer, i.e. all but the last two modules
+    img = activations["layer4"]
 
     #Plotting activations from the 10 first filters
     plt.figure(figsize=(15,6))
@@ -0,0 +1,336 @@
+import pathlib
+import tempfile
+import torch
+import torch._dynamo
+import torchvision
+import utils
+from torch import nn
+from dataloaders import TensorDataLoader
+from feature_cache import load_feature_cache, CachedFeatureModel
+from distillation import load_teacher_logits
+from activations import capture_activations
+from trainer import Trainer, MultiTrainer
+from evaluator import evaluate, evaluate_many
+from inference_optimization import BatchNormFoldedConv2d, batch_norm_affine
+
+
+class RandomResNet18(nn.Module):
+    """task2.Model with random instead of pretrained weights, so no download is needed."""
+
+    def __init__(self):
+        super().__init__()
+        self.model = torchvision.models.resnet18()
+        self.model.fc = nn.Linear(512, 10)
+
+    def forward(self, x):
+        return self.model(x)
+
+
+def random_tensor_dataloaders(num_samples: int, image_size: int, batch_size: int):
+    """Train/val/test TensorDataLoaders over random uint8 images."""
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randint(0, 256, (num_samples, 3, image_size, image_size),
+                           dtype=torch.uint8, generator=generator)
+    labels = torch.randint(0, 10, (num_samples,), generator=generator)
+    splits = torch.arange(num_samples).chunk(3)
+    return [TensorDataLoader(images, labels, indices, batch_size,
+                             shuffle=split == 0, drop_last=split == 0)
+            for split, indices in enumerate(splits)]
+
+
+def test_feature_cache():
+    print("="*80)
+    print("Running tests for load_feature_cache")
+    utils.set_seed(0)
+    model = RandomResNet18()
+    dataloaders = random_tensor_dataloaders(num_samples=90, image_size=64, batch_size=8)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cached_model, cached_dataloaders = load_feature_cache(
+            model, dataloaders, batch_size=8, cache_dir=pathlib.Path(cache_dir))
+        model.eval()
+        with torch.inference_mode():
+            # The test split is cached in order, with every sample
+            live_batches = list(dataloaders[2])
+            cached_batches = list(cached_dataloaders[2])
+            res = len(cached_batches)
+            ans = len(live_batches)
+            assert res == ans, "Expected {}, got: {}".format(ans, res)
+            for (X_batch, Y_batch), (features, Y_cached) in zip(live_batches, cached_batches):
+                assert torch.equal(Y_batch, Y_cached), "Expected {}, got: {}".format(Y_batch, Y_cached)
+                live = model(X_batch)
+                cached = cached_model(features)
+                # The cache stores the layer3 activations as fp16
+                difference = (live - cached).abs().max().item()
+                tolerance = 1e-2 * live.abs().max().item()
+                assert difference <= tolerance,\
+                    "Expected a difference of at most {}, got: {}".format(tolerance, difference)
+
+            # The training split drops its last batch, the cache keeps every sample
+            res = len(cached_dataloaders[0].labels)
+            ans = len(dataloaders[0].indices)
+            assert res == ans, "Expected {}, got: {}".format(ans, res)
+
+        # The cached head shares its weights and state_dict keys with the full model
+        res = sorted(cached_model.state_dict().keys())
+        ans = sorted(model.state_dict().keys())
+        assert res == ans, "Expected {}, got: {}".format(ans, res)
+        assert isinstance(cached_model, CachedFeatureModel)
+        assert cached_model.model.fc is model.model.fc
+
+
+def test_teacher_logits_cache():
+    print("="*80)
+    print("Running tests for load_teacher_logits")
+    utils.set_seed(0)
+    teacher = nn.Sequential(nn.Flatten(), nn.Linear(3*16*16, 10))
+    dataloader_train = random_tensor_dataloaders(num_samples=30, image_size=16, batch_size=4)[0]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        filepath = pathlib.Path(cache_dir, "teacher_logits.npy")
+        logits = load_teacher_logits(teacher, dataloader_train, dataloader_train, filepath).teacher_logits
+        with torch.inference_mode():
+            ans = teacher(dataloader_train.normalize(dataloader_train.images)).numpy()
+        assert abs(logits - ans).max() < 1e-2, "Expected {}, got: {}".format(ans, logits)
+
+        # A teacher loader with another normalization rebuilds the cache
+        renormalized = TensorDataLoader(dataloader_train.images, dataloader_train.labels,
+                                        dataloader_train.indices, batch_size=4, shuffle=False,
+                                        mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+        logits = load_teacher_logits(teacher, renormalized, dataloader_train, filepath).teacher_logits
+        with torch.inference_mode():
+            ans = teacher(renormalized.normalize(renormalized.images)).numpy()
+        assert abs(logits - ans).max() < 1e-2, "Expected {}, got: {}".format(ans, logits)
+
+
+def test_capture_activations():
+    print("="*80)
+    print("Running tests for capture_activations")
+    utils.set_seed(0)
+    model = RandomResNet18().eval()
+    images = torch.randn(6, 3, 32, 32)
+    # The ReLU of a BasicBlock runs twice per forward pass, the second call is the block output
+    layer_names = ["model.layer1.0.relu", "model.conv1", "model.layer2.1.relu"]
+    modules = dict(model.named_modules())
+    last_outputs = {}
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            last_outputs[name] = output
+        return hook
+
+    # Reference: full forward passes, keeping the output of the last call of every layer
+    handles = [modules[name].register_forward_hook(make_hook(name)) for name in layer_names]
+    batches = []
+    with torch.inference_mode():
+        for start in range(0, len(images), 2):
+            model(images[start:start + 2])
+            batches.append(dict(last_outputs))
+    for handle in handles:
+        handle.remove()
+    ans = {name: torch.cat([batch[name] for batch in batches]) for name in layer_names}
+
+    res = capture_activations(model, layer_names, images, batch_size=2)
+    for name in layer_names:
+        assert torch.equal(res[name], ans[name]), "Expected {}, got: {}".format(ans[name], res[name])
+
+
+def test_profile_steps():
+    print("="*80)
+    print("Running tests for Trainer profile_steps")
+    utils.set_seed(0)
+    dataloaders = random_tensor_dataloaders(num_samples=48, image_size=8, batch_size=4)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+
+        def make_trainer(name, profile_steps):
+            return Trainer(4, 1e-2, 4, 1, nn.Sequential(nn.Flatten(), nn.Linear(3*8*8, 10)),
+                           dataloaders, checkpoint_dir=tmp_dir.joinpath(name),
+                           profile_steps=profile_steps, profile_dir=tmp_dir.joinpath("profiles"))
+
+        # An empty window would never stop the profiler
+        for profile_steps in [(2, 2), (3, 1)]:
+            try:
+                make_trainer("empty", profile_steps)
+            except AssertionError:
+                continue
+            raise AssertionError("Expected an AssertionError for profile_steps={}".format(profile_steps))
+
+        trainer = make_trainer("profiled", (1, 2))
+        try:
+            MultiTrainer([trainer, make_trainer("other", None)])
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("Expected an AssertionError for profiling in lockstep")
+
+        trainer.train()
+        assert trainer.profiler is None, "Expected the profiler to be stopped"
+        assert tmp_dir.joinpath("profiles", "steps_1-2_trace.json").is_file(),\
+            "Expected a trace in {}".format(tmp_dir.joinpath("profiles"))
+
+
+def test_batch_norm_folded_conv():
+    print("="*80)
+    print("Running tests for BatchNormFoldedConv2d")
+    utils.set_seed(0)
+    for groups, stride, bias in [(1, 1, True), (1, 2, False), (2, 1, True), (4, 2, True)]:
+        bn = nn.BatchNorm2d(8).eval()
+        bn.running_mean.normal_()
+        bn.running_var.uniform_(0.5, 2)
+        bn.weight.data.normal_()
+        bn.bias.data.normal_()
+        conv = nn.Conv2d(8, 12, 5, stride=stride, padding=2, groups=groups, bias=bias).eval()
+        folded = BatchNormFoldedConv2d(conv, *batch_norm_affine(bn)).eval()
+        # Only the folded weights and the [out_channels, 1, 5, 5] offset kernel are kept
+        res = sum(tensor.numel() for tensor in folded.state_dict().values())
+        ans = conv.weight.numel() + 12 * 5 * 5 + (12 if bias else 0)
+        assert res == ans, "Expected {}, got: {}".format(ans, res)
+        with torch.no_grad():
+            for image_size in [8, 11]:
+                x = torch.randn(2, 8, image_size, image_size)
+                ans = conv(bn(x))
+                res = folded(x)
+                assert torch.allclose(res, ans, atol=1e-4), "Expected {}, got: {}".format(ans, res)
+
+
+def test_async_checkpoint_writer():
+    print("="*80)
+    print("Running tests for AsyncCheckpointWriter")
+    utils.set_seed(0)
+    dataloaders = random_tensor_dataloaders(num_samples=48, image_size=8, batch_size=4)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        writer = utils.AsyncCheckpointWriter(tmp_dir.joinpath("writer"), max_pending=1)
+        res = writer.queue.maxsize
+        assert res == 1, "Expected {}, got: {}".format(1, res)
+        state_dict = nn.Linear(2, 2).state_dict()
+        writer.save(state_dict, tmp_dir.joinpath("writer", "1.ckpt"), is_best=True)
+        writer.wait()
+        assert utils.load_best_checkpoint(tmp_dir.joinpath("writer")) is not None
+
+        def failing_write(*args):
+            raise OSError("disk full")
+        writer._write = failing_write
+        writer.save(state_dict, tmp_dir.joinpath("writer", "2.ckpt"), is_best=False)
+        writer.wait(raise_error=False)
+        # The failed write is raised by the next save, once
+        try:
+            writer.save(state_dict, tmp_dir.joinpath("writer", "3.ckpt"), is_best=False)
+        except OSError:
+            pass
+        else:
+            raise AssertionError("Expected the failed write to be raised by save")
+        writer.wait(raise_error=False)
+        writer.error = None
+
+        # A failed checkpoint write does not replace the exception that ended training
+        trainer = Trainer(4, 1e-2, 4, 1, nn.Sequential(nn.Flatten(), nn.Linear(3*8*8, 10)),
+                          dataloaders, checkpoint_dir=tmp_dir.joinpath("trainer"))
+        trainer.checkpoint_writer._write = failing_write
+        validate_and_save = trainer.validate_and_save
+
+        def failing_validate_and_save(*args):
+            validate_and_save(*args)
+            raise RuntimeError("training failed")
+        trainer.validate_and_save = failing_validate_and_save
+        try:
+            trainer.train()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Expected the training error to be raised")
+        try:
+            trainer.checkpoint_writer.wait()
+        except OSError:
+            pass
+        else:
+            raise AssertionError("Expected the failed write to be kept for the next wait")
+
+
+def test_evaluate():
+    print("="*80)
+    print("Running tests for evaluate and evaluate_many")
+    utils.set_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(3*8*8, 10)).eval()
+    loss_criterion = nn.CrossEntropyLoss()
+    dataloaders = random_tensor_dataloaders(num_samples=60, image_size=8, batch_size=7)
+
+    # A loader without batches has no metrics
+    empty = TensorDataLoader(dataloaders[2].images, dataloaders[2].labels, [], batch_size=7, shuffle=False)
+    try:
+        evaluate(empty, model, loss_criterion)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected a ValueError for an empty dataloader")
+
+    single_process = evaluate_many(dataloaders, model, loss_criterion, batch_size=16, num_processes=1)
+    for dataloader, metrics in zip(dataloaders, single_process):
+        X, Y = dataloader.images[dataloader.indices], dataloader.labels[dataloader.indices]
+        with torch.no_grad():
+            output = model(dataloader.normalize(X))
+        ans = nn.functional.cross_entropy(output, Y).item()
+        assert abs(metrics["loss"] - ans) < 1e-5, "Expected {}, got: {}".format(ans, metrics["loss"])
+        ans = (output.argmax(dim=1) == Y).float().mean().item()
+        assert abs(metrics["accuracy"] - ans) < 1e-6, "Expected {}, got: {}".format(ans, metrics["accuracy"])
+        ans = (output.topk(5, dim=1).indices == Y[:, None]).any(dim=1).float().mean().item()
+        res = metrics["top5_accuracy"]
+        assert abs(res - ans) < 1e-6, "Expected {}, got: {}".format(ans, res)
+        ans = torch.zeros(10, 10, dtype=torch.long)
+        ans.index_put_((Y, output.argmax(dim=1)), torch.ones_like(Y), accumulate=True)
+        res = metrics["confusion_matrix"]
+        assert (res == ans.numpy()).all(), "Expected {}, got: {}".format(ans, res)
+
+    # Worker processes give the same metrics
+    multi_process = evaluate_many(dataloaders, model, loss_criterion, batch_size=16, num_processes=3)
+    for ans, res in zip(single_process, multi_process):
+        assert res.keys() == ans.keys(), "Expected {}, got: {}".format(ans.keys(), res.keys())
+        for key in ["loss", "accuracy", "top5_accuracy"]:
+            assert abs(res[key] - ans[key]) < 1e-6, "Expected {}, got: {}".format(ans[key], res[key])
+        assert (res["confusion_matrix"] == ans["confusion_matrix"]).all(),\
+            "Expected {}, got: {}".format(ans["confusion_matrix"], res["confusion_matrix"])
+
+
+def test_compile_fallback():
+    print("="*80)
+    print("Running tests for the Trainer eager mode fallback")
+    utils.set_seed(0)
+    dataloaders = random_tensor_dataloaders(num_samples=48, image_size=8, batch_size=4)
+    X_batch, Y_batch = next(iter(dataloaders[0]))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trainer = Trainer(4, 1e-2, 4, 1, nn.Sequential(nn.Flatten(), nn.Linear(3*8*8, 10)),
+                          dataloaders, checkpoint_dir=pathlib.Path(tmp_dir), compile=True)
+
+        def failing_step(error):
+            def step(X_batch, Y_batch):
+                raise error
+            return step
+
+        # Errors of the model or data are raised, and compilation stays enabled
+        trainer.forward_backward_step = failing_step(ValueError("bad batch"))
+        try:
+            trainer.train_step(X_batch, Y_batch)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected the model error to be raised")
+        assert trainer.compiled, "Expected compilation to stay enabled"
+
+        # Compilation errors fall back to the eager model
+        trainer.forward_backward_step = failing_step(torch._dynamo.exc.TorchDynamoException("compile failed"))
+        loss = trainer.train_step(X_batch, Y_batch)
+        assert not trainer.compiled, "Expected the fallback to eager mode"
+        assert trainer.forward_model is trainer.model
+        assert loss > 0, "Expected a positive loss, got: {}".format(loss)
+
+
+if __name__ == "__main__":
+    test_feature_cache()
+    test_teacher_logits_cache()
+    test_capture_activations()
+    test_profile_steps()
+    test_batch_norm_folded_conv()
+    test_async_checkpoint_writer()
+    test_evaluate()
+    test_compile_fallback()
+    print("="*80)
+    print("All tests OK.")
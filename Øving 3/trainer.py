@@ -1,9 +1,12 @@
 
 import torch
+import torch._dynamo
 import typing
 import time
 import collections
 import utils
+import evaluator
+from dataloaders import resize_dataloaders
 import pathlib
 import numpy as np
 
@@ -22,36 +25,8 @@ def compute_loss_and_accuracy(
     Returns:
         [average_loss, accuracy]: both scalar.
     """
-    average_loss = 0
-    accuracy = 0
-    correct = 0
-    loss = 0
-    num_pictures = 0
-    # TODO: Implement this function (Task  2a)
-    with torch.no_grad():
-        for (X_batch, Y_batch) in dataloader:
-            # Transfer images/labels to GPU VRAM, if possible
-            X_batch = utils.to_cuda(X_batch)
-            Y_batch = utils.to_cuda(Y_batch)
-            # Forward pass the images through our model
-            output_probs = model(X_batch)
-
-            #Getting predictions from network output
-            pred = torch.argmax(output_probs, dim =1)
-
-            #Adding up total loss and correct predictions
-            correct += torch.sum(Y_batch == pred)
-            loss += loss_criterion(output_probs, Y_batch)
-
-            #Counting total number of pictures to calculate accuracy
-            num_pictures += len(Y_batch)
-
-        #Final loss and accuracy calculations
-        accuracy = correct/num_pictures
-        average_loss = loss/len(dataloader)
-
-    #.detach().cpu().item() to be able to locally plot loss and accuracy from GPU
-    return average_loss.detach().cpu().item(), accuracy.detach().cpu().item()
+    metrics = evaluator.evaluate(dataloader, model, loss_criterion)
+    return metrics["loss"], metrics["accuracy"]
 
 
 class Trainer:
@@ -62,22 +37,64 @@ class Trainer:
                  early_stop_count: int,
                  epochs: int,
                  model: torch.nn.Module,
-                 dataloaders: typing.List[torch.utils.data.DataLoader]):
+                 dataloaders: typing.List[torch.utils.data.DataLoader],
+                 augmentation: typing.Callable = None,
+                 eval_batch_size: int = None,
+                 mixed_precision: bool = False,
+                 checkpoint_dir: pathlib.Path = pathlib.Path("checkpoints"),
+                 compile: bool = False,
+                 compile_train_step: bool = False,
+                 num_threads: int = None,
+                 profile_steps: typing.Tuple[int, int] = None,
+                 profile_dir: pathlib.Path = pathlib.Path("profiles"),
+                 resolution_schedule: typing.Dict[int, typing.Tuple[int, int]] = None,
+                 loss_criterion: torch.nn.Module = None):
         """
             Initialize our trainer class.
+            augmentation is an optional callable applied to every training batch
+            before the forward pass, e.g. augmentation.BatchAugmentation.
+            eval_batch_size is the batch size used for validation,
+            4 times the training batch size if not set.
+            mixed_precision runs the forward pass and loss in bfloat16 autocast,
+            while the weights and the optimizer update stay in fp32.
+            compile compiles the model with torch.compile, and compile_train_step
+            compiles the whole forward + loss + backward step. If compilation
+            fails with a torch._dynamo error, training falls back to eager mode.
+            num_threads sets the number of CPU threads used by torch
+            (see autotune.py), the torch default is kept if not set.
+            profile_steps is an optional (first, last) global step window that is
+            profiled with torch.profiler: steps first up to, but not including, last.
+            A Chrome trace and a table of the top ops are written to profile_dir.
+            resolution_schedule maps epochs to (image_size, batch_size), e.g.
+            {0: (112, 128), 3: (224, 32)} trains at 112x112 from epoch 0 and at
+            224x224 from epoch 3 (see set_resolution). Needs in-memory dataloaders.
+            loss_criterion replaces the default cross entropy loss, e.g.
+            distillation.DistillationLoss.
         """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
         self.batch_size = batch_size
         self.learning_rate = learning_rate
         self.early_stop_count = early_stop_count
         self.epochs = epochs
+        self.augmentation = augmentation
+        self.mixed_precision = mixed_precision
+        self.autocast_device = "cuda" if torch.cuda.is_available() else "cpu"
 
         # Since we are doing multi-class classification, we use CrossEntropyLoss
-        self.loss_criterion = torch.nn.CrossEntropyLoss()
+        self.loss_criterion = loss_criterion if loss_criterion is not None else torch.nn.CrossEntropyLoss()
         # Initialize the model
         self.model = model
         # Transfer model to GPU VRAM, if possible.
         self.model = utils.to_cuda(self.model)
         print(self.model)
+        # The compiled module shares parameters with self.model, so checkpoints
+        # are still saved and loaded through self.model in the usual format
+        self.compiled = compile or compile_train_step
+        self.forward_model = torch.compile(self.model) if compile else self.model
+        self.forward_backward_step = self.forward_backward
+        if compile_train_step:
+            self.forward_backward_step = torch.compile(self.forward_backward)
 
         # Define our optimizer. SGD = Stochastich Gradient Descent
         self.optimizer = torch.optim.SGD(self.model.parameters(), self.learning_rate)   #Optimizer for task2/3
@@ -85,11 +102,16 @@ class Trainer:
 
         # Load our dataset
         self.dataloader_train, self.dataloader_val, self.dataloader_test = dataloaders
+        # No gradients are stored during evaluation, so it can use larger batches
+        self.eval_batch_size = eval_batch_size if eval_batch_size is not None else 4 * batch_size
+        self.eval_dataloader_val = evaluator.rebatch(self.dataloader_val, self.eval_batch_size)
 
         # Validate our model everytime we pass through 50% of the dataset
         self.num_steps_per_val = len(self.dataloader_train) // 2
         self.global_step = 0
         self.start_time = time.time()
+        # Duration of the first train step, which includes any compilation
+        self.warmup_time = None
 
         # Tracking variables
         self.train_history = dict(
@@ -99,25 +121,66 @@ class Trainer:
         )
         self.validation_history = dict(
             loss=collections.OrderedDict(),
-            accuracy=collections.OrderedDict()
+            accuracy=collections.OrderedDict(),
+            # Wall-clock seconds since the start of training, for time-to-accuracy curves
+            time=collections.OrderedDict()
         )
-        self.checkpoint_dir = pathlib.Path("checkpoints")
+        self.checkpoint_dir = checkpoint_dir
+        # Checkpoints are written on a background thread, so training never waits for the disk
+        self.checkpoint_writer = utils.AsyncCheckpointWriter(self.checkpoint_dir)
+
+        if profile_steps is not None:
+            first_step, last_step = profile_steps
+            assert 0 <= first_step < last_step,\
+                f"profile_steps must be a (first, last) window with first < last, got: {profile_steps}"
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.resolution_schedule = resolution_schedule
+
+    def set_resolution(self, image_size: int, batch_size: int):
+        """
+            Switches training to image_size x image_size images and the given
+            batch size. A model that upsamples its input (task2.Model with
+            image_size set) gets the new size, otherwise the dataloaders switch
+            to the matching resized cache. The learning rate is scaled linearly
+            with the batch size, relative to the batch size the trainer was created with.
+        """
+        print(f"Training at {image_size}x{image_size} with batch size {batch_size}")
+        if getattr(self.model, "image_size", None) is not None:
+            self.model.image_size = image_size
+            image_size = None
+        self.dataloader_train, self.dataloader_val, self.dataloader_test = resize_dataloaders(
+            [self.dataloader_train, self.dataloader_val, self.dataloader_test],
+            image_size, batch_size)
+        eval_batch_size = self.eval_batch_size * batch_size // self.batch_size
+        self.eval_dataloader_val = evaluator.rebatch(self.dataloader_val, eval_batch_size)
+        self.num_steps_per_val = len(self.dataloader_train) // 2
+        for group in self.optimizer.param_groups:
+            group["lr"] = self.learning_rate * batch_size / self.batch_size
 
-    def validation_step(self):
+    def validation_step(self, metrics: dict = None):
         """
-            Computes the loss/accuracy for all three datasets.
-            Train, validation and test.
+            Computes the loss/accuracy on the validation set.
+            metrics can be given if they are already computed (see MultiTrainer).
         """
         self.model.eval()
-        validation_loss, validation_acc = compute_loss_and_accuracy(
-            self.dataloader_val, self.model, self.loss_criterion
-        )
+        if metrics is None:
+            with torch.profiler.record_function("validation"):
+                metrics = evaluator.evaluate(
+                    self.eval_dataloader_val, self.model, self.loss_criterion
+                )
+        validation_loss, validation_acc = metrics["loss"], metrics["accuracy"]
         self.validation_history["loss"][self.global_step] = validation_loss
         self.validation_history["accuracy"][self.global_step] = validation_acc
-        used_time = time.time() - self.start_time
+        elapsed_time = time.time() - self.start_time
+        self.validation_history["time"][self.global_step] = elapsed_time
+        # The warm-up step is left out, so this is the steady-state throughput
+        used_time = elapsed_time - self.warmup_time
         print(
             f"Epoch: {self.epoch:>1}",
-            f"Batches per seconds: {self.global_step / used_time:.2f}",
+            f"Time: {elapsed_time:.0f}s",
+            f"Batches per seconds: {(self.global_step - 1) / used_time:.2f}",
             f"Global step: {self.global_step:>6}",
             f"Validation Loss: {validation_loss:.2f}",
             f"Validation Accuracy: {validation_acc:.3f}",
@@ -157,41 +220,153 @@ class Trainer:
         # Transfer images / labels to GPU VRAM, if possible
         X_batch = utils.to_cuda(X_batch)
         Y_batch = utils.to_cuda(Y_batch)
+        if self.augmentation is not None:
+            X_batch = self.augmentation(X_batch)
 
-        # Perform the forward pass
-        predictions = self.model(X_batch)
-        # Compute the cross entropy loss for the batch
-        loss = self.loss_criterion(predictions, Y_batch)
-        # Backpropagation
-        loss.backward()
-        # Gradient descent step
-        self.optimizer.step()
-        # Reset all computed gradients to 0
-        self.optimizer.zero_grad()
+        try:
+            loss = self.forward_backward_step(X_batch, Y_batch)
+        except torch._dynamo.exc.TorchDynamoException as error:
+            # Only compilation errors (including BackendCompilerFailed) fall back,
+            # errors of the model or data itself are raised as in eager mode
+            if not self.compiled:
+                raise
+            print(f"Compilation failed, falling back to eager mode: {error}")
+            self.compiled = False
+            self.optimizer.zero_grad()
+            self.forward_model = self.model
+            self.forward_backward_step = self.forward_backward
+            loss = self.forward_backward_step(X_batch, Y_batch)
+        with torch.profiler.record_function("optimizer_step"):
+            # Gradient descent step
+            self.optimizer.step()
+            # Reset all computed gradients to 0
+            self.optimizer.zero_grad()
 
         return loss.detach().cpu().item()
 
+    def forward_backward(self, X_batch, Y_batch):
+        """
+        Forward pass, loss and backpropagation for one batch.
+        Returns the loss tensor.
+        """
+        with torch.profiler.record_function("forward"), \
+                torch.autocast(self.autocast_device, dtype=torch.bfloat16,
+                               enabled=self.mixed_precision):
+            # Perform the forward pass
+            predictions = self.forward_model(X_batch)
+            # Compute the cross entropy loss for the batch
+            loss = self.loss_criterion(predictions, Y_batch)
+        with torch.profiler.record_function("backward"):
+            # Backpropagation
+            loss.backward()
+        return loss
+
     def train(self):
         """
         Trains the model for [self.epochs] epochs.
         """
-        def should_validate_model():
-            return self.global_step % self.num_steps_per_val == 0
+        self.start_time = time.time()
+        completed = False
+        try:
+            self._train_epochs()
+            completed = True
+        finally:
+            # Export the profile if training ended inside the profiling window
+            self.stop_profiler()
+            # Make sure all checkpoints are on disk before returning. If training
+            # failed, a failed checkpoint write must not replace its exception.
+            self.checkpoint_writer.wait(raise_error=completed)
 
+    def start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities)
+        self.profiler.start()
+
+    def stop_profiler(self):
+        """
+        Stops the profiler (if running) and writes the Chrome trace
+        and the top ops table to self.profile_dir
+        """
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        self.profile_dir.mkdir(exist_ok=True, parents=True)
+        first_step, last_step = self.profile_steps
+        name = f"steps_{first_step}-{last_step}"
+        trace_path = self.profile_dir.joinpath(f"{name}_trace.json")
+        self.profiler.export_chrome_trace(str(trace_path))
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        table = self.profiler.key_averages().table(sort_by=sort_by, row_limit=30)
+        with open(self.profile_dir.joinpath(f"{name}_top_ops.txt"), "w") as fp:
+            fp.write(table)
+        print(f"Profile of steps {first_step}-{last_step} saved to: {self.profile_dir}")
+        self.profiler = None
+
+    def time_to_accuracy(self, accuracy: float) -> typing.Optional[float]:
+        """
+        Returns the wall-clock seconds until the validation accuracy first
+        reached accuracy, or None if it never did.
+        """
+        for step, validation_acc in self.validation_history["accuracy"].items():
+            if validation_acc >= accuracy:
+                return self.validation_history["time"][step]
+        return None
+
+    def should_validate_model(self):
+        return self.global_step % self.num_steps_per_val == 0
+
+    def train_batch(self, X_batch, Y_batch):
+        """
+        Performs one train step and records its loss.
+        """
+        if self.warmup_time is None:
+            warmup_start = time.time()
+            loss = self.train_step(X_batch, Y_batch)
+            self.warmup_time = time.time() - warmup_start
+            print(f"Warm-up time (first train step): {self.warmup_time:.2f}s")
+        else:
+            loss = self.train_step(X_batch, Y_batch)
+        self.train_history["loss"][self.global_step] = loss
+        self.global_step += 1
+
+    def validate_and_save(self, metrics: dict = None):
+        """
+        Validates and checkpoints the model.
+        Returns True if training should stop early.
+        """
+        self.validation_step(metrics)
+        self.save_model()
+        if self.should_early_stop():
+            print("Early stopping.")
+            return True
+        return False
+
+    def _train_epochs(self):
         for epoch in range(self.epochs):
             self.epoch = epoch
+            if self.resolution_schedule is not None and epoch in self.resolution_schedule:
+                self.set_resolution(*self.resolution_schedule[epoch])
             # Perform a full pass through all the training samples
-            for X_batch, Y_batch in self.dataloader_train:
-                loss = self.train_step(X_batch, Y_batch)
-                self.train_history["loss"][self.global_step] = loss
-                self.global_step += 1
+            batches = iter(self.dataloader_train)
+            while True:
+                # The check also runs on the iteration that ends an epoch, so only start once
+                if self.profile_steps is not None and self.global_step == self.profile_steps[0]\
+                        and self.profiler is None:
+                    self.start_profiler()
+                # Time spent waiting for the dataloader
+                with torch.profiler.record_function("data_wait"):
+                    X_batch, Y_batch = next(batches, (None, None))
+                if X_batch is None:
+                    break
+                self.train_batch(X_batch, Y_batch)
                 # Compute loss/accuracy for validation set
-                if should_validate_model():
-                    self.validation_step()
-                    self.save_model()
-                    if self.should_early_stop():
-                        print("Early stopping.")
+                if self.should_validate_model():
+                    if self.validate_and_save():
                         return
+                if self.profile_steps is not None and self.global_step == self.profile_steps[1]:
+                    self.stop_profiler()
 
     def save_model(self):
         def is_best_model():
@@ -202,15 +377,98 @@ class Trainer:
             validation_losses = list(val_loss.values())
             return validation_losses[-1] == min(validation_losses)
 
-        state_dict = self.model.state_dict()
-        filepath = self.checkpoint_dir.joinpath(f"{self.global_step}.ckpt")
+        with torch.profiler.record_function("checkpoint"):
+            state_dict = self.model.state_dict()
+            filepath = self.checkpoint_dir.joinpath(f"{self.global_step}.ckpt")
 
-        utils.save_checkpoint(state_dict, filepath, is_best_model())
+            self.checkpoint_writer.save(state_dict, filepath, is_best_model())
 
     def load_best_model(self):
+        self.checkpoint_writer.wait()
         state_dict = utils.load_best_checkpoint(self.checkpoint_dir)
         if state_dict is None:
             print(
                 f"Could not load best checkpoint. Did not find under: {self.checkpoint_dir}")
             return
         self.model.load_state_dict(state_dict)
+
+
+class MultiTrainer:
+
+    def __init__(self, trainers: typing.List[Trainer]):
+        """
+            Trains several models in lockstep from one shared data stream.
+            Every training batch is loaded once and fed to all trainers, and
+            the models are validated together in one pass over the validation
+            set. Each trainer keeps its own early stopping, checkpoints and
+            history, and is validated with its own loss criterion. The trainers
+            must share their dataloaders and batch size, and use different
+            checkpoint directories.
+            The models run one after another on every batch, so the elapsed time
+            and batches per second of each trainer include the compute of all
+            the other models.
+        """
+        self.trainers = trainers
+        first = trainers[0]
+        for trainer in trainers:
+            assert trainer.dataloader_train is first.dataloader_train and\
+                trainer.dataloader_val is first.dataloader_val,\
+                "All trainers must use the same dataloaders"
+            assert trainer.batch_size == first.batch_size,\
+                "All trainers must use the same batch size"
+            assert trainer.resolution_schedule is None,\
+                "Resolution schedules are not supported when training in lockstep"
+            assert trainer.profile_steps is None,\
+                "Profiling is not supported when training in lockstep, profile the trainers one by one"
+        checkpoint_dirs = [trainer.checkpoint_dir for trainer in trainers]
+        assert len(set(checkpoint_dirs)) == len(trainers),\
+            f"All trainers need their own checkpoint directory, got: {checkpoint_dirs}"
+        self.dataloader_train = first.dataloader_train
+        self.eval_dataloader_val = first.eval_dataloader_val
+
+    def train(self):
+        """
+        Trains every model for its own number of epochs, or until it stops early.
+        """
+        for trainer in self.trainers:
+            trainer.start_time = time.time()
+        completed = False
+        try:
+            self._train_epochs()
+            completed = True
+        finally:
+            for trainer in self.trainers:
+                trainer.checkpoint_writer.wait(raise_error=False)
+        if completed:
+            for trainer in self.trainers:
+                trainer.checkpoint_writer.raise_error()
+
+    def _train_epochs(self):
+        stopped = set()
+        for epoch in range(max(trainer.epochs for trainer in self.trainers)):
+            active = [trainer for trainer in self.trainers
+                      if epoch < trainer.epochs and trainer not in stopped]
+            if not active:
+                return
+            for trainer in active:
+                trainer.epoch = epoch
+            for X_batch, Y_batch in self.dataloader_train:
+                X_batch = utils.to_cuda(X_batch)
+                Y_batch = utils.to_cuda(Y_batch)
+                for trainer in active:
+                    trainer.train_batch(X_batch, Y_batch)
+
+                validating = [trainer for trainer in active if trainer.should_validate_model()]
+                if not validating:
+                    continue
+                for trainer in validating:
+                    trainer.model.eval()
+                all_metrics = evaluator.evaluate_models(
+                    self.eval_dataloader_val, [trainer.model for trainer in validating],
+                    [trainer.loss_criterion for trainer in validating])
+                for trainer, metrics in zip(validating, all_metrics):
+                    if trainer.validate_and_save(metrics):
+                        stopped.add(trainer)
+                active = [trainer for trainer in active if trainer not in stopped]
+                if not active:
+                    return
@@ -4,6 +4,12 @@ import numpy as np
 import pathlib
 import random
 import collections
+import contextlib
+import hashlib
+import io
+import os
+import queue
+import threading
 
 # Allow torch/cudnn to optimize/analyze the input/output shape of convolutions
 # To optimize forward/backward pass.
@@ -58,6 +64,126 @@ def save_checkpoint(state_dict: dict,
         fp.write("\n".join(previous_checkpoints))
 
 
+def state_dict_hash(module: torch.nn.Module) -> str:
+    """
+    Returns a hash of the parameters and buffers of module, to key caches of its outputs on.
+    """
+    state_hash = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        state_hash.update(name.encode())
+        state_hash.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return state_hash.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_path(filepath: pathlib.Path):
+    """
+    Yields a temporary path next to filepath to write the file to. It is renamed
+    to filepath when the block completes and removed if the block raises,
+    so filepath never contains a partially written file.
+    """
+    tmp_path = filepath.parent.joinpath(f".{filepath.stem}.tmp{filepath.suffix}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, filepath)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def atomic_write(data: bytes, filepath: pathlib.Path):
+    """
+    Writes data to filepath atomically (see atomic_path).
+    """
+    with atomic_path(filepath) as tmp_path:
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+class AsyncCheckpointWriter:
+
+    def __init__(self, directory: pathlib.Path, max_keep: int = 1, max_pending: int = 2):
+        """
+            Saves checkpoints on a background thread, with the same files as
+            save_checkpoint. The caller only pays for copying the state_dict to
+            CPU memory; serialization and disk I/O happen on the writer thread.
+            Every file is written atomically, and the list of kept checkpoints
+            is tracked in memory instead of being re-read from disk.
+            At most max_pending snapshots wait for the writer, save blocks when
+            the disk falls further behind. A failed write is raised by the
+            next save or wait.
+        """
+        self.directory = directory
+        self.max_keep = max_keep
+        self.previous_checkpoints = None
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state_dict: dict, filepath: pathlib.Path, is_best: bool):
+        """
+        Snapshots state_dict to CPU memory and queues it to be written to filepath.
+        If is_best is toggled, it is also written to best.ckpt
+        """
+        self.raise_error()
+        snapshot = {key: value.detach().to("cpu", copy=True)
+                    for key, value in state_dict.items()}
+        self.queue.put((snapshot, filepath, is_best))
+
+    def wait(self, raise_error: bool = True):
+        """
+        Blocks until all queued checkpoints are written.
+        With raise_error=False a failed write is kept for the next save or wait,
+        e.g. to not mask the exception that ended training.
+        """
+        self.queue.join()
+        if raise_error:
+            self.raise_error()
+
+    def raise_error(self):
+        """
+        Raises (once) the first error of the writer thread, if any.
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            snapshot, filepath, is_best = self.queue.get()
+            try:
+                self._write(snapshot, filepath, is_best)
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, snapshot: dict, filepath: pathlib.Path, is_best: bool):
+        self.directory.mkdir(exist_ok=True, parents=True)
+        buffer = io.BytesIO()
+        torch.save(snapshot, buffer)
+        data = buffer.getvalue()
+        atomic_write(data, filepath)
+        if is_best:
+            atomic_write(data, self.directory.joinpath("best.ckpt"))
+
+        if self.previous_checkpoints is None:
+            self.previous_checkpoints = get_previous_checkpoints(self.directory)
+        if filepath.name not in self.previous_checkpoints:
+            self.previous_checkpoints = [filepath.name] + self.previous_checkpoints
+        for ckpt in self.previous_checkpoints[self.max_keep:]:
+            path = self.directory.joinpath(ckpt)
+            if path.exists():
+                path.unlink()
+        self.previous_checkpoints = self.previous_checkpoints[:self.max_keep]
+        atomic_write("\n".join(self.previous_checkpoints).encode(),
+                     self.directory.joinpath("latest_checkpoint"))
+
+
 def get_previous_checkpoints(directory: pathlib.Path) -> list:
     assert directory.is_dir()
     list_path = directory.joinpath("latest_checkpoint")
@@ -0,0 +1,204 @@
+import argparse
+import json
+import math
+import platform
+import time
+import torch
+import torch.nn.functional as F
+from ssd.config.defaults import cfg
+from ssd.modeling.box_head.loss import MultiBoxLoss
+from ssd.modeling.box_head.prior_box import PriorBox
+from ssd.utils import box_utils
+
+BENCHMARKS = ["assign_priors", "loss"]
+
+
+# Reference implementation: the original MultiBoxLoss with sort based hard negative mining
+
+def reference_hard_negative_mining(loss, labels, neg_pos_ratio):
+    pos_mask = labels > 0
+    num_pos = pos_mask.long().sum(dim=1, keepdim=True)
+    num_neg = num_pos * neg_pos_ratio
+
+    loss[pos_mask] = -math.inf
+    _, indexes = loss.sort(dim=1, descending=True)
+    _, orders = indexes.sort(dim=1)
+    neg_mask = orders < num_neg
+    return pos_mask | neg_mask
+
+
+def reference_multibox_loss(confidence, predicted_locations, labels, gt_locations, neg_pos_ratio):
+    num_classes = confidence.size(2)
+    with torch.no_grad():
+        loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
+        mask = reference_hard_negative_mining(loss, labels, neg_pos_ratio)
+
+    confidence = confidence[mask, :]
+    classification_loss = F.cross_entropy(confidence.view(-1, num_classes), labels[mask], reduction='sum')
+
+    pos_mask = labels > 0
+    predicted_locations = predicted_locations[pos_mask, :].view(-1, 4)
+    gt_locations = gt_locations[pos_mask, :].view(-1, 4)
+    smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, reduction='sum')
+    num_pos = gt_locations.size(0)
+    return smooth_l1_loss / num_pos, classification_loss / num_pos
+
+
+def scale_prior_density(cfg, density):
+    """Returns a copy of cfg with density times as many locations per feature map axis,
+    at the same input image size."""
+    cfg = cfg.clone()
+    priors = cfg.MODEL.PRIORS
+    priors.FEATURE_MAPS = [[fw * density, fh * density] for fw, fh in priors.FEATURE_MAPS]
+    priors.STRIDES = [[sx / density, sy / density] for sx, sy in priors.STRIDES]
+    return cfg
+
+
+def random_gt_boxes(num_images, num_targets, generator):
+    """Random corner form gt boxes relative to the image size, from tiny to image sized."""
+    size = torch.rand((num_images, num_targets, 2), generator=generator) ** 2 * 0.9 + 0.01
+    left_top = torch.rand((num_images, num_targets, 2), generator=generator) * (1 - size)
+    return torch.cat([left_top, left_top + size], dim=2)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark_assign_priors(cfg, densities, num_targets, num_images, seed=0):
+    """Times assign_priors with the full iou matrix and with the PriorGridIndex,
+    for every prior density and number of gt boxes per image, and checks that
+    both give identical boxes and labels."""
+    results = []
+    for density in densities:
+        density_cfg = scale_prior_density(cfg, density)
+        prior_box = PriorBox(density_cfg)
+        corner_form_priors = box_utils.center_form_to_corner_form(prior_box())
+        grid_index = box_utils.PriorGridIndex(
+            corner_form_priors, prior_box.feature_maps, prior_box.boxes_per_location)
+        for targets in num_targets:
+            generator = torch.Generator().manual_seed(seed)
+            all_gt_boxes = random_gt_boxes(num_images, targets, generator)
+            all_gt_labels = torch.randint(1, cfg.MODEL.NUM_CLASSES, (num_images, targets), generator=generator)
+            dense_time = grid_time = 0
+            num_candidates = 0
+            for gt_boxes, gt_labels in zip(all_gt_boxes, all_gt_labels):
+                elapsed, dense = timed(box_utils.assign_priors, gt_boxes, gt_labels,
+                                       corner_form_priors, density_cfg.MODEL.THRESHOLD)
+                dense_time += elapsed
+                elapsed, grid = timed(box_utils.assign_priors, gt_boxes, gt_labels,
+                                      corner_form_priors, density_cfg.MODEL.THRESHOLD, grid_index)
+                grid_time += elapsed
+                assert torch.equal(dense[0], grid[0]) and torch.equal(dense[1], grid[1]), \
+                    "Grid indexed matching differs from the full iou matrix"
+                num_candidates += len(grid_index.candidates(gt_boxes)[0])
+            result = dict(
+                density=density, num_priors=len(corner_form_priors), num_targets=targets,
+                dense_ms=dense_time / num_images * 1000, grid_ms=grid_time / num_images * 1000,
+                candidate_fraction=num_candidates / (num_images * targets * len(corner_form_priors)))
+            result["speedup"] = result["dense_ms"] / result["grid_ms"]
+            print("| {density} | {num_priors} | {num_targets} | {dense_ms:.2f} | {grid_ms:.2f} "
+                  "| {speedup:.1f}x | {candidate_fraction:.3f} |".format(**result))
+            results.append(result)
+    return results
+
+
+def random_loss_inputs(cfg, batch_size, num_priors, generator):
+    """Random predictions and targets, with 1 to 60 positive priors per image."""
+    confidence = torch.randn((batch_size, num_priors, cfg.MODEL.NUM_CLASSES), generator=generator) * 3
+    predicted_locations = torch.randn((batch_size, num_priors, 4), generator=generator)
+    gt_locations = torch.randn((batch_size, num_priors, 4), generator=generator)
+    num_pos = torch.randint(1, 61, (batch_size, 1), generator=generator)
+    is_positive = torch.rand((batch_size, num_priors), generator=generator) < num_pos / num_priors
+    labels = torch.randint(1, cfg.MODEL.NUM_CLASSES, (batch_size, num_priors), generator=generator) * is_positive
+    return confidence, predicted_locations, labels, gt_locations
+
+
+def benchmark_loss(cfg, batch_sizes, num_iterations, seed=0):
+    """Times a forward and backward pass of the reference and the fused MultiBoxLoss
+    per batch size (tests.py checks that both give the same losses)."""
+    num_priors = len(PriorBox(cfg)())
+    loss_evaluator = MultiBoxLoss(neg_pos_ratio=cfg.MODEL.NEG_POS_RATIO)
+    fused = lambda *inputs: loss_evaluator(*inputs)
+    reference = lambda *inputs: reference_multibox_loss(*inputs, cfg.MODEL.NEG_POS_RATIO)
+    results = []
+    for batch_size in batch_sizes:
+        generator = torch.Generator().manual_seed(seed)
+        confidence, predicted_locations, labels, gt_locations = random_loss_inputs(
+            cfg, batch_size, num_priors, generator)
+        confidence.requires_grad_(True)
+        predicted_locations.requires_grad_(True)
+        timings = {}
+        losses = {}
+        for name, loss_function in [("reference", reference), ("fused", fused)]:
+            elapsed_times = []
+            for iteration in range(num_iterations + 1):
+                confidence.grad = predicted_locations.grad = None
+                elapsed, (reg_loss, cls_loss) = timed(
+                    loss_function, confidence, predicted_locations, labels, gt_locations)
+                start = time.perf_counter()
+                (reg_loss + cls_loss).backward()
+                # The first iteration is a warmup
+                if iteration > 0:
+                    elapsed_times.append(elapsed + time.perf_counter() - start)
+            timings[name] = sorted(elapsed_times)[len(elapsed_times) // 2]
+            losses[name] = (reg_loss.item(), cls_loss.item())
+        result = dict(
+            batch_size=batch_size, num_priors=num_priors,
+            reference_ms=timings["reference"] * 1000, fused_ms=timings["fused"] * 1000,
+            reg_loss=losses["fused"][0], cls_loss=losses["fused"][1])
+        result["speedup"] = result["reference_ms"] / result["fused_ms"]
+        print("| {batch_size} | {reference_ms:.1f} | {fused_ms:.1f} | {speedup:.1f}x "
+              "| {reg_loss:.5f} | {cls_loss:.5f} |".format(**result))
+        results.append(result)
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks the SSD target assignment and loss")
+    parser.add_argument("--config_file", default="", metavar="FILE",
+                        help="config file, the defaults are used if not given")
+    parser.add_argument("--benchmarks", choices=BENCHMARKS, nargs="+", default=BENCHMARKS)
+    parser.add_argument("--densities", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="multiples of the feature map sizes of cfg.MODEL.PRIORS")
+    parser.add_argument("--num-targets", type=int, nargs="+", default=[1, 10, 50],
+                        help="numbers of gt boxes per image")
+    parser.add_argument("--num-images", type=int, default=20)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 32, 64, 128],
+                        help="batch sizes to time the loss at")
+    parser.add_argument("--iterations", type=int, default=10,
+                        help="number of timed loss iterations per batch size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.config_file:
+        cfg.merge_from_file(args.config_file)
+    results = dict(
+        torch_version=torch.__version__,
+        python_version=platform.python_version(),
+        processor=platform.processor() or platform.machine(),
+        num_threads=torch.get_num_threads(),
+    )
+    if "assign_priors" in args.benchmarks:
+        print("| Density | Priors | Gt boxes | Full iou matrix (ms/image) | Grid index (ms/image) "
+              "| Speedup | Candidate fraction |")
+        print("|" + "---|" * 7)
+        results["assign_priors"] = benchmark_assign_priors(
+            cfg, args.densities, args.num_targets, args.num_images, args.seed)
+    if "loss" in args.benchmarks:
+        print("| Batch size | Reference (ms/iteration) | Fused (ms/iteration) | Speedup | Reg loss | Cls loss |")
+        print("|" + "---|" * 6)
+        results["loss"] = benchmark_loss(cfg, args.batch_sizes, args.iterations, args.seed)
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=4)
+    print("Results written to: {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,18 @@ cfg = CN()
 cfg.MODEL = CN()
 # match default boxes to any ground truth with jaccard overlap higher than a threshold (0.5)
 cfg.MODEL.THRESHOLD = 0.55
+# Assign the targets to the priors for the whole batch in the training step,
+# instead of per image in the dataloader workers
+cfg.MODEL.BATCHED_TARGET_ASSIGNMENT = False
+# Match the priors through a box_utils.PriorGridIndex instead of the full iou matrix.
+# Only faster at prior densities well above the default (see benchmark.py)
+cfg.MODEL.GRID_PRIOR_MATCHING = False
 cfg.MODEL.NUM_CLASSES = 21
 # Hard negative mining
 cfg.MODEL.NEG_POS_RATIO = 3
+# Static cap on the hard negatives per image, 0 for no cap. Without a cap the
+# number of negatives is read back from the device in every training step
+cfg.MODEL.MAX_NEGATIVES = 0
 cfg.MODEL.CENTER_VARIANCE = 0.1
 cfg.MODEL.SIZE_VARIANCE = 0.2
 
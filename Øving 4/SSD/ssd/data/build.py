@@ -8,8 +8,15 @@ from ssd.container import Container
 
 
 class BatchCollator:
-    def __init__(self, is_train=True):
+    def __init__(self, is_train=True, pad_targets=False):
+        """
+        Args:
+            pad_targets: the targets are the raw gt boxes/labels of every image (see
+                cfg.MODEL.BATCHED_TARGET_ASSIGNMENT), which are padded with zero boxes
+                and label 0 (background) to the largest number of boxes in the batch.
+        """
         self.is_train = is_train
+        self.pad_targets = pad_targets
 
     def __call__(self, batch):
         transposed_batch = list(zip(*batch))
@@ -18,6 +25,8 @@ class BatchCollator:
 
         if self.is_train:
             list_targets = transposed_batch[1]
+            if self.pad_targets:
+                return images, pad_targets(list_targets), img_ids
             targets = Container(
                 {key: default_collate([d[key] for d in list_targets]) for key in list_targets[0]}
             )
@@ -26,6 +35,17 @@ class BatchCollator:
         return images, targets, img_ids
 
 
+def pad_targets(list_targets):
+    max_targets = max(1, max(len(target["labels"]) for target in list_targets))
+    boxes = torch.zeros((len(list_targets), max_targets, 4), dtype=torch.float32)
+    labels = torch.zeros((len(list_targets), max_targets), dtype=torch.int64)
+    for i, target in enumerate(list_targets):
+        num_targets = len(target["labels"])
+        boxes[i, :num_targets] = torch.as_tensor(target["boxes"])
+        labels[i, :num_targets] = torch.as_tensor(target["labels"])
+    return Container(boxes=boxes, labels=labels)
+
+
 def make_data_loader(cfg, is_train=True, max_iter=None, start_iter=0):
     train_transform = build_transforms(cfg, is_train=is_train)
     target_transform = build_target_transform(cfg) if is_train else None
@@ -36,6 +56,7 @@ def make_data_loader(cfg, is_train=True, max_iter=None, start_iter=0):
         target_transform=target_transform, is_train=is_train)
 
     shuffle = is_train
+    batched_targets = is_train and cfg.MODEL.BATCHED_TARGET_ASSIGNMENT
 
     data_loaders = []
 
@@ -51,7 +72,7 @@ def make_data_loader(cfg, is_train=True, max_iter=None, start_iter=0):
             batch_sampler = samplers.IterationBasedBatchSampler(batch_sampler, num_iterations=max_iter, start_iter=start_iter)
 
         data_loader = DataLoader(dataset, num_workers=cfg.DATA_LOADER.NUM_WORKERS, batch_sampler=batch_sampler,
-                                 pin_memory=cfg.DATA_LOADER.PIN_MEMORY, collate_fn=BatchCollator(is_train))
+                                 pin_memory=cfg.DATA_LOADER.PIN_MEMORY, collate_fn=BatchCollator(is_train, batched_targets))
         data_loaders.append(data_loader)
 
     if is_train:
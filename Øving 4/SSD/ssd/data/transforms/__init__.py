@@ -1,5 +1,5 @@
 from ssd.modeling.box_head.prior_box import PriorBox
-from .target_transform import SSDTargetTransform
+from .target_transform import SSDTargetTransform, SSDBatchTargetTransform
 from .transforms import *
 
 
@@ -23,8 +23,24 @@ def build_transforms(cfg, is_train=True):
 
 
 def build_target_transform(cfg):
-    transform = SSDTargetTransform(PriorBox(cfg)(),
+    if cfg.MODEL.BATCHED_TARGET_ASSIGNMENT:
+        # Targets are assigned in the training step, see build_batch_target_transform
+        return None
+    prior_box = PriorBox(cfg)
+    grid_arguments = []
+    if cfg.MODEL.GRID_PRIOR_MATCHING:
+        grid_arguments = [prior_box.feature_maps, prior_box.boxes_per_location]
+    transform = SSDTargetTransform(prior_box(),
                                    cfg.MODEL.CENTER_VARIANCE,
                                    cfg.MODEL.SIZE_VARIANCE,
-                                   cfg.MODEL.THRESHOLD)
+                                   cfg.MODEL.THRESHOLD,
+                                   *grid_arguments)
+    return transform
+
+
+def build_batch_target_transform(cfg):
+    transform = SSDBatchTargetTransform(PriorBox(cfg)(),
+                                        cfg.MODEL.CENTER_VARIANCE,
+                                        cfg.MODEL.SIZE_VARIANCE,
+                                        cfg.MODEL.THRESHOLD)
     return transform
@@ -1,12 +1,21 @@
 import numpy as np
 import torch
+from ssd.container import Container
 from ssd.utils import box_utils
 
 
 class SSDTargetTransform:
-    def __init__(self, center_form_priors, center_variance, size_variance, iou_threshold):
+    def __init__(self, center_form_priors, center_variance, size_variance, iou_threshold,
+                 feature_maps=None, boxes_per_location=None):
+        """
+        If the feature maps and boxes per location of the priors are given, priors are
+        matched through a box_utils.PriorGridIndex instead of the full iou matrix.
+        """
         self.center_form_priors = center_form_priors
         self.corner_form_priors = box_utils.center_form_to_corner_form(center_form_priors)
+        self.grid_index = None
+        if feature_maps is not None:
+            self.grid_index = box_utils.PriorGridIndex(self.corner_form_priors, feature_maps, boxes_per_location)
         self.center_variance = center_variance
         self.size_variance = size_variance
         self.iou_threshold = iou_threshold
@@ -17,8 +26,46 @@ class SSDTargetTransform:
         if type(gt_labels) is np.ndarray:
             gt_labels = torch.from_numpy(gt_labels)
         boxes, labels = box_utils.assign_priors(gt_boxes, gt_labels,
-                                                self.corner_form_priors, self.iou_threshold)
+                                                self.corner_form_priors, self.iou_threshold,
+                                                self.grid_index)
         boxes = box_utils.corner_form_to_center_form(boxes)
         locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
-       
+
         return locations, labels
+
+
+class SSDBatchTargetTransform(SSDTargetTransform):
+    """
+    Batched version of SSDTargetTransform, used in the training step instead of
+    in the dataloader workers. The workers then only send the padded gt boxes and
+    labels (see BatchCollator), and the targets of the whole batch are encoded at
+    once on the device of the batch, where the priors are kept.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device = self.center_form_priors.device
+
+    def to(self, device):
+        if self.device != torch.device(device):
+            self.center_form_priors = self.center_form_priors.to(device)
+            self.corner_form_priors = self.corner_form_priors.to(device)
+            self.device = self.center_form_priors.device
+        return self
+
+    def __call__(self, targets):
+        """
+        Args:
+            targets: Container with boxes (batch_size, max_targets, 4) and
+                labels (batch_size, max_targets), padded with label 0.
+        Returns:
+            Container with boxes (batch_size, num_priors, 4) and labels (batch_size, num_priors),
+            as given by SSDTargetTransform for every image
+        """
+        gt_boxes, gt_labels = targets["boxes"], targets["labels"]
+        self.to(gt_boxes.device)
+        boxes, labels = box_utils.assign_priors_batched(gt_boxes, gt_labels,
+                                                        self.corner_form_priors, self.iou_threshold)
+        boxes = box_utils.corner_form_to_center_form(boxes)
+        locations = box_utils.convert_boxes_to_locations(boxes, self.center_form_priors, self.center_variance, self.size_variance)
+        return Container(boxes=locations, labels=labels)
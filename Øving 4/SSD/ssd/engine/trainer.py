@@ -6,6 +6,7 @@ import time
 import torch
 import torch.utils.tensorboard
 from ssd.engine.inference import do_evaluation
+from ssd.data.transforms import build_batch_target_transform
 from ssd.utils.metric_logger import MetricLogger
 from ssd import torch_utils
 
@@ -30,6 +31,8 @@ def do_train(cfg, model,
     meters = MetricLogger()
 
     model.train()
+    # With batched target assignment, the loader returns the padded raw gt boxes and labels
+    target_transform = build_batch_target_transform(cfg) if cfg.MODEL.BATCHED_TARGET_ASSIGNMENT else None
 
     summary_writer = torch.utils.tensorboard.SummaryWriter(
         log_dir=os.path.join(cfg.OUTPUT_DIR, 'tf_logs'))
@@ -43,6 +46,8 @@ def do_train(cfg, model,
         arguments["iteration"] = iteration
         images = torch_utils.to_cuda(images)
         targets = torch_utils.to_cuda(targets)
+        if target_transform is not None:
+            targets = target_transform(targets)
         loss_dict = model(images, targets=targets)
         loss = sum(loss for loss in loss_dict.values())
 
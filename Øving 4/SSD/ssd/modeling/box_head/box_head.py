@@ -13,7 +13,8 @@ class SSDBoxHead(nn.Module):
         super().__init__()
         self.cfg = cfg
         self.predictor = BoxPredictor(cfg)
-        self.loss_evaluator = MultiBoxLoss(neg_pos_ratio=cfg.MODEL.NEG_POS_RATIO)
+        self.loss_evaluator = MultiBoxLoss(neg_pos_ratio=cfg.MODEL.NEG_POS_RATIO,
+                                           max_negatives=cfg.MODEL.MAX_NEGATIVES or None)
         self.post_processor = PostProcessor(cfg)
         self.priors = None
 
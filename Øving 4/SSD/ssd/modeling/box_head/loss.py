@@ -5,14 +5,17 @@ from ssd.utils import box_utils
 
 
 class MultiBoxLoss(nn.Module):
-    def __init__(self, neg_pos_ratio):
+    def __init__(self, neg_pos_ratio, max_negatives=None):
         """Implement SSD MultiBox Loss.
 
         Basically, MultiBox loss combines classification loss
          and Smooth L1 regression loss.
+        max_negatives: optional cap on the hard negatives per image, which avoids
+            a device sync in every step (see box_utils.hard_negative_mining)
         """
         super().__init__()
         self.neg_pos_ratio = neg_pos_ratio
+        self.max_negatives = max_negatives
 
     def forward(self, confidence, predicted_locations, labels, gt_locations):
         """Compute classification loss and smooth l1 loss.
@@ -23,18 +26,20 @@ class MultiBoxLoss(nn.Module):
             labels (batch_size, num_priors): real labels of all the priors.
             gt_locations (batch_size, num_priors, 4): real boxes corresponding all the priors.
         """
-        num_classes = confidence.size(2)
+        # A single log-softmax, used for both the mining and the classification loss
+        log_probs = F.log_softmax(confidence, dim=2)
         with torch.no_grad():
             # derived from cross_entropy=sum(log(p))
-            loss = -F.log_softmax(confidence, dim=2)[:, :, 0]
-            mask = box_utils.hard_negative_mining(loss, labels, self.neg_pos_ratio)
+            loss = -log_probs[:, :, 0]
+            mask = box_utils.hard_negative_mining(loss, labels, self.neg_pos_ratio, self.max_negatives)
 
-        confidence = confidence[mask, :]
-        classification_loss = F.cross_entropy(confidence.view(-1, num_classes), labels[mask], reduction='sum')
+        # Reduce over the masks instead of gathering the selected priors into new tensors
+        cross_entropy = -log_probs.gather(2, labels.unsqueeze(2)).squeeze(2)
+        classification_loss = torch.where(mask, cross_entropy, torch.zeros_like(cross_entropy)).sum()
 
         pos_mask = labels > 0
-        predicted_locations = predicted_locations[pos_mask, :].view(-1, 4)
-        gt_locations = gt_locations[pos_mask, :].view(-1, 4)
+        # Targets of the other priors are set to the prediction, which gives zero loss and gradient
+        gt_locations = torch.where(pos_mask.unsqueeze(2), gt_locations, predicted_locations.detach())
         smooth_l1_loss = F.smooth_l1_loss(predicted_locations, gt_locations, reduction='sum')
-        num_pos = gt_locations.size(0)
+        num_pos = pos_mask.sum()
         return smooth_l1_loss / num_pos, classification_loss / num_pos
@@ -1,9 +1,22 @@
+import hashlib
+import json
+import os
+import pathlib
 import torch
 from math import sqrt
 
+# Priors are a pure function of the input size and prior config,
+# so they are memoized per process (and on disk, see PriorBox.__call__)
+_PRIOR_CACHE = {}
+
+
+def default_cache_dir():
+    torch_home = os.path.expanduser(os.getenv("TORCH_HOME", "~/.torch"))
+    return pathlib.Path(torch_home, "ssd_priors")
+
 
 class PriorBox:
-    def __init__(self, cfg):
+    def __init__(self, cfg, cache_dir=None):
         self.image_size = cfg.INPUT.IMAGE_SIZE
         prior_config = cfg.MODEL.PRIORS
         self.feature_maps = prior_config.FEATURE_MAPS
@@ -12,47 +25,87 @@ class PriorBox:
         self.strides = prior_config.STRIDES
         self.aspect_ratios = prior_config.ASPECT_RATIOS
         self.clip = prior_config.CLIP
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else default_cache_dir()
+        self.key = hashlib.sha1(json.dumps(
+            [list(self.image_size), prior_config], sort_keys=True, default=list
+        ).encode()).hexdigest()
+
+    @property
+    def boxes_per_location(self):
+        # The small and big square box, and two boxes per aspect ratio
+        return [2 + 2 * len(ratios) for ratios in self.aspect_ratios]
 
     def __call__(self):
         """Generate SSD Prior Boxes.
             It returns the center, height and width of the priors. The values are relative to the image size
+            The priors are cached in memory and in cache_dir, keyed by a hash of
+            cfg.INPUT.IMAGE_SIZE and cfg.MODEL.PRIORS.
             Returns:
                 priors (num_priors, 4): The prior boxes represented as [[center_x, center_y, w, h]]. All the values
                     are relative to the image size.
         """
+        if self.key not in _PRIOR_CACHE:
+            _PRIOR_CACHE[self.key] = self._load_or_generate()
+        # Callers may modify the priors in place, so never hand out the cached tensor
+        return _PRIOR_CACHE[self.key].clone()
+
+    def _load_or_generate(self):
+        filepath = self.cache_dir.joinpath(self.key + ".pt")
+        if filepath.is_file():
+            try:
+                return torch.load(filepath)
+            except Exception:
+                # Corrupt cache file, regenerate it below
+                pass
+        priors = self.generate()
+        try:
+            self.cache_dir.mkdir(exist_ok=True, parents=True)
+            tmp_filepath = filepath.with_suffix(".{}.tmp".format(os.getpid()))
+            torch.save(priors, tmp_filepath)
+            tmp_filepath.replace(filepath)
+        except OSError:
+            # Read-only cache directory, the in-memory cache still applies
+            pass
+        return priors
+
+    def generate(self):
+        """Generates the priors of all feature maps without any caching.
+            For every feature map, the priors are ordered row by row over the locations,
+            and per location: the small square box, the big square box and then
+            the (w * sqrt(r), h / sqrt(r)), (w / sqrt(r), h * sqrt(r)) boxes of every aspect ratio r.
+        """
         priors = []
         for k, [fw, fh] in enumerate(self.feature_maps):
+            # Computed in float64 and cast once, matching the python float computation
             scale_y = self.image_size[1] / self.strides[k][1]
             scale_x = self.image_size[0] / self.strides[k][0]
-            for j in range(fh):
-                for i in range(fw):
-                    # unit center x,y
-                    cx = (i + 0.5) / scale_x
-                    cy = (j + 0.5) / scale_y
-
-                    # small sized square box
-                    size = self.min_sizes[k]
-                    h = size[1] / self.image_size[1]
-                    w = size[0] / self.image_size[0]
-                    priors.append([cx, cy, w, h])
-
-                    # big sized square box
-                    sizeH = sqrt(self.min_sizes[k][1] * self.max_sizes[k][1])
-                    sizeW = sqrt(self.min_sizes[k][0] * self.max_sizes[k][0])
-                    h = sizeH / self.image_size[1]
-                    w = sizeW / self.image_size[0]
-                    priors.append([cx, cy, w, h])
-
-                    # change h/w ratio of the small sized box
-                    size = self.min_sizes[k]
-                    h = size[1] / self.image_size[1]
-                    w = size[0] / self.image_size[0]
-                    for ratio in self.aspect_ratios[k]:
-                        ratio = sqrt(ratio)
-                        priors.append([cx, cy, w * ratio, h / ratio])
-                        priors.append([cx, cy, w / ratio, h * ratio])
-
-        priors = torch.tensor(priors)
+            cy, cx = torch.meshgrid(
+                (torch.arange(fh, dtype=torch.float64) + 0.5) / scale_y,
+                (torch.arange(fw, dtype=torch.float64) + 0.5) / scale_x,
+                indexing="ij")
+
+            # small sized square box
+            w = self.min_sizes[k][0] / self.image_size[0]
+            h = self.min_sizes[k][1] / self.image_size[1]
+            sizes = [[w, h]]
+            # big sized square box
+            sizes.append([
+                sqrt(self.min_sizes[k][0] * self.max_sizes[k][0]) / self.image_size[0],
+                sqrt(self.min_sizes[k][1] * self.max_sizes[k][1]) / self.image_size[1]])
+            # change h/w ratio of the small sized box
+            for ratio in self.aspect_ratios[k]:
+                ratio = sqrt(ratio)
+                sizes.append([w * ratio, h / ratio])
+                sizes.append([w / ratio, h * ratio])
+            sizes = torch.tensor(sizes, dtype=torch.float64)
+
+            # [fh * fw, 1, 2] centers and [1, boxes_per_location, 2] sizes
+            centers = torch.stack([cx, cy], dim=-1).view(-1, 1, 2)
+            centers = centers.expand(-1, len(sizes), -1)
+            sizes = sizes.unsqueeze(0).expand(len(centers), -1, -1)
+            priors.append(torch.cat([centers, sizes], dim=-1).view(-1, 4))
+
+        priors = torch.cat(priors).float()
         if self.clip:
             priors.clamp_(max=1, min=0)
         return priors
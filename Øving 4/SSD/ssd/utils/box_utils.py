@@ -71,24 +71,134 @@ def iou_of(boxes0, boxes1, eps=1e-5):
     return overlap_area / (area0 + area1 - overlap_area + eps)
 
 
+class PriorGridIndex:
+    """Spatial index over priors laid out as by PriorBox: per feature map, row by row
+    over the locations, with boxes_per_location boxes per location.
+    The priors of one feature map and box type b form a grid, where the x coordinates
+    only depend on the column and the y coordinates only on the row. A gt box therefore
+    overlaps a contiguous range of columns and rows, which is found with a binary search,
+    so only those candidate priors are compared against it.
+    """
+
+    def __init__(self, corner_form_priors, feature_maps, boxes_per_location):
+        """
+        Args:
+            corner_form_priors (num_priors, 4): corner form priors
+            feature_maps: [[fw, fh], ...], as cfg.MODEL.PRIORS.FEATURE_MAPS
+            boxes_per_location: number of boxes per location of every feature map
+        """
+        num_priors = sum(fw * fh * num_boxes for (fw, fh), num_boxes in zip(feature_maps, boxes_per_location))
+        if num_priors != len(corner_form_priors):
+            raise ValueError("Expected {} priors from the feature maps, got {}".format(
+                num_priors, len(corner_form_priors)))
+        max_width = max(fw for fw, fh in feature_maps)
+        max_height = max(fh for fw, fh in feature_maps)
+        # One group per feature map and box type. Padded with inf, which never overlaps.
+        x_tables, y_tables, groups = [], [], []
+        offset = 0
+        for (fw, fh), num_boxes in zip(feature_maps, boxes_per_location):
+            grid = corner_form_priors[offset:offset + fh * fw * num_boxes].view(fh, fw, num_boxes, 4)
+            x = grid[0, :, :, 0::2]
+            y = grid[:, 0, :, 1::2]
+            if not (torch.equal(grid[..., 0::2], x.expand(fh, -1, -1, -1))
+                    and torch.equal(grid[..., 1::2], y.unsqueeze(1).expand(-1, fw, -1, -1))):
+                raise ValueError("The priors are not laid out on the feature map grids")
+            if (x.diff(dim=0) < 0).any() or (y.diff(dim=0) < 0).any():
+                raise ValueError("The prior coordinates do not increase along the feature map grids")
+            for b in range(num_boxes):
+                x_tables.append(torch.full((max_width, 2), math.inf, dtype=x.dtype).index_copy_(0, torch.arange(fw), x[:, b]))
+                y_tables.append(torch.full((max_height, 2), math.inf, dtype=y.dtype).index_copy_(0, torch.arange(fh), y[:, b]))
+                groups.append([offset + b, fw, num_boxes])
+            offset += fh * fw * num_boxes
+        # size: num_groups x max_width / max_height
+        x_tables = torch.stack(x_tables)
+        y_tables = torch.stack(y_tables)
+        self.x1, self.x2 = x_tables[..., 0].contiguous(), x_tables[..., 1].contiguous()
+        self.y1, self.y2 = y_tables[..., 0].contiguous(), y_tables[..., 1].contiguous()
+        # size: num_groups x 3, the prior index of the first location, the width and the stride
+        self.groups = torch.tensor(groups)
+
+    def candidates(self, gt_boxes):
+        """Find all (target, prior) pairs with a non-zero overlap.
+
+        Args:
+            gt_boxes (num_targets, 4): ground truth boxes.
+        Returns:
+            target_index (num_candidates), prior_index (num_candidates)
+        """
+        # Integer gt boxes are compared in the floating point type of the priors
+        device, dtype = gt_boxes.device, torch.promote_types(gt_boxes.dtype, self.x1.dtype)
+        gt_boxes = gt_boxes.to(dtype)
+        num_groups, num_targets = len(self.groups), len(gt_boxes)
+
+        def overlapping_range(low, high, gt_low, gt_high):
+            # The overlap is positive for high > gt_low and low < gt_high.
+            # Both tables are sorted, so these are a prefix and a suffix.
+            low, high = low.to(device, dtype), high.to(device, dtype)
+            start = torch.searchsorted(high, gt_low.expand(num_groups, -1).contiguous(), right=True)
+            end = torch.searchsorted(low, gt_high.expand(num_groups, -1).contiguous())
+            return start.flatten(), (end - start).clamp(min=0).flatten()
+
+        # size: num_groups * num_targets
+        column_start, num_columns = overlapping_range(self.x1, self.x2, gt_boxes[:, 0], gt_boxes[:, 2])
+        row_start, num_rows = overlapping_range(self.y1, self.y2, gt_boxes[:, 1], gt_boxes[:, 3])
+        counts = num_columns * num_rows
+        pair = torch.repeat_interleave(torch.arange(len(counts), device=device), counts)
+        local = torch.arange(len(pair), device=device) - (counts.cumsum(0) - counts)[pair]
+        num_columns = num_columns[pair]
+        column = column_start[pair] + local % num_columns
+        row = row_start[pair] + local // num_columns
+        first_prior, width, stride = self.groups.to(device)[pair // num_targets].unbind(1)
+        prior_index = first_prior + (row * width + column) * stride
+        target_index = pair % num_targets
+        return target_index, prior_index
+
+    def max_ious(self, gt_boxes, corner_form_priors):
+        """The same as ious.max(1) and ious.max(0) of the full num_priors x num_targets
+        iou matrix in assign_priors, including the index of the first maximum on ties.
+        """
+        target_index, prior_index = self.candidates(gt_boxes)
+        ious = iou_of(gt_boxes[target_index], corner_form_priors[prior_index])
+
+        def max_over(index, other_index, size, num_other):
+            best = ious.new_zeros(size).scatter_reduce_(0, index, ious, reduce="amax")
+            is_best = ious == best[index]
+            best_index = index.new_full((size,), num_other).scatter_reduce_(
+                0, index[is_best], other_index[is_best], reduce="amin")
+            # All zero rows have their maximum at index 0
+            return best, torch.where(best > 0, best_index, 0)
+
+        best_target_per_prior, best_target_per_prior_index = max_over(
+            prior_index, target_index, len(corner_form_priors), len(gt_boxes))
+        best_prior_per_target, best_prior_per_target_index = max_over(
+            target_index, prior_index, len(gt_boxes), len(corner_form_priors))
+        return best_target_per_prior, best_target_per_prior_index, best_prior_per_target, best_prior_per_target_index
+
+
 def assign_priors(gt_boxes, gt_labels, corner_form_priors,
-                  iou_threshold):
+                  iou_threshold, grid_index=None):
     """Assign ground truth boxes and targets to priors.
 
     Args:
         gt_boxes (num_targets, 4): ground truth boxes.
         gt_labels (num_targets): labels of targets.
         priors (num_priors, 4): corner form priors
+        grid_index: optional PriorGridIndex of the priors. Gives the same result,
+            but only computes the ious of overlapping gt boxes and priors.
     Returns:
         boxes (num_priors, 4): real values for priors.
         labels (num_priros): labels for priors.
     """
-    # size: num_priors x num_targets
-    ious = iou_of(gt_boxes.unsqueeze(0), corner_form_priors.unsqueeze(1))
-    # size: num_priors
-    best_target_per_prior, best_target_per_prior_index = ious.max(1)
-    # size: num_targets
-    best_prior_per_target, best_prior_per_target_index = ious.max(0)
+    if grid_index is not None:
+        best_target_per_prior, best_target_per_prior_index, best_prior_per_target, best_prior_per_target_index = \
+            grid_index.max_ious(gt_boxes, corner_form_priors)
+    else:
+        # size: num_priors x num_targets
+        ious = iou_of(gt_boxes.unsqueeze(0), corner_form_priors.unsqueeze(1))
+        # size: num_priors
+        best_target_per_prior, best_target_per_prior_index = ious.max(1)
+        # size: num_targets
+        best_prior_per_target, best_prior_per_target_index = ious.max(0)
 
     for target_index, prior_index in enumerate(best_prior_per_target_index):
         best_target_per_prior_index[prior_index] = target_index
@@ -101,7 +211,50 @@ def assign_priors(gt_boxes, gt_labels, corner_form_priors,
     return boxes, labels
 
 
-def hard_negative_mining(loss, labels, neg_pos_ratio):
+def assign_priors_batched(gt_boxes, gt_labels, corner_form_priors,
+                          iou_threshold):
+    """Assign ground truth boxes and targets to priors for a whole (padded) batch.
+    Gives the same result as assign_priors on every image, without a python loop.
+
+    Args:
+        gt_boxes (batch_size, max_targets, 4): ground truth boxes, padded with zeros.
+        gt_labels (batch_size, max_targets): labels of targets, padded with 0 (background).
+        priors (num_priors, 4): corner form priors
+    Returns:
+        boxes (batch_size, num_priors, 4): real values for priors. Images without
+            targets get the priors themselves, so their encoded locations are zero.
+        labels (batch_size, num_priors): labels for priors.
+    """
+    is_target = gt_labels > 0
+    # size: batch_size x num_priors x max_targets
+    ious = iou_of(gt_boxes.unsqueeze(1), corner_form_priors[None, :, None])
+    # Padding never wins the max below, as real ious are >= 0
+    ious.masked_fill_(~is_target.unsqueeze(1), -1)
+    # size: batch_size x num_priors
+    best_target_per_prior, best_target_per_prior_index = ious.max(2)
+    # size: batch_size x max_targets
+    best_prior_per_target_index = ious.argmax(1)
+
+    # Every target is forced onto its best prior. When several targets share a prior,
+    # the loop in assign_priors keeps the last one, i.e. the highest target index.
+    target_index = torch.arange(gt_labels.shape[1], device=gt_labels.device).expand_as(gt_labels)
+    forced_target = torch.full_like(best_target_per_prior_index, -1).scatter_reduce_(
+        1, best_prior_per_target_index, torch.where(is_target, target_index, -1),
+        reduce="amax")
+    is_forced = forced_target >= 0
+    best_target_per_prior_index = torch.where(is_forced, forced_target, best_target_per_prior_index)
+    # 2.0 is used to make sure every target has a prior assigned
+    best_target_per_prior.masked_fill_(is_forced, 2)
+
+    labels = gt_labels.gather(1, best_target_per_prior_index)
+    labels[best_target_per_prior < iou_threshold] = 0  # the backgournd id
+    boxes = gt_boxes.gather(1, best_target_per_prior_index.unsqueeze(2).expand(-1, -1, 4))
+    has_targets = is_target.any(1)[:, None, None]
+    boxes = torch.where(has_targets, boxes, corner_form_priors.unsqueeze(0))
+    return boxes, labels
+
+
+def hard_negative_mining(loss, labels, neg_pos_ratio, max_negatives=None):
     """
     It used to suppress the presence of a large number of negative prediction.
     It works on image level not batch level.
@@ -114,15 +267,24 @@ def hard_negative_mining(loss, labels, neg_pos_ratio):
         loss (N, num_priors): the loss for each example.
         labels (N, num_priors): the labels.
         neg_pos_ratio:  the ratio between the negative examples and positive examples.
+        max_negatives: optional static cap on the number of negatives per image.
+            Without it, the largest number of negatives of the batch is read back
+            to size the topk, which synchronizes with the device on every call.
     """
     pos_mask = labels > 0
     num_pos = pos_mask.long().sum(dim=1, keepdim=True)
     num_neg = num_pos * neg_pos_ratio
 
-    loss[pos_mask] = -math.inf
-    _, indexes = loss.sort(dim=1, descending=True)
-    _, orders = indexes.sort(dim=1)
-    neg_mask = orders < num_neg
+    loss = loss.masked_fill(pos_mask, -math.inf)
+    # Only the num_neg highest losses of every image are needed, so select
+    # the largest num_neg of the batch with topk instead of ranking all priors
+    if max_negatives is None:
+        k = min(int(num_neg.max()), loss.size(1))
+    else:
+        k = min(max_negatives, loss.size(1))
+    _, indexes = loss.topk(k, dim=1)
+    ranks = torch.arange(k, device=loss.device).unsqueeze(0)
+    neg_mask = torch.zeros_like(pos_mask).scatter_(1, indexes, ranks < num_neg)
     return pos_mask | neg_mask
 
 
@@ -0,0 +1,131 @@
+import math
+import torch
+from benchmark import reference_hard_negative_mining, reference_multibox_loss, random_loss_inputs
+from ssd.config.defaults import cfg
+from ssd.data.build import pad_targets
+from ssd.data.transforms import build_target_transform, build_batch_target_transform
+from ssd.modeling.box_head.loss import MultiBoxLoss
+from ssd.modeling.box_head.prior_box import PriorBox
+from ssd.utils import box_utils
+
+
+def random_gt_boxes(num_targets, generator):
+    """Random corner form gt boxes relative to the image size, from tiny to image sized."""
+    size = torch.rand((num_targets, 2), generator=generator) ** 2 * 0.9 + 0.01
+    left_top = torch.rand((num_targets, 2), generator=generator) * (1 - size)
+    return torch.cat([left_top, left_top + size], dim=1)
+
+
+def random_gt_labels(num_targets, generator):
+    return torch.randint(1, cfg.MODEL.NUM_CLASSES, (num_targets,), generator=generator)
+
+
+def test_batch_target_transform():
+    print("="*80)
+    print("Running tests for SSDBatchTargetTransform")
+    target_transform = build_target_transform(cfg)
+    batch_target_transform = build_batch_target_transform(cfg)
+    generator = torch.Generator().manual_seed(0)
+    # Images without gt boxes are padded like the others
+    num_targets = [3, 0, 1, 20, 0, 7]
+    list_targets = [dict(boxes=random_gt_boxes(n, generator), labels=random_gt_labels(n, generator))
+                    for n in num_targets]
+    targets = batch_target_transform(pad_targets(list_targets))
+    for i, target in enumerate(list_targets):
+        res_locations, res_labels = targets["boxes"][i], targets["labels"][i]
+        if len(target["labels"]) == 0:
+            assert torch.all(res_labels == 0), "Expected only background for an image without gt boxes"
+            assert torch.allclose(res_locations, torch.zeros_like(res_locations), atol=1e-5),\
+                "Expected zero locations for an image without gt boxes, got: {}".format(res_locations.abs().max())
+            continue
+        locations, labels = target_transform(target["boxes"], target["labels"])
+        assert torch.equal(res_labels, labels), "Labels of image {} differ at {} priors".format(
+            i, (res_labels != labels).sum())
+        assert torch.allclose(res_locations, locations, atol=1e-5), "Locations of image {} differ by {}".format(
+            i, (res_locations - locations).abs().max())
+
+    # Only padded images
+    list_targets = [dict(boxes=random_gt_boxes(0, generator), labels=random_gt_labels(0, generator))] * 2
+    targets = batch_target_transform(pad_targets(list_targets))
+    assert torch.all(targets["labels"] == 0)
+
+
+def test_prior_grid_index():
+    print("="*80)
+    print("Running tests for PriorGridIndex")
+    generator = torch.Generator().manual_seed(0)
+    for density in [1, 2]:
+        density_cfg = cfg.clone()
+        priors = density_cfg.MODEL.PRIORS
+        priors.FEATURE_MAPS = [[fw * density, fh * density] for fw, fh in priors.FEATURE_MAPS]
+        priors.STRIDES = [[sx / density, sy / density] for sx, sy in priors.STRIDES]
+        prior_box = PriorBox(density_cfg)
+        corner_form_priors = box_utils.center_form_to_corner_form(prior_box())
+        grid_index = box_utils.PriorGridIndex(
+            corner_form_priors, prior_box.feature_maps, prior_box.boxes_per_location)
+        all_gt_boxes = [random_gt_boxes(n, generator) for n in [1, 5, 30]]
+        # Tiny boxes, boxes covering the whole image and boxes on the image border
+        all_gt_boxes.append(torch.tensor([[0.5, 0.5, 0.5001, 0.5001], [0, 0, 0.001, 0.001],
+                                          [0.999, 0.999, 1, 1], [0.2, 0.7, 0.2005, 0.7003]]))
+        all_gt_boxes.append(torch.tensor([[0., 0., 1., 1.]]))
+        all_gt_boxes.append(torch.tensor([[0, 0, 1, 1], [0, 0, 1, 1], [0.01, 0, 0.99, 1], [0.4, 0.4, 0.41, 0.41]]))
+        # Integer boxes
+        all_gt_boxes.append(torch.tensor([[0, 0, 1, 1]]))
+        for gt_boxes in all_gt_boxes:
+            gt_labels = random_gt_labels(len(gt_boxes), generator)
+            ans_boxes, ans_labels = box_utils.assign_priors(
+                gt_boxes, gt_labels, corner_form_priors, density_cfg.MODEL.THRESHOLD)
+            res_boxes, res_labels = box_utils.assign_priors(
+                gt_boxes, gt_labels, corner_form_priors, density_cfg.MODEL.THRESHOLD, grid_index)
+            assert torch.equal(res_labels, ans_labels), "Labels differ at {} priors for gt boxes: {}".format(
+                (res_labels != ans_labels).sum(), gt_boxes)
+            assert torch.equal(res_boxes, ans_boxes), "Boxes differ at {} priors for gt boxes: {}".format(
+                (res_boxes != ans_boxes).any(1).sum(), gt_boxes)
+
+
+def test_multibox_loss():
+    print("="*80)
+    print("Running tests for MultiBoxLoss")
+    num_priors = len(PriorBox(cfg)())
+    neg_pos_ratio = cfg.MODEL.NEG_POS_RATIO
+    generator = torch.Generator().manual_seed(0)
+    for batch_size in [1, 4, 16]:
+        inputs = random_loss_inputs(cfg, batch_size, num_priors, generator)
+        confidence, predicted_locations, labels, gt_locations = inputs
+        if batch_size == 4:
+            # More negatives than there are priors left
+            labels[0, :num_priors // 2] = 1
+        outputs = {}
+        for name, loss_function in [("reference", lambda *inputs: reference_multibox_loss(*inputs, neg_pos_ratio)),
+                                    ("fused", MultiBoxLoss(neg_pos_ratio))]:
+            confidence_grad = confidence.clone().requires_grad_(True)
+            locations_grad = predicted_locations.clone().requires_grad_(True)
+            reg_loss, cls_loss = loss_function(confidence_grad, locations_grad, labels, gt_locations)
+            (reg_loss + cls_loss).backward()
+            outputs[name] = reg_loss.item(), cls_loss.item(), confidence_grad.grad, locations_grad.grad
+        ans, res = outputs["reference"], outputs["fused"]
+        assert math.isclose(res[0], ans[0], rel_tol=1e-5) and math.isclose(res[1], ans[1], rel_tol=1e-5),\
+            "Expected losses {}, got: {}".format(ans[:2], res[:2])
+        assert torch.allclose(res[2], ans[2], atol=1e-7) and torch.allclose(res[3], ans[3], atol=1e-7),\
+            "Gradients differ from the reference"
+
+        # A cap of at least the largest number of negatives gives the same mask, a smaller one caps every image
+        loss = torch.rand((batch_size, num_priors), generator=generator)
+        ans = reference_hard_negative_mining(loss.clone(), labels, neg_pos_ratio)
+        max_num_neg = int((labels > 0).sum(1).max()) * neg_pos_ratio
+        for max_negatives in [None, max_num_neg, num_priors * 2]:
+            res = box_utils.hard_negative_mining(loss, labels, neg_pos_ratio, max_negatives)
+            assert torch.equal(res, ans), "Masks differ at {} priors with max_negatives={}".format(
+                (res != ans).sum(), max_negatives)
+        res = box_utils.hard_negative_mining(loss, labels, neg_pos_ratio, 5)
+        num_neg = (res & (labels == 0)).sum(1)
+        ans = ((labels > 0).sum(1) * neg_pos_ratio).clamp(max=5)
+        assert torch.equal(num_neg, ans), "Expected {} negatives, got: {}".format(ans, num_neg)
+
+
+if __name__ == "__main__":
+    test_batch_target_transform()
+    test_prior_grid_index()
+    test_multibox_loss()
+    print("="*80)
+    print("All tests OK.")
@@ -0,0 +1,239 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import time
+import numpy as np
+import task2
+from box_store import BoxStore
+
+SSD_EVAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "SSD", "ssd", "data", "datasets", "evaluation", "eval_detection_voc.py")
+
+
+# Reference implementations: the original loop based versions of task2.py
+
+def reference_get_all_box_matches(prediction_boxes, gt_boxes, iou_threshold):
+    pred_matches = []
+    gt_matches = []
+    for pred in prediction_boxes:
+        max_iou = 0
+        match = None
+        for gt in gt_boxes:
+            iou = task2.calculate_iou(pred, gt)
+            if (iou >= iou_threshold) and (iou >= max_iou):
+                max_iou = iou
+                match = gt
+        if max_iou > 0 and match is not None:
+            pred_matches.append(pred)
+            gt_matches.append(match)
+    return np.array(pred_matches), np.array(gt_matches)
+
+
+def reference_calculate_individual_image_result(prediction_boxes, gt_boxes, iou_threshold):
+    _, gt_matched = reference_get_all_box_matches(prediction_boxes, gt_boxes, iou_threshold)
+    true_pos = np.unique(gt_matched, axis=0).shape[0] if len(gt_matched) else 0
+    return {
+        "true_pos": true_pos,
+        "false_pos": prediction_boxes.shape[0] - true_pos,
+        "false_neg": gt_boxes.shape[0] - true_pos,
+    }
+
+
+def reference_get_precision_recall_curve(all_prediction_boxes, all_gt_boxes, confidence_scores, iou_threshold):
+    precisions = []
+    recalls = []
+    for ct in np.linspace(0, 1, 500):
+        true_pos = false_pos = false_neg = 0
+        for prediction_boxes, gt_boxes, scores in zip(all_prediction_boxes, all_gt_boxes, confidence_scores):
+            res = reference_calculate_individual_image_result(
+                prediction_boxes[scores >= ct, :], gt_boxes, iou_threshold)
+            true_pos += res["true_pos"]
+            false_pos += res["false_pos"]
+            false_neg += res["false_neg"]
+        precisions.append(task2.calculate_precision(true_pos, false_pos, false_neg))
+        recalls.append(task2.calculate_recall(true_pos, false_pos, false_neg))
+    return np.array(precisions), np.array(recalls)
+
+
+def reference_calculate_mean_average_precision(precisions, recalls):
+    recall_levels = np.round(np.linspace(0, 1.0, 11), decimals=14)
+    prec_values = []
+    for level in recall_levels:
+        prec = [p for p, r in zip(precisions, recalls) if r >= level]
+        prec_values.append(max(prec) if prec else 0)
+    return np.mean(prec_values)
+
+
+def generate_dataset(num_images, mean_gt_per_image=2, false_positive_rate=1.0,
+                     miss_rate=0.1, image_size=1000, seed=0):
+    """Generates random ground truth boxes and jittered predictions with scores.
+       Every ground truth box is detected with probability 1 - miss_rate, by a box
+       jittered proportionally to its size. On top come on average
+       false_positive_rate random boxes per image. Detections get higher scores
+       the less they are jittered.
+
+    Returns:
+        ground_truth_boxes, predicted_boxes: box_store.BoxStore
+    """
+    rng = np.random.default_rng(seed)
+    image_ids = ["img_{:07d}.png".format(i) for i in range(num_images)]
+
+    def random_boxes(num_boxes):
+        size = rng.uniform(10, 150, (num_boxes, 2))
+        xy = rng.uniform(0, image_size, (num_boxes, 2)) - size / 2
+        return np.hstack([xy, xy + size]).astype(np.float32)
+
+    num_gt = rng.poisson(mean_gt_per_image - 1, num_images) + 1
+    gt_offsets = np.concatenate([[0], np.cumsum(num_gt)])
+    gt_boxes = random_boxes(gt_offsets[-1])
+    gt_image = np.repeat(np.arange(num_images), num_gt)
+
+    detected = rng.random(len(gt_boxes)) >= miss_rate
+    jitter = rng.normal(0, 0.1, (detected.sum(), 4))
+    size = np.tile(gt_boxes[detected, 2:] - gt_boxes[detected, :2], 2)
+    true_boxes = gt_boxes[detected] + (jitter * size).astype(np.float32)
+    true_scores = np.clip(1 - np.abs(jitter).mean(axis=1) * 4 + rng.normal(0, 0.1, len(jitter)), 0, 1)
+
+    num_false = rng.poisson(false_positive_rate, num_images)
+    false_boxes = random_boxes(num_false.sum())
+    false_scores = rng.beta(1, 4, len(false_boxes))
+
+    pred_image = np.concatenate([gt_image[detected], np.repeat(np.arange(num_images), num_false)])
+    order = np.argsort(pred_image, kind="stable")
+    pred_boxes = np.concatenate([true_boxes, false_boxes])[order]
+    pred_scores = np.concatenate([true_scores, false_scores]).astype(np.float32)[order]
+    pred_offsets = np.concatenate([[0], np.cumsum(np.bincount(pred_image, minlength=num_images))])
+
+    return (BoxStore(image_ids, gt_boxes, None, gt_offsets),
+            BoxStore(image_ids, pred_boxes, pred_scores, pred_offsets))
+
+
+def load_eval_detection_voc():
+    """Imports SSD's eval_detection_voc straight from its file, so the dataset
+       packages (and their dependencies) of ssd.data are not needed."""
+    spec = importlib.util.spec_from_file_location("eval_detection_voc", SSD_EVAL_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.eval_detection_voc
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark(num_images, max_reference_images, iou_threshold=0.5, seed=0):
+    """Times every step of the evaluation on num_images generated images.
+       The reference implementations are only run on the first
+       max_reference_images images, and their time is scaled up linearly.
+
+    Returns:
+        dict with the timings in seconds, and the resulting mAPs
+    """
+    ground_truth_boxes, predicted_boxes = generate_dataset(num_images, seed=seed)
+    all_gt_boxes, all_prediction_boxes, confidence_scores = task2.collect_boxes(
+        ground_truth_boxes, predicted_boxes)
+    num_reference = min(num_images, max_reference_images)
+    reference_scale = num_images / num_reference
+    reference = (all_prediction_boxes[:num_reference], all_gt_boxes[:num_reference],
+                 confidence_scores[:num_reference])
+    results = dict(num_images=num_images, num_gt_boxes=len(ground_truth_boxes.boxes),
+                   num_predicted_boxes=len(predicted_boxes.boxes),
+                   num_reference_images=num_reference, timings={}, map={})
+
+    def record(name, reference_time, vectorized_time):
+        results["timings"][name] = dict(
+            reference_s=reference_time * reference_scale if reference_time is not None else None,
+            vectorized_s=vectorized_time,
+            speedup=reference_time * reference_scale / vectorized_time if reference_time is not None else None)
+
+    def all_pairs_scalar_iou(all_prediction_boxes, all_gt_boxes):
+        for prediction_boxes, gt_boxes in zip(all_prediction_boxes, all_gt_boxes):
+            for pred in prediction_boxes:
+                for gt in gt_boxes:
+                    task2.calculate_iou(pred, gt)
+
+    def all_iou_matrices(all_prediction_boxes, all_gt_boxes):
+        for prediction_boxes, gt_boxes in zip(all_prediction_boxes, all_gt_boxes):
+            task2.calculate_iou_matrix(prediction_boxes, gt_boxes)
+
+    def all_matches(get_result, all_prediction_boxes, all_gt_boxes):
+        for prediction_boxes, gt_boxes in zip(all_prediction_boxes, all_gt_boxes):
+            get_result(prediction_boxes, gt_boxes, iou_threshold)
+
+    reference_time, _ = timed(all_pairs_scalar_iou, *reference[:2])
+    vectorized_time, _ = timed(all_iou_matrices, all_prediction_boxes, all_gt_boxes)
+    record("calculate_iou", reference_time, vectorized_time)
+
+    reference_time, _ = timed(all_matches, reference_calculate_individual_image_result, *reference[:2])
+    vectorized_time, _ = timed(all_matches, task2.calculate_individual_image_result,
+                               all_prediction_boxes, all_gt_boxes)
+    record("matching", reference_time, vectorized_time)
+
+    reference_time, (reference_precisions, reference_recalls) = timed(
+        reference_get_precision_recall_curve, *reference, iou_threshold)
+    vectorized_time, (precisions, recalls) = timed(
+        task2.get_precision_recall_curve, all_prediction_boxes, all_gt_boxes, confidence_scores, iou_threshold)
+    record("precision_recall_curve", reference_time, vectorized_time)
+
+    reference_time, _ = timed(reference_calculate_mean_average_precision, reference_precisions, reference_recalls)
+    vectorized_time, results["map"]["task2"] = timed(
+        task2.calculate_mean_average_precision, precisions, recalls)
+    record("mean_average_precision", reference_time, vectorized_time)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        vectorized_time, (results["map"]["task2_iou_0.5:0.95"], _) = timed(
+            task2.mean_average_precision_over_thresholds, ground_truth_boxes, predicted_boxes)
+    record("mean_average_precision_iou_0.5:0.95", None, vectorized_time)
+
+    # SSD evaluation of the same boxes, as a single class with the VOC 2007 11-point metric
+    eval_detection_voc = load_eval_detection_voc()
+    labels = [np.ones(len(boxes), dtype=int) for boxes in all_prediction_boxes]
+    gt_labels = [np.ones(len(boxes), dtype=int) for boxes in all_gt_boxes]
+    vectorized_time, voc_result = timed(
+        lambda: eval_detection_voc(all_prediction_boxes, labels, confidence_scores,
+                                   all_gt_boxes, gt_labels, iou_thresh=iou_threshold, use_07_metric=True))
+    record("ssd_eval_detection_voc", None, vectorized_time)
+    results["map"]["ssd_eval_detection_voc"] = float(voc_result["map"])
+    results["map"]["task2"] = float(results["map"]["task2"])
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Times the task2 evaluation functions on generated datasets")
+    parser.add_argument("--num-images", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--max-reference-images", type=int, default=100,
+                        help="number of images the (slow) reference implementations are timed on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    all_results = dict(
+        numpy_version=np.__version__,
+        python_version=platform.python_version(),
+        processor=platform.processor() or platform.machine(),
+        results=[]
+    )
+    print("{:>10} {:<38} {:>14} {:>14} {:>9}".format(
+        "Images", "Step", "Reference (s)", "Vectorized (s)", "Speedup"))
+    for num_images in args.num_images:
+        results = benchmark(num_images, args.max_reference_images, seed=args.seed)
+        for name, timing in results["timings"].items():
+            reference = "{:14.3f}".format(timing["reference_s"]) if timing["reference_s"] is not None else "{:>14}".format("-")
+            speedup = "{:8.1f}x".format(timing["speedup"]) if timing["speedup"] is not None else "{:>9}".format("-")
+            print("{:>10} {:<38} {} {:14.3f} {}".format(num_images, name, reference, timing["vectorized_s"], speedup))
+        print("{:>10} mAP: {}".format(num_images, json.dumps(results["map"])))
+        all_results["results"].append(results)
+        # Written after every size, so the results so far survive an interrupted run
+        with open(args.output, "w") as fp:
+            json.dump(all_results, fp, indent=4)
+    print("Results written to: {}".format(args.output))
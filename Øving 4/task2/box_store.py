@@ -0,0 +1,172 @@
+"""
+Columnar storage of the boxes in predicted_boxes.json / ground_truth_boxes.json,
+read with a streaming JSON parser and cached as a .npz file next to the JSON file.
+"""
+
+import array
+import json
+import numpy as np
+import os
+
+
+class BoxStore:
+    """Columnar store of the boxes (and scores) of many images.
+       The boxes of all images are kept in one flat float32 array, and the boxes
+       of image i are boxes[offsets[i]:offsets[i+1]].
+
+    Attributes:
+        image_ids: (list of str) the image ids, in file order
+        boxes: (np.array of float32) shape: [total number of boxes, 4].
+            Each row includes [xmin, ymin, xmax, ymax]
+        scores: (np.array of float32) shape: [total number of boxes],
+            or None for ground truth boxes
+        offsets: (np.array of int64) shape: [number of images + 1]
+    """
+
+    def __init__(self, image_ids, boxes, scores, offsets):
+        self.image_ids = list(image_ids)
+        self.boxes = boxes
+        self.scores = scores
+        self.offsets = offsets
+        self.index = {image_id: i for i, image_id in enumerate(self.image_ids)}
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def get_boxes(self, image_id):
+        i = self.index[image_id]
+        return self.boxes[self.offsets[i]:self.offsets[i+1]]
+
+    def get_scores(self, image_id):
+        i = self.index[image_id]
+        return self.scores[self.offsets[i]:self.offsets[i+1]]
+
+    def save_npz(self, filepath, source_stat=None):
+        """Saves the store as a .npz file. The file is written under a temporary
+           name first, so an interrupted run never leaves a broken file behind.
+
+        Args:
+            source_stat: (os.stat_result) of the JSON file the store was read from,
+                used to detect a stale sidecar (see read_box_store)
+        """
+        arrays = dict(image_ids=np.array(self.image_ids, dtype=str),
+                      boxes=self.boxes, offsets=self.offsets)
+        if self.scores is not None:
+            arrays["scores"] = self.scores
+        if source_stat is not None:
+            arrays["source_stat"] = np.array([source_stat.st_size, source_stat.st_mtime_ns])
+        tmp_filepath = filepath + ".tmp.npz"
+        try:
+            np.savez(tmp_filepath, **arrays)
+            os.replace(tmp_filepath, filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+
+    @staticmethod
+    def load_npz(filepath):
+        """Returns the store saved with save_npz, and the saved source_stat (or None)"""
+        with np.load(filepath, allow_pickle=False) as data:
+            store = BoxStore(data["image_ids"].tolist(), data["boxes"],
+                             data["scores"] if "scores" in data else None, data["offsets"])
+            source_stat = tuple(data["source_stat"].tolist()) if "source_stat" in data else None
+        return store, source_stat
+
+
+def iterate_json_object(filepath, chunk_size=1 << 20):
+    """Streams the (key, value) pairs of the top-level JSON object in filepath.
+       The file is read in chunks and only one value is decoded at a time,
+       so the memory use does not grow with the file size.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+    with open(filepath, "r") as to_read:
+        buffer = ""
+        position = 0
+        end_of_file = False
+
+        def skip(characters):
+            nonlocal buffer, position, end_of_file
+            while True:
+                while position < len(buffer) and buffer[position] in characters:
+                    position += 1
+                if position < len(buffer) or end_of_file:
+                    return
+                buffer = to_read.read(chunk_size)
+                position = 0
+                end_of_file = len(buffer) < chunk_size
+
+        def decode():
+            nonlocal buffer, position, end_of_file
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    # A number at the end of the buffer may continue in the next chunk
+                    if end < len(buffer) or end_of_file:
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    if end_of_file:
+                        raise
+                chunk = to_read.read(chunk_size)
+                end_of_file = len(chunk) < chunk_size
+                buffer = buffer[position:] + chunk
+                position = 0
+
+        skip(whitespace)
+        assert buffer[position:position+1] == "{", "Expected a JSON object in: {}".format(filepath)
+        position += 1
+        while True:
+            skip(whitespace + ",")
+            if buffer[position:position+1] == "}" or position >= len(buffer):
+                return
+            key = decode()
+            skip(whitespace + ":")
+            value = decode()
+            yield key, value
+
+
+def read_box_store(filepath, cache=True):
+    """Reads a predicted_boxes.json or ground_truth_boxes.json style file into a BoxStore,
+       with a streaming parser. If cache is set, the store is also saved as a .npz
+       sidecar next to the JSON file, which later calls load instead, as long as
+       the JSON file is unchanged. If the sidecar can not be written, for example
+       in a read-only directory, the store is returned without caching it.
+    """
+    assert os.path.isfile(filepath), "Did not find filepath. \
+                     I looked in: {}".format(os.path.abspath(filepath))
+    source_stat = os.stat(filepath)
+    npz_filepath = os.path.splitext(filepath)[0] + ".npz"
+    if cache and os.path.isfile(npz_filepath):
+        store, cached_stat = BoxStore.load_npz(npz_filepath)
+        if cached_stat == (source_stat.st_size, source_stat.st_mtime_ns):
+            return store
+
+    image_ids = []
+    boxes = array.array("f")
+    scores = array.array("f")
+    offsets = array.array("q", [0])
+    has_scores = False
+    for image_id, value in iterate_json_object(filepath):
+        if isinstance(value, dict):
+            has_scores = True
+            assert len(value["scores"]) == len(value["boxes"])
+            scores.extend(value["scores"])
+            value = value["boxes"]
+        for box in value:
+            assert len(box) == 4
+            boxes.extend(box)
+        image_ids.append(image_id)
+        offsets.append(offsets[-1] + len(value))
+
+    store = BoxStore(
+        image_ids,
+        np.frombuffer(boxes, dtype=np.float32).reshape(-1, 4),
+        np.frombuffer(scores, dtype=np.float32) if has_scores else None,
+        np.frombuffer(offsets, dtype=np.int64))
+    if cache:
+        try:
+            store.save_npz(npz_filepath, source_stat)
+        except OSError as error:
+            print("Could not cache the boxes in {}: {}".format(npz_filepath, error))
+    return store
@@ -1,6 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from tools import read_predicted_boxes, read_ground_truth_boxes
+from box_store import read_box_store, BoxStore
 
 
 def calculate_iou(prediction_box, gt_box):
@@ -37,6 +37,41 @@ def calculate_iou(prediction_box, gt_box):
     return iou
 
 
+def calculate_iou_matrix(prediction_boxes, gt_boxes):
+    """Calculate intersection over union of every predicted and ground truth box pair.
+        The IoUs of all pairs are computed at once by broadcasting.
+
+    Args:
+        prediction_boxes (np.array of floats): location of predicted objects
+            with shape: [number of predicted boxes, 4].
+            Each row includes [xmin, ymin, xmax, ymax]
+        gt_boxes (np.array of floats): location of ground truth objects
+            with shape: [number of ground truth boxes, 4].
+            Each row includes [xmin, ymin, xmax, ymax]
+
+        returns:
+            np.array of floats with shape [number of predicted boxes, number of ground truth boxes],
+            where element [i, j] is the IoU of predicted box i and ground truth box j.
+    """
+    # Empty inputs (e.g. np.array([])) become arrays of shape [0, 4]
+    prediction_boxes = np.asarray(prediction_boxes, dtype=float).reshape(-1, 4)
+    gt_boxes = np.asarray(gt_boxes, dtype=float).reshape(-1, 4)
+    pred = prediction_boxes[:, None, :]
+    gt = gt_boxes[None, :, :]
+
+    # Compute intersection
+    x_int = np.minimum(pred[..., 2], gt[..., 2]) - np.maximum(pred[..., 0], gt[..., 0])
+    y_int = np.minimum(pred[..., 3], gt[..., 3]) - np.maximum(pred[..., 1], gt[..., 1])
+    intersection = np.maximum(x_int, 0) * np.maximum(y_int, 0)
+
+    # Compute union
+    pred_area = (prediction_boxes[:, 2] - prediction_boxes[:, 0]) * (prediction_boxes[:, 3] - prediction_boxes[:, 1])
+    gt_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
+    union = pred_area[:, None] + gt_area[None, :] - intersection
+
+    return intersection / union
+
+
 def calculate_precision(num_tp, num_fp, num_fn):
     """ Calculates the precision for the given parameters.
         Returns 1 if num_tp + num_fp = 0
@@ -73,6 +108,37 @@ def calculate_recall(num_tp, num_fp, num_fn):
     return recall
 
 
+def match_boxes(iou_matrix, iou_threshold):
+    """Greedy one-to-one matching of predicted and ground truth boxes in decreasing IoU order.
+        All pairs with IoU >= iou_threshold are sorted by decreasing IoU, and a pair
+        is matched if neither of its boxes has been matched before.
+
+    Args:
+        iou_matrix: (np.array of floats): IoU of every predicted / ground truth box pair
+            with shape: [number of predicted boxes, number of ground truth boxes]
+            (see calculate_iou_matrix)
+        iou_threshold (float): minimum IoU of a match
+    Returns:
+        pred_indices, gt_indices: (np.array of ints) indices of the matched
+            predicted and ground truth boxes, in decreasing IoU order.
+    """
+    pred_candidates, gt_candidates = np.nonzero(iou_matrix >= iou_threshold)
+    # Stable sort, so equal IoUs are matched in row-major order
+    order = np.argsort(-iou_matrix[pred_candidates, gt_candidates], kind="stable")
+    pred_used = np.zeros(iou_matrix.shape[0], dtype=bool)
+    gt_used = np.zeros(iou_matrix.shape[1], dtype=bool)
+    pred_indices = []
+    gt_indices = []
+    for pred, gt in zip(pred_candidates[order].tolist(), gt_candidates[order].tolist()):
+        if pred_used[pred] or gt_used[gt]:
+            continue
+        pred_used[pred] = True
+        gt_used[gt] = True
+        pred_indices.append(pred)
+        gt_indices.append(gt)
+    return np.array(pred_indices, dtype=int), np.array(gt_indices, dtype=int)
+
+
 def get_all_box_matches(prediction_boxes, gt_boxes, iou_threshold):
     """Finds all possible matches for the predicted boxes to the ground truth boxes.
         No bounding box can have more than one match.
@@ -93,24 +159,12 @@ def get_all_box_matches(prediction_boxes, gt_boxes, iou_threshold):
             objects with shape: [number of box matches, 4].
             Each row includes [xmin, ymin, xmax, ymax]
     """
+    prediction_boxes = np.asarray(prediction_boxes).reshape(-1, 4)
+    gt_boxes = np.asarray(gt_boxes).reshape(-1, 4)
+    iou_matrix = calculate_iou_matrix(prediction_boxes, gt_boxes)
+    pred_indices, gt_indices = match_boxes(iou_matrix, iou_threshold)
 
-    pred_matches = []
-    gt_matches = []
-    
-    #Find best gt match for each pred box by iou
-    for pred in prediction_boxes:
-        max_iou = 0
-        match = None
-        for gt in gt_boxes:
-            iou = calculate_iou(pred, gt)
-            if (iou >= iou_threshold) and (iou >= max_iou):
-                max_iou = iou
-                match = gt
-        if max_iou > 0 and match is not None:
-            pred_matches.append(pred)
-            gt_matches.append(match)
-    
-    return np.array(pred_matches), np.array(gt_matches)
+    return prediction_boxes[pred_indices], gt_boxes[gt_indices]
 
 def calculate_individual_image_result(prediction_boxes, gt_boxes, iou_threshold):
     """Given a set of prediction boxes and ground truth boxes,
@@ -129,14 +183,14 @@ def calculate_individual_image_result(prediction_boxes, gt_boxes, iou_threshold)
         dict: containing true positives, false positives, true negatives, false negatives
             {"true_pos": int, "false_pos": int, false_neg": int}
     """
-    _, gt_matched = get_all_box_matches(prediction_boxes, gt_boxes, iou_threshold)
+    iou_matrix = calculate_iou_matrix(prediction_boxes, gt_boxes)
+    pred_indices, _ = match_boxes(iou_matrix, iou_threshold)
 
     #Number of predictions and and gt boxes to predict
-    positives = prediction_boxes.shape[0]
-    relevant = gt_boxes.shape[0]
+    positives, relevant = iou_matrix.shape
 
-    #Number of detected gt boxes
-    true_pos = np.unique(gt_matched, axis = 0).shape[0]
+    #Number of detected gt boxes, every match is one-to-one
+    true_pos = len(pred_indices)
 
     res = {}
     res["true_pos"] = true_pos
@@ -184,6 +238,118 @@ def calculate_precision_recall_all_images(
     return (precision, recall)
 
 
+def get_true_positives_all_thresholds(prediction_boxes, gt_boxes, scores, iou_thresholds):
+    """Matches the predicted boxes of a single image in decreasing confidence order,
+       for several IoU thresholds at once: at every threshold, each prediction is
+       matched to the unmatched ground truth box it has the highest IoU with,
+       if that IoU is >= the threshold.
+       Because of the confidence order, the matches of the predictions above any
+       confidence threshold are the same as when matching only those predictions.
+       The IoU matrix is computed once and every prediction is matched at all
+       thresholds in one vectorized step.
+
+    Args:
+        prediction_boxes: (np.array of floats): list of predicted bounding boxes
+            shape: [number of predicted boxes, 4].
+            Each row includes [xmin, ymin, xmax, ymax]
+        gt_boxes: (np.array of floats): list of bounding boxes ground truth
+            objects with shape: [number of ground truth boxes, 4].
+            Each row includes [xmin, ymin, xmax, ymax]
+        scores: (np.array of floats): confidence score of every predicted box
+            Shape: [number of predicted boxes]
+        iou_thresholds: (np.array of floats) Shape: [number of thresholds]
+    Returns:
+        np.array of bools: element [t, i] is True if predicted box i is a
+            true positive at iou_thresholds[t].
+            Shape: [number of thresholds, number of predicted boxes]
+    """
+    iou_thresholds = np.asarray(iou_thresholds, dtype=float)
+    iou_matrix = calculate_iou_matrix(prediction_boxes, gt_boxes)
+    num_thresholds = len(iou_thresholds)
+    is_true_pos = np.zeros((num_thresholds, iou_matrix.shape[0]), dtype=bool)
+    gt_used = np.zeros((num_thresholds, iou_matrix.shape[1]), dtype=bool)
+    # Predictions without any ground truth box above the lowest threshold can never match
+    has_candidate = (iou_matrix >= iou_thresholds.min(initial=np.inf)).any(axis=1)
+    thresholds = np.arange(num_thresholds)
+    for pred in np.argsort(-np.asarray(scores), kind="stable"):
+        if not has_candidate[pred]:
+            continue
+        ious = np.where(gt_used, -1, iou_matrix[pred][None, :])
+        gt = np.argmax(ious, axis=1)
+        matched = ious[thresholds, gt] >= iou_thresholds
+        gt_used[thresholds[matched], gt[matched]] = True
+        is_true_pos[:, pred] = matched
+    return is_true_pos
+
+
+def get_true_positives(prediction_boxes, gt_boxes, scores, iou_threshold):
+    """Matches the predicted boxes of a single image in decreasing confidence order
+       (see get_true_positives_all_thresholds).
+
+    Returns:
+        np.array of bools: True for every predicted box that is a true positive.
+            Shape: [number of predicted boxes]
+    """
+    return get_true_positives_all_thresholds(prediction_boxes, gt_boxes, scores, [iou_threshold])[0]
+
+
+def get_exact_precision_recall_curves(
+    all_prediction_boxes, all_gt_boxes, confidence_scores, iou_thresholds
+):
+    """Calculates the precision and recall over all images at every distinct
+       confidence score, for every IoU threshold. Every image is matched once
+       (see get_true_positives_all_thresholds), then all predictions are sorted
+       by decreasing score and the true and false positives are summed cumulatively.
+
+    Args:
+        all_prediction_boxes, all_gt_boxes, confidence_scores: see get_precision_recall_curve
+        iou_thresholds: (np.array of floats) Shape: [number of thresholds]
+    Returns:
+        scores, precisions, recalls: scores has shape [number of distinct scores],
+            precisions and recalls have shape [number of thresholds, number of distinct scores].
+            precisions[t, i] and recalls[t, i] are the precision and recall at
+            iou_thresholds[t] when keeping the predictions with confidence >= scores[i].
+            scores is sorted in decreasing order.
+    """
+    num_thresholds = len(iou_thresholds)
+    num_gt = sum(len(gt_boxes) for gt_boxes in all_gt_boxes)
+    is_true_pos = [
+        get_true_positives_all_thresholds(prediction_boxes, gt_boxes, scores, iou_thresholds)
+        for prediction_boxes, gt_boxes, scores
+        in zip(all_prediction_boxes, all_gt_boxes, confidence_scores)
+    ]
+    scores = np.concatenate([np.asarray(s, dtype=float) for s in confidence_scores] + [np.zeros(0)])
+    is_true_pos = np.concatenate(is_true_pos + [np.zeros((num_thresholds, 0), dtype=bool)], axis=1)
+
+    order = np.argsort(-scores, kind="stable")
+    scores = scores[order]
+    true_pos = np.cumsum(is_true_pos[:, order], axis=1)
+    num_predictions = np.arange(1, len(scores) + 1)
+
+    # Equal scores are kept or dropped together, so only the last of them is a point on the curve
+    last_of_score = np.append(scores[1:] != scores[:-1], True)[:len(scores)]
+    precisions = true_pos / num_predictions
+    recalls = true_pos / num_gt if num_gt > 0 else np.zeros_like(precisions)
+    return scores[last_of_score], precisions[:, last_of_score], recalls[:, last_of_score]
+
+
+def get_exact_precision_recall_curve(
+    all_prediction_boxes, all_gt_boxes, confidence_scores, iou_threshold
+):
+    """Calculates the precision and recall over all images at every distinct
+       confidence score (see get_exact_precision_recall_curves).
+
+    Returns:
+        scores, precisions, recalls: three np.ndarray with same shape.
+            precisions[i] and recalls[i] are the precision and recall when
+            keeping the predictions with confidence >= scores[i].
+            scores is sorted in decreasing order.
+    """
+    scores, precisions, recalls = get_exact_precision_recall_curves(
+        all_prediction_boxes, all_gt_boxes, confidence_scores, [iou_threshold])
+    return scores, precisions[0], recalls[0]
+
+
 def get_precision_recall_curve(
     all_prediction_boxes, all_gt_boxes, confidence_scores, iou_threshold
 ):
@@ -214,21 +380,16 @@ def get_precision_recall_curve(
     # curve, we will use an approximation
     confidence_thresholds = np.linspace(0, 1, 500)
     # YOUR CODE 
-    precisions = [] 
-    recalls = []
-    
-    for ct in confidence_thresholds:
-        conf_pred_boxes = [] 
-        #Finding all pred boxes above confidence threshold
-        for i in range(len(confidence_scores)):
-            conf_pred_boxes.append(all_prediction_boxes[i][confidence_scores[i] >= ct,:])
-        
-        #Calculating prec and recall for confident predictions
-        pr = calculate_precision_recall_all_images(conf_pred_boxes, all_gt_boxes, iou_threshold)
-        precisions.append(pr[0])
-        recalls.append(pr[1])
+    scores, exact_precisions, exact_recalls = get_exact_precision_recall_curve(
+        all_prediction_boxes, all_gt_boxes, confidence_scores, iou_threshold)
+
+    #Number of distinct scores >= each threshold, i.e. the index into the exact curve
+    num_points = np.searchsorted(-scores, -confidence_thresholds, side="right")
+    #Without any predictions, precision is 1 and recall 0 (see calculate_precision/recall)
+    precisions = np.append(1.0, exact_precisions)[num_points]
+    recalls = np.append(0.0, exact_recalls)[num_points]
 
-    return np.array(precisions), np.array(recalls)
+    return precisions, recalls
 
 
 def plot_precision_recall_curve(precisions, recalls):
@@ -266,16 +427,45 @@ def calculate_mean_average_precision(precisions, recalls):
     recall_levels = np.round(np.linspace(0, 1.0, 11), decimals = 14)
     # YOUR CODE HERE
     
-    prec_values = []
-    for level in recall_levels:
-        #Fetching maximum precision for every (p,r) pair 
-        #where recalls is above current threshold
-        prec = [p for p,r in zip(precisions, recalls) if r >= level]
-        prec_values.append(max(prec) if prec else 0)
-        
+    order = np.argsort(recalls, kind="stable")
+    recalls = np.asarray(recalls)[order]
+    precisions = np.asarray(precisions)[order]
+    #Monotone envelope: the maximum precision at this or any higher recall.
+    #A precision of 0 is appended for recall levels above the highest recall
+    envelope = np.append(np.maximum.accumulate(precisions[::-1])[::-1], 0)
+    prec_values = envelope[np.searchsorted(recalls, recall_levels, side="left")]
+
     return np.mean(prec_values)
 
 
+def collect_boxes(ground_truth_boxes, predicted_boxes):
+    """ Collects the boxes of every image, in the order of ground_truth_boxes
+        (see mean_average_precision for the arguments)
+
+    Returns:
+        all_gt_boxes, all_prediction_boxes, confidence_scores:
+            lists with one np.array per image
+    """
+    all_gt_boxes = []
+    all_prediction_boxes = []
+    confidence_scores = []
+
+    if isinstance(ground_truth_boxes, BoxStore):
+        for image_id in ground_truth_boxes.image_ids:
+            all_gt_boxes.append(ground_truth_boxes.get_boxes(image_id))
+            all_prediction_boxes.append(predicted_boxes.get_boxes(image_id))
+            confidence_scores.append(predicted_boxes.get_scores(image_id))
+    else:
+        for image_id in ground_truth_boxes.keys():
+            pred_boxes = predicted_boxes[image_id]["boxes"]
+            scores = predicted_boxes[image_id]["scores"]
+
+            all_gt_boxes.append(ground_truth_boxes[image_id])
+            all_prediction_boxes.append(pred_boxes)
+            confidence_scores.append(scores)
+    return all_gt_boxes, all_prediction_boxes, confidence_scores
+
+
 def mean_average_precision(ground_truth_boxes, predicted_boxes):
     """ Calculates the mean average precision over the given dataset
         with IoU threshold of 0.5
@@ -292,19 +482,12 @@ def mean_average_precision(ground_truth_boxes, predicted_boxes):
                 "scores": (np.array of float). Shape: [number of pred boxes]
             }
         }
+        Both can also be a box_store.BoxStore (see read_box_store), the boxes of
+        every image are then used as views into the flat arrays of the store.
     """
     # DO NOT EDIT THIS CODE
-    all_gt_boxes = []
-    all_prediction_boxes = []
-    confidence_scores = []
-
-    for image_id in ground_truth_boxes.keys():
-        pred_boxes = predicted_boxes[image_id]["boxes"]
-        scores = predicted_boxes[image_id]["scores"]
-
-        all_gt_boxes.append(ground_truth_boxes[image_id])
-        all_prediction_boxes.append(pred_boxes)
-        confidence_scores.append(scores)
+    all_gt_boxes, all_prediction_boxes, confidence_scores = collect_boxes(
+        ground_truth_boxes, predicted_boxes)
 
     precisions, recalls = get_precision_recall_curve(
         all_prediction_boxes, all_gt_boxes, confidence_scores, 0.5)
@@ -313,7 +496,40 @@ def mean_average_precision(ground_truth_boxes, predicted_boxes):
     print("Mean average precision: {:.4f}".format(mean_average_precision))
 
 
+def mean_average_precision_over_thresholds(ground_truth_boxes, predicted_boxes,
+                                           iou_thresholds=np.round(np.linspace(0.5, 0.95, 10), 2)):
+    """ Calculates the mean average precision at every IoU threshold, and
+        their mean: mAP@[.5:.95] with the default thresholds.
+        The IoU matrix of every image is computed once and matched at all
+        thresholds together (see get_exact_precision_recall_curves), so this
+        costs about as much as a single mean_average_precision.
+        The average precision of every threshold uses the 11-point interpolation
+        of calculate_mean_average_precision on the exact precision recall curve.
+
+    Args:
+        ground_truth_boxes, predicted_boxes: see mean_average_precision
+        iou_thresholds: (np.array of floats)
+    Returns:
+        float, np.array of floats: the mean over all thresholds, and the
+            mean average precision of every threshold
+    """
+    all_gt_boxes, all_prediction_boxes, confidence_scores = collect_boxes(
+        ground_truth_boxes, predicted_boxes)
+    _, precisions, recalls = get_exact_precision_recall_curves(
+        all_prediction_boxes, all_gt_boxes, confidence_scores, iou_thresholds)
+    average_precisions = np.array([
+        calculate_mean_average_precision(precisions[t], recalls[t])
+        for t in range(len(iou_thresholds))
+    ])
+    for iou_threshold, average_precision in zip(iou_thresholds, average_precisions):
+        print("Mean average precision @ IoU {:.2f}: {:.4f}".format(iou_threshold, average_precision))
+    print("Mean average precision @ IoU [{:.2f}:{:.2f}]: {:.4f}".format(
+        iou_thresholds[0], iou_thresholds[-1], average_precisions.mean()))
+    return average_precisions.mean(), average_precisions
+
+
 if __name__ == "__main__":
-    ground_truth_boxes = read_ground_truth_boxes()
-    predicted_boxes = read_predicted_boxes()
+    ground_truth_boxes = read_box_store("ground_truth_boxes.json")
+    predicted_boxes = read_box_store("predicted_boxes.json")
     mean_average_precision(ground_truth_boxes, predicted_boxes)
+    mean_average_precision_over_thresholds(ground_truth_boxes, predicted_boxes)
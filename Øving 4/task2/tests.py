@@ -1,5 +1,9 @@
 from task2 import *
+from box_store import iterate_json_object
+import json
 import numpy as np
+import os
+import tempfile
 
 
 def test_iou():
@@ -202,6 +206,281 @@ def test_mean_average_precision():
     assert round(res1, 5) == ans1, "Expected {}, got: {}".format(ans1, res1)
 
 
+def reference_iou_matrix(prediction_boxes, gt_boxes):
+    # Per box pair, with calculate_iou
+    iou_matrix = np.zeros((len(prediction_boxes), len(gt_boxes)))
+    for i, prediction_box in enumerate(prediction_boxes):
+        for j, gt_box in enumerate(gt_boxes):
+            iou_matrix[i, j] = calculate_iou(prediction_box, gt_box)
+    return iou_matrix
+
+
+def reference_match_boxes(iou_matrix, iou_threshold):
+    # Per box pair, in decreasing IoU order and row-major order for equal IoUs
+    pairs = [(iou_matrix[i, j], i, j)
+             for i in range(iou_matrix.shape[0]) for j in range(iou_matrix.shape[1])
+             if iou_matrix[i, j] >= iou_threshold]
+    pairs.sort(key=lambda pair: -pair[0])
+    pred_indices, gt_indices = [], []
+    for _, i, j in pairs:
+        if i not in pred_indices and j not in gt_indices:
+            pred_indices.append(i)
+            gt_indices.append(j)
+    return pred_indices, gt_indices
+
+
+def reference_true_positives(prediction_boxes, gt_boxes, scores, iou_threshold):
+    # Per predicted box, in decreasing confidence order: match the unmatched
+    # ground truth box with the highest IoU (the first one for equal IoUs)
+    is_true_pos = [False] * len(prediction_boxes)
+    gt_used = [False] * len(gt_boxes)
+    for i in sorted(range(len(prediction_boxes)), key=lambda i: -scores[i]):
+        best_iou, best_gt = -1, None
+        for j, gt_box in enumerate(gt_boxes):
+            iou = calculate_iou(prediction_boxes[i], gt_box)
+            if not gt_used[j] and iou > best_iou:
+                best_iou, best_gt = iou, j
+        if best_gt is not None and best_iou >= iou_threshold:
+            gt_used[best_gt] = True
+            is_true_pos[i] = True
+    return np.array(is_true_pos, dtype=bool)
+
+
+def random_boxes(rng, num_boxes, grid_size=6):
+    # Integer coordinates on a small grid, so many IoUs are exactly equal
+    corners = rng.integers(0, grid_size, size=(num_boxes, 2, 2))
+    corners.sort(axis=1)
+    corners[:, 1] += 1
+    return corners.transpose(0, 2, 1).reshape(-1, 4)[:, [0, 2, 1, 3]].astype(float)
+
+
+def test_vectorized_matching():
+    print("="*80)
+    print("Running tests for calculate_iou_matrix, match_boxes and get_true_positives_all_thresholds")
+    iou_thresholds = np.round(np.linspace(0.5, 0.95, 10), 2)
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        prediction_boxes = random_boxes(rng, rng.integers(0, 8))
+        gt_boxes = random_boxes(rng, rng.integers(0, 8))
+        scores = rng.integers(0, 4, size=len(prediction_boxes)) / 4
+
+        res = calculate_iou_matrix(prediction_boxes, gt_boxes)
+        ans = reference_iou_matrix(prediction_boxes, gt_boxes)
+        assert res.shape == ans.shape and np.all(res == ans), "Expected {}, got: {}".format(ans, res)
+
+        res = get_true_positives_all_thresholds(prediction_boxes, gt_boxes, scores, iou_thresholds)
+        for t, iou_threshold in enumerate(iou_thresholds):
+            pred_indices, gt_indices = match_boxes(ans, iou_threshold)
+            ans_pred, ans_gt = reference_match_boxes(ans, iou_threshold)
+            assert pred_indices.tolist() == ans_pred and gt_indices.tolist() == ans_gt,\
+                "Expected {}, got: {}".format((ans_pred, ans_gt), (pred_indices, gt_indices))
+            ans_true_pos = reference_true_positives(prediction_boxes, gt_boxes, scores, iou_threshold)
+            assert np.all(res[t] == ans_true_pos), "Expected {}, got: {}".format(ans_true_pos, res[t])
+
+    # Ties in IoU: both ground truth boxes have IoU 0.5 with the prediction, the first one is matched
+    prediction_boxes = np.array([[0, 0, 2, 2]])
+    gt_boxes = np.array([[0, 0, 1, 2], [1, 0, 2, 2]])
+    pred_indices, gt_indices = match_boxes(calculate_iou_matrix(prediction_boxes, gt_boxes), 0.5)
+    assert pred_indices.tolist() == [0] and gt_indices.tolist() == [0]
+    res = get_true_positives(prediction_boxes, gt_boxes, np.array([0.9]), 0.5)
+    assert res.tolist() == [True], "Expected [True], got: {}".format(res)
+    # Two equal predictions with equal scores: only the first one is a true positive
+    prediction_boxes = np.array([[0, 0, 1, 1], [0, 0, 1, 1]])
+    gt_boxes = np.array([[0, 0, 1, 1]])
+    pred_indices, gt_indices = match_boxes(calculate_iou_matrix(prediction_boxes, gt_boxes), 0.5)
+    assert pred_indices.tolist() == [0] and gt_indices.tolist() == [0]
+    res = get_true_positives(prediction_boxes, gt_boxes, np.array([0.5, 0.5]), 0.5)
+    assert res.tolist() == [True, False], "Expected [True, False], got: {}".format(res)
+
+    # Zero predictions or zero ground truth boxes
+    for prediction_boxes, gt_boxes in [(np.zeros((0, 4)), np.array([[0, 0, 1, 1]])),
+                                       (np.array([[0, 0, 1, 1]]), np.zeros((0, 4))),
+                                       (np.array([]), np.array([]))]:
+        num_pred, num_gt = len(prediction_boxes), len(gt_boxes)
+        iou_matrix = calculate_iou_matrix(prediction_boxes, gt_boxes)
+        assert iou_matrix.shape == (num_pred, num_gt), "Expected shape {}, got: {}".format(
+            (num_pred, num_gt), iou_matrix.shape)
+        pred_indices, gt_indices = match_boxes(iou_matrix, 0.5)
+        assert pred_indices.size == 0 and gt_indices.size == 0
+        res = get_true_positives_all_thresholds(prediction_boxes, gt_boxes, np.zeros(num_pred), iou_thresholds)
+        assert res.shape == (len(iou_thresholds), num_pred) and not res.any()
+
+    # An IoU exactly at the threshold is a match, just above it is not
+    prediction_boxes = np.array([[0, 0, 1, 1]])
+    gt_boxes = np.array([[0, 0, 1, 2]])
+    assert calculate_iou_matrix(prediction_boxes, gt_boxes)[0, 0] == 0.5
+    pred_indices, _ = match_boxes(calculate_iou_matrix(prediction_boxes, gt_boxes), 0.5)
+    assert pred_indices.tolist() == [0]
+    pred_indices, _ = match_boxes(calculate_iou_matrix(prediction_boxes, gt_boxes), np.nextafter(0.5, 1))
+    assert pred_indices.tolist() == []
+    res = get_true_positives_all_thresholds(prediction_boxes, gt_boxes, np.array([1.0]), [0.5, np.nextafter(0.5, 1)])
+    assert res.tolist() == [[True], [False]], "Expected [[True], [False]], got: {}".format(res.tolist())
+
+
+def reference_precision_recall_curve(all_prediction_boxes, all_gt_boxes, confidence_scores, iou_threshold):
+    # The thresholded curve: match the predictions above every sampled confidence threshold on their own
+    precisions, recalls = [], []
+    for confidence_threshold in np.linspace(0, 1, 500):
+        true_pos = false_pos = false_neg = 0
+        for prediction_boxes, gt_boxes, scores in zip(all_prediction_boxes, all_gt_boxes, confidence_scores):
+            keep = scores >= confidence_threshold
+            is_true_pos = reference_true_positives(prediction_boxes[keep], gt_boxes, scores[keep], iou_threshold)
+            true_pos += is_true_pos.sum()
+            false_pos += len(is_true_pos) - is_true_pos.sum()
+            false_neg += len(gt_boxes) - is_true_pos.sum()
+        precisions.append(calculate_precision(true_pos, false_pos, false_neg))
+        recalls.append(calculate_recall(true_pos, false_pos, false_neg))
+    return np.array(precisions), np.array(recalls)
+
+
+def test_exact_precision_recall_curve():
+    print("="*80)
+    print("Running tests for get_exact_precision_recall_curve")
+    confidence_thresholds = np.linspace(0, 1, 500)
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        all_prediction_boxes = [random_boxes(rng, rng.integers(0, 6)) for _ in range(4)]
+        all_gt_boxes = [random_boxes(rng, rng.integers(0, 6)) for _ in range(4)]
+        # Tied scores, and scores exactly at the sampled confidence thresholds
+        all_scores = [rng.choice(confidence_thresholds[::50], size=len(boxes)) for boxes in all_prediction_boxes]
+        for iou_threshold in [0.5, 0.75]:
+            res1, res2 = get_precision_recall_curve(all_prediction_boxes, all_gt_boxes, all_scores, iou_threshold)
+            ans1, ans2 = reference_precision_recall_curve(
+                all_prediction_boxes, all_gt_boxes, all_scores, iou_threshold)
+            assert np.allclose(res1, ans1), "Expected {}, got: {}".format(ans1, res1)
+            assert np.allclose(res2, ans2), "Expected {}, got: {}".format(ans2, res2)
+
+    # Every prediction overlaps at most one ground truth box here, so the curve is also
+    # the one of calculate_precision_recall_all_images at every confidence threshold
+    b1 = np.array([
+        [0, 0, 1, 1],
+        [0.5, 0.5, 1.5, 1.5],
+        [2, 2, 3, 3],
+        [5.5, 5.5, 8, 8]
+    ])
+    b2 = np.array([
+        [0, 0, 1, 1],
+        [0, 0, 1.5, 1.5],
+        [3, 3, 4, 4],
+        [5, 5, 8, 8]
+    ])
+    s = np.array([0.4, 0.7, 0.6, 0.9])
+    res1, res2 = get_precision_recall_curve([b1, b2], [b2, b2], [s, s], 0.5)
+    for i, confidence_threshold in enumerate(confidence_thresholds):
+        ans1, ans2 = calculate_precision_recall_all_images(
+            [b1[s >= confidence_threshold], b2[s >= confidence_threshold]], [b2, b2], 0.5)
+        assert res1[i] == ans1 and res2[i] == ans2, "Expected {}, got: {} at confidence {}".format(
+            (ans1, ans2), (res1[i], res2[i]), confidence_threshold)
+
+    # Tied scores are kept or dropped together, so they give one point on the exact curve
+    prediction_boxes = np.array([[0, 0, 1, 1], [5, 5, 6, 6], [2, 2, 3, 3]])
+    gt_boxes = np.array([[0, 0, 1, 1], [2, 2, 3, 3]])
+    scores = np.array([0.5, 0.5, 0.3])
+    res_scores, res1, res2 = get_exact_precision_recall_curve([prediction_boxes], [gt_boxes], [scores], 0.5)
+    assert res_scores.tolist() == [0.5, 0.3], "Expected [0.5, 0.3], got: {}".format(res_scores)
+    assert res1.tolist() == [1/2, 2/3], "Expected [1/2, 2/3], got: {}".format(res1)
+    assert res2.tolist() == [1/2, 1.0], "Expected [1/2, 1.0], got: {}".format(res2)
+
+
+def test_mean_average_precision_over_thresholds():
+    print("="*80)
+    print("Running tests for mean_average_precision_over_thresholds")
+    rng = np.random.default_rng(1)
+    ground_truth_boxes = {}
+    predicted_boxes = {}
+    for i in range(10):
+        gt_boxes = random_boxes(rng, rng.integers(0, 6))
+        ground_truth_boxes["image_{}".format(i)] = gt_boxes
+        # Noisy copies of the ground truth boxes, with IoUs spread over all thresholds, and false positives
+        prediction_boxes = np.concatenate([gt_boxes + rng.normal(0, 0.2, gt_boxes.shape),
+                                           random_boxes(rng, rng.integers(0, 3))])
+        predicted_boxes["image_{}".format(i)] = {"boxes": prediction_boxes,
+                                                 "scores": rng.random(len(prediction_boxes))}
+    all_gt_boxes = list(ground_truth_boxes.values())
+    all_prediction_boxes = [predicted_boxes[image_id]["boxes"] for image_id in ground_truth_boxes]
+    all_scores = [predicted_boxes[image_id]["scores"] for image_id in ground_truth_boxes]
+
+    iou_thresholds = np.round(np.linspace(0.5, 0.95, 10), 2)
+    ans2 = []
+    for iou_threshold in iou_thresholds:
+        _, precisions, recalls = get_exact_precision_recall_curve(
+            all_prediction_boxes, all_gt_boxes, all_scores, iou_threshold)
+        ans2.append(calculate_mean_average_precision(precisions, recalls))
+    ans1 = np.mean(ans2)
+    res1, res2 = mean_average_precision_over_thresholds(ground_truth_boxes, predicted_boxes)
+    assert np.allclose(res2, ans2), "Expected {}, got: {}".format(ans2, res2)
+    assert np.isclose(res1, ans1), "Expected {}, got: {}".format(ans1, res1)
+    assert ans2[0] > ans2[-1], "Expected a lower mAP at a higher IoU threshold, got: {}".format(ans2)
+
+    res1, res2 = mean_average_precision_over_thresholds(ground_truth_boxes, predicted_boxes, [0.5])
+    assert res2.shape == (1,) and res1 == res2[0] == ans2[0], "Expected {}, got: {}".format(ans2[0], res2)
+
+
+def test_iterate_json_object():
+    print("="*80)
+    print("Running tests for iterate_json_object")
+    data = {
+        "image_1": [[0, 0, 1, 1], [0.5, 0.25, 123456.789, 3e-05]],
+        "image_2": {"boxes": [[1, 2, 3, 4]], "scores": [0.75]},
+        "image_3": []
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "boxes.json")
+        with open(filepath, "w") as fp:
+            json.dump(data, fp, indent=2)
+        num_characters = os.path.getsize(filepath)
+        # Every chunk size splits the keys, numbers and separators at other positions
+        for chunk_size in range(1, num_characters + 2):
+            res = list(iterate_json_object(filepath, chunk_size))
+            ans = list(data.items())
+            assert res == ans, "Expected {}, got: {} (chunk_size={})".format(ans, res, chunk_size)
+
+        for text in ["{}", " {\n } "]:
+            with open(filepath, "w") as fp:
+                fp.write(text)
+            for chunk_size in [1, 2, 1 << 20]:
+                res = list(iterate_json_object(filepath, chunk_size))
+                assert res == [], "Expected no items in {!r}, got: {}".format(text, res)
+
+
+def test_read_box_store():
+    print("="*80)
+    print("Running tests for read_box_store")
+    gt = {"image_1": [[0, 0, 1, 1], [2, 2, 3, 3]], "image_2": []}
+    predictions = {"image_1": {"boxes": [[0, 0, 1, 1]], "scores": [0.5]},
+                   "image_2": {"boxes": [], "scores": []}}
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "boxes.json")
+        npz_filepath = os.path.join(directory, "boxes.npz")
+        with open(filepath, "w") as fp:
+            json.dump(gt, fp)
+        store = read_box_store(filepath, cache=False)
+        assert not os.path.exists(npz_filepath), "cache=False should not write a sidecar"
+        assert store.image_ids == ["image_1", "image_2"]
+        assert np.all(store.get_boxes("image_1") == np.array(gt["image_1"]))
+        assert store.get_boxes("image_2").shape == (0, 4)
+        assert store.scores is None
+
+        read_box_store(filepath)
+        assert os.path.isfile(npz_filepath), "Expected a sidecar in: {}".format(npz_filepath)
+        store = read_box_store(filepath)
+        assert np.all(store.get_boxes("image_1") == np.array(gt["image_1"]))
+
+        # A changed JSON file makes the sidecar stale, so it is regenerated
+        with open(filepath, "w") as fp:
+            json.dump(predictions, fp)
+        stat = os.stat(filepath)
+        os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        store = read_box_store(filepath)
+        assert np.all(store.get_boxes("image_1") == np.array([[0, 0, 1, 1]]))
+        assert np.all(store.get_scores("image_1") == np.array([0.5]))
+        assert store.get_scores("image_2").size == 0
+        _, cached_stat = BoxStore.load_npz(npz_filepath)
+        stat = os.stat(filepath)
+        ans = (stat.st_size, stat.st_mtime_ns)
+        assert cached_stat == ans, "Expected the regenerated sidecar of {}, got: {}".format(ans, cached_stat)
+
+
 if __name__ == "__main__":
     test_iou()
     test_precision()
@@ -211,5 +490,10 @@ if __name__ == "__main__":
     test_calculate_precision_recall_all_images()
     test_get_precision_recall_curve()
     test_mean_average_precision()
+    test_vectorized_matching()
+    test_exact_precision_recall_curve()
+    test_mean_average_precision_over_thresholds()
+    test_iterate_json_object()
+    test_read_box_store()
     print("="*80)
     print("All tests OK.")
\ No newline at end of file